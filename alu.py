@@ -1,38 +1,121 @@
-import math
+# PARITY_TABLE[b] is True when the byte b has an even number of set bits
+PARITY_TABLE = tuple(bin(b).count('1') % 2 == 0 for b in range(256))
+
+# Value mask and sign bit of each operand width
+MASKS = {8: 0xFF, 16: 0xFFFF, 32: 0xFFFFFFFF}
+SIGN_BITS = {8: 0x80, 16: 0x8000, 32: 0x80000000}
+
+#####################################################################
+# ALUException - A divide error raised by DIV/IDIV
+#####################################################################
+class ALUException(Exception):
+    pass
 
 #####################################################################
-# ALU - a class used for basic arithmetic operations on binary arrays
+# ALU - a class used for basic arithmetic operations on 8 and 16 bit
+# integers. The arithmetic operations return
+# (result, carry, overflow, auxiliary carry), the result is already
+# truncated to the operand width
 #####################################################################
 class ALU:
 
     @staticmethod
-    def binArrToDec(binArr):
-        bitsRev = binArr[::-1]
-        result = 0
-        for i, bit in enumerate(bitsRev):
-            result += math.pow(2, i) * int(bit)
-        return result
-
-    @staticmethod
-    def addTwoBinaryArrays(arr1, arr2):
-        assert len(arr1) == len(arr2)
-
-        carryFlag = False
-        resArr = [0 for i in range(len(arr1))]
-        arr1Rev = arr1[::-1]
-        arr2Rev = arr2[::-1]
-        carry = 0
-        for i in range(len(arr1Rev)):
-            result = arr1Rev[i] + arr2Rev[i] + carry
-            if result > 1:
-                result = result - 2
-                carry = 1
-            else:
-                carry = 0
-            resArr[i] = result
-
-        # check if there is carry remaining
-        if carry == 1:
-            carryFlag = True
-
-        return (resArr[::-1], carryFlag) 
+    def parity(value):
+        return PARITY_TABLE[value & 0xFF]
+
+    @staticmethod
+    def toSigned(value, width):
+        if value & SIGN_BITS[width]:
+            return value - (MASKS[width] + 1)
+        return value
+
+    @staticmethod
+    def add(a, b, width, carryIn=0):
+        mask = MASKS[width]
+        raw = a + b + carryIn
+        result = raw & mask
+        overflow = ((a ^ result) & (b ^ result) & SIGN_BITS[width]) != 0
+        return result, raw > mask, overflow, ((a ^ b ^ result) & 0x10) != 0
+
+    @staticmethod
+    def adc(a, b, width, carry):
+        return ALU.add(a, b, width, 1 if carry else 0)
+
+    @staticmethod
+    def sub(a, b, width, borrowIn=0):
+        raw = a - b - borrowIn
+        result = raw & MASKS[width]
+        overflow = ((a ^ b) & (a ^ result) & SIGN_BITS[width]) != 0
+        return result, raw < 0, overflow, ((a ^ b ^ result) & 0x10) != 0
+
+    @staticmethod
+    def sbb(a, b, width, carry):
+        return ALU.sub(a, b, width, 1 if carry else 0)
+
+    # cmp computes the same flags as sub, the caller does not store the result
+    @staticmethod
+    def cmp(a, b, width):
+        return ALU.sub(a, b, width)
+
+    # inc and dec leave the carry flag untouched, the returned carry should be ignored
+    @staticmethod
+    def inc(a, width):
+        return ALU.add(a, 1, width)
+
+    @staticmethod
+    def dec(a, width):
+        return ALU.sub(a, 1, width)
+
+    @staticmethod
+    def neg(a, width):
+        return ALU.sub(0, a, width)
+
+    @staticmethod
+    def bitwiseAnd(a, b, width):
+        return (a & b) & MASKS[width], False, False, False
+
+    @staticmethod
+    def bitwiseOr(a, b, width):
+        return (a | b) & MASKS[width], False, False, False
+
+    @staticmethod
+    def bitwiseXor(a, b, width):
+        return (a ^ b) & MASKS[width], False, False, False
+
+    # Multiplies two width-bit operands. Returns (low half, high half, carry and overflow)
+    @staticmethod
+    def mul(a, b, width, signed=False):
+        mask = MASKS[width]
+        if signed:
+            product = ALU.toSigned(a, width) * ALU.toSigned(b, width)
+            low = product & mask
+            high = (product >> width) & mask
+            # the flags are set when the high half is not just the sign extension of the low half
+            extended = mask if low & SIGN_BITS[width] else 0
+            return low, high, high != extended
+        product = a * b
+        high = product >> width
+        return product & mask, high, high != 0
+
+    # Divides a 2*width-bit dividend by a width-bit divisor. Returns (quotient, remainder)
+    @staticmethod
+    def div(dividend, divisor, width, signed=False):
+        mask = MASKS[width]
+        if divisor == 0:
+            raise ALUException("Divide by zero")
+        if signed:
+            dividend = ALU.toSigned(dividend, width * 2)
+            divisor = ALU.toSigned(divisor, width)
+            # 8086 division truncates towards zero and the remainder takes the sign of the dividend
+            quotient = abs(dividend) // abs(divisor)
+            if (dividend < 0) != (divisor < 0):
+                quotient = -quotient
+            remainder = dividend - quotient * divisor
+            limit = SIGN_BITS[width]
+            if quotient >= limit or quotient < -limit:
+                raise ALUException("Divide overflow")
+            return quotient & mask, remainder & mask
+        quotient, remainder = divmod(dividend, divisor)
+        if quotient > mask:
+            raise ALUException("Divide overflow")
+        return quotient, remainder
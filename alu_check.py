@@ -0,0 +1,245 @@
+import argparse
+import math
+import random
+import sys
+from alu import ALU, ALUException, MASKS
+from registers import FlagsRegister, toBits
+
+#####################################################################
+# BitSerialALU - the original list based ALU, kept as the reference
+# model for the integer ALU. Values are lists of bits, most
+# significant bit first
+#####################################################################
+class BitSerialALU:
+
+    @staticmethod
+    def binArrToDec(binArr):
+        bitsRev = binArr[::-1]
+        result = 0
+        for i, bit in enumerate(bitsRev):
+            result += math.pow(2, i) * int(bit)
+        return result
+
+    @staticmethod
+    def addTwoBinaryArrays(arr1, arr2):
+        assert len(arr1) == len(arr2)
+
+        carryFlag = False
+        resArr = [0 for i in range(len(arr1))]
+        arr1Rev = arr1[::-1]
+        arr2Rev = arr2[::-1]
+        carry = 0
+        for i in range(len(arr1Rev)):
+            result = arr1Rev[i] + arr2Rev[i] + carry
+            if result > 1:
+                result = result - 2
+                carry = 1
+            else:
+                carry = 0
+            resArr[i] = result
+
+        # check if there is carry remaining
+        if carry == 1:
+            carryFlag = True
+
+        return (resArr[::-1], carryFlag)
+
+    # The same ripple adder, also returning the carries the flags are derived from
+    # Returns (result, carry out, carry into the sign bit, carry out of bit 3)
+    @staticmethod
+    def rippleAdd(arr1, arr2, carry=0):
+        resArr = [0 for i in range(len(arr1))]
+        arr1Rev = arr1[::-1]
+        arr2Rev = arr2[::-1]
+        carryIntoSign = 0
+        carryOutOfBit3 = 0
+        for i in range(len(arr1Rev)):
+            if i == len(arr1Rev) - 1:
+                carryIntoSign = carry
+            result = arr1Rev[i] + arr2Rev[i] + carry
+            if result > 1:
+                result = result - 2
+                carry = 1
+            else:
+                carry = 0
+            resArr[i] = result
+            if i == 3:
+                carryOutOfBit3 = carry
+        return resArr[::-1], carry, carryIntoSign, carryOutOfBit3
+
+    # Returns (result bits, carry, overflow, auxiliary carry)
+    @staticmethod
+    def add(arr1, arr2, carryIn=0):
+        resArr, carry, carryIntoSign, carryOutOfBit3 = BitSerialALU.rippleAdd(arr1, arr2, carryIn)
+        return resArr, carry == 1, carryIntoSign != carry, carryOutOfBit3 == 1
+
+    # a - b - borrow computed as a + ~b + 1 - borrow, the borrows are the inverted carries
+    @staticmethod
+    def sub(arr1, arr2, borrowIn=0):
+        inverted = [1 - bit for bit in arr2]
+        resArr, carry, carryIntoSign, carryOutOfBit3 = BitSerialALU.rippleAdd(arr1, inverted, 1 - borrowIn)
+        return resArr, carry == 0, carryIntoSign != carry, carryOutOfBit3 == 0
+
+    @staticmethod
+    def bitwise(arr1, arr2, operation):
+        return [operation(bit1, bit2) for bit1, bit2 in zip(arr1, arr2)]
+
+    # Shift and add multiplication, returns the bits of the double width product
+    @staticmethod
+    def mul(arr1, arr2):
+        width = len(arr1)
+        product = [0 for i in range(width * 2)]
+        for i, bit in enumerate(arr2[::-1]):
+            if bit:
+                shifted = [0 for j in range(width - i)] + arr1 + [0 for j in range(i)]
+                product, carry = BitSerialALU.addTwoBinaryArrays(product, shifted)
+        return product
+
+    # Restoring division of a double width dividend, returns (quotient bits, remainder bits)
+    @staticmethod
+    def div(dividendArr, divisorArr):
+        width = len(divisorArr)
+        remainder = [0 for i in range(width + 1)]
+        quotient = []
+        divisor = [0] + divisorArr
+        for bit in dividendArr:
+            remainder = remainder[1:] + [bit]
+            difference, borrow, overflow, auxiliary = BitSerialALU.sub(remainder, divisor)
+            if borrow:
+                quotient.append(0)
+            else:
+                quotient.append(1)
+                remainder = difference
+        return quotient, remainder[1:]
+
+#####################################################################
+# Property checks - random and boundary operands are run through
+# both ALUs and the lazy FlagsRegister, every mismatch is reported
+#####################################################################
+
+BOUNDARY_VALUES = (0, 1, 2, 0x0F, 0x10, 0x7F, 0x80, 0xFF, 0x100, 0x7FFF, 0x8000, 0xFFFE, 0xFFFF)
+
+class Checker:
+    def __init__(self):
+        self.checks = 0
+        self.failures = []
+
+    def expect(self, name, operands, got, expected):
+        self.checks += 1
+        if got != expected:
+            self.failures.append("%s%r: got %r, expected %r" % (name, operands, got, expected))
+
+    # The flags the lazy FlagsRegister computes for a pending operation
+    @staticmethod
+    def lazyFlags(kind, a, b, raw, width):
+        flags = FlagsRegister()
+        if kind >= FlagsRegister.INC:
+            flags.setPendingIncDec(kind, a, raw, width)
+        else:
+            flags.pending = (kind, a, b, raw, width, None)
+        return flags.carry, flags.overflow, flags.auxiliary, flags.zero, flags.sign, flags.parity
+
+    # The flags derived from the bits of a result
+    @staticmethod
+    def resultFlags(bits):
+        return (not any(bits), bits[0] == 1, sum(bits[-8:]) % 2 == 0)
+
+    def checkArithmetic(self, a, b, width, carryIn):
+        bitsA, bitsB = toBits(a, width), toBits(b, width)
+
+        # add/adc
+        reference = BitSerialALU.add(bitsA, bitsB, carryIn)
+        expected = (int(BitSerialALU.binArrToDec(reference[0])),) + reference[1:]
+        self.expect('adc', (a, b, width, carryIn), ALU.adc(a, b, width, carryIn), expected)
+        lazy = Checker.lazyFlags(FlagsRegister.ADD, a, b, a + b + carryIn, width)
+        self.expect('lazy adc', (a, b, width, carryIn), lazy, reference[1:] + Checker.resultFlags(reference[0]))
+
+        # sub/sbb/cmp
+        reference = BitSerialALU.sub(bitsA, bitsB, carryIn)
+        expected = (int(BitSerialALU.binArrToDec(reference[0])),) + reference[1:]
+        self.expect('sbb', (a, b, width, carryIn), ALU.sbb(a, b, width, carryIn), expected)
+        lazy = Checker.lazyFlags(FlagsRegister.SUB, a, b, a - b - carryIn, width)
+        self.expect('lazy sbb', (a, b, width, carryIn), lazy, reference[1:] + Checker.resultFlags(reference[0]))
+
+        # and/or/xor
+        for name, aluFunc, bitFunc in (('and', ALU.bitwiseAnd, lambda x, y: x & y),
+                ('or', ALU.bitwiseOr, lambda x, y: x | y),
+                ('xor', ALU.bitwiseXor, lambda x, y: x ^ y)):
+            bits = BitSerialALU.bitwise(bitsA, bitsB, bitFunc)
+            self.expect(name, (a, b, width), aluFunc(a, b, width), (int(BitSerialALU.binArrToDec(bits)), False, False, False))
+            lazy = Checker.lazyFlags(FlagsRegister.LOGIC, a, b, aluFunc(a, b, width)[0], width)
+            self.expect('lazy ' + name, (a, b, width), lazy, (False, False, False) + Checker.resultFlags(bits))
+
+        # mul, the carry and overflow flags are set when the high half is not zero
+        product = BitSerialALU.mul(bitsA, bitsB)
+        high = int(BitSerialALU.binArrToDec(product[:width]))
+        expected = (int(BitSerialALU.binArrToDec(product[width:])), high, high != 0)
+        self.expect('mul', (a, b, width), ALU.mul(a, b, width), expected)
+
+        # div of the dividend b:a
+        dividend = (b << width) | a
+        divisor = (a ^ b) & MASKS[width]
+        quotientBits, remainderBits = BitSerialALU.div(toBits(dividend, width * 2), toBits(divisor, width))
+        try:
+            got = ALU.div(dividend, divisor, width)
+        except ALUException:
+            got = 'divide error'
+        if divisor == 0 or any(quotientBits[:width]):
+            expected = 'divide error'
+        else:
+            expected = (int(BitSerialALU.binArrToDec(quotientBits)), int(BitSerialALU.binArrToDec(remainderBits)))
+        self.expect('div', (dividend, divisor, width), got, expected)
+
+    def checkSingleOperand(self, a, width):
+        bitsA = toBits(a, width)
+        zeros = toBits(0, width)
+        one = toBits(1, width)
+
+        for name, aluFunc, kind, reference in (
+                ('inc', ALU.inc, FlagsRegister.INC, BitSerialALU.add(bitsA, one)),
+                ('dec', ALU.dec, FlagsRegister.DEC, BitSerialALU.sub(bitsA, one))):
+            result, carry, overflow, auxiliary = aluFunc(a, width)
+            self.expect(name, (a, width), (result, overflow, auxiliary),
+                (int(BitSerialALU.binArrToDec(reference[0])), reference[2], reference[3]))
+            raw = a + 1 if kind == FlagsRegister.INC else a - 1
+            lazy = Checker.lazyFlags(kind, a, 1, raw, width)
+            # inc/dec keep the carry of the operation before them, a fresh register has it clear
+            self.expect('lazy ' + name, (a, width), lazy, (False,) + reference[2:] + Checker.resultFlags(reference[0]))
+
+        reference = BitSerialALU.sub(zeros, bitsA)
+        self.expect('neg', (a, width), ALU.neg(a, width), (int(BitSerialALU.binArrToDec(reference[0])),) + reference[1:])
+
+    # Runs the checks on the boundary values and `iterations` random operand pairs per width
+    def run(self, iterations, seed, exhaustive):
+        rng = random.Random(seed)
+        for width in (8, 16):
+            mask = MASKS[width]
+            boundary = sorted(set(value & mask for value in BOUNDARY_VALUES))
+            pairs = [(a, b) for a in boundary for b in boundary]
+            if exhaustive and width == 8:
+                pairs = [(a, b) for a in range(256) for b in range(256)]
+            else:
+                pairs += [(rng.randint(0, mask), rng.randint(0, mask)) for i in range(iterations)]
+
+            for a, b in pairs:
+                self.checkArithmetic(a, b, width, (a + b) & 1)
+            for a, b in pairs[:iterations]:
+                self.checkSingleOperand(a, width)
+        return not self.failures
+
+def main():
+    argParser = argparse.ArgumentParser(description="Checks the integer ALU against the bit-serial reference ALU")
+    argParser.add_argument('--iterations', type=int, default=2000, help="random operand pairs per width")
+    argParser.add_argument('--seed', type=int, default=8086)
+    argParser.add_argument('--exhaustive', action='store_true', help="check every 8-bit operand pair")
+    args = argParser.parse_args()
+
+    checker = Checker()
+    passed = checker.run(args.iterations, args.seed, args.exhaustive)
+    for failure in checker.failures[:20]:
+        print(failure)
+    print("%d checks, %d failures" % (checker.checks, len(checker.failures)))
+    sys.exit(0 if passed else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import hashlib
+import os
+from emit import ASSEMBLER_VERSION
+
+# Where assembled programs are kept unless another directory is given
+DEFAULT_CACHE_DIR = os.environ.get('SIM8086_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', '8086-simulator'))
+
+# The cache evicts the least recently used programs once it grows beyond this size
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+IMAGE_EXTENSION = '.bin'
+
+#####################################################################
+# AssemblyCache - an on-disk cache of assembled machine code images.
+# Images are keyed by a hash of the source and the assembler version.
+# Every hit refreshes the modification time of the entry, which is
+# the order of the least recently used eviction
+#####################################################################
+class AssemblyCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR, maxBytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(source):
+        digest = hashlib.sha256()
+        digest.update(b'%d\0' % ASSEMBLER_VERSION)
+        digest.update(source.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, source):
+        return os.path.join(self.directory, AssemblyCache.key(source) + IMAGE_EXTENSION)
+
+    # Returns the cached image of the source, or None
+    def get(self, source):
+        path = self._path(source)
+        try:
+            with open(path, 'rb') as imageFile:
+                image = imageFile.read()
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return image
+
+    # Stores the image of the source and evicts old entries if the cache is too big
+    def put(self, source, image):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(source)
+
+        # write to a temporary file first so readers never see a partial image
+        temporaryPath = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporaryPath, 'wb') as imageFile:
+            imageFile.write(image)
+        os.replace(temporaryPath, path)
+        self.evict()
+
+    # Returns (modification time, size, path) of every cached image
+    def _entries(self):
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith(IMAGE_EXTENSION):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+        return entries
+
+    # Removes the least recently used images until the cache fits in maxBytes
+    def evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    # Removes every cached image
+    def clear(self):
+        for mtime, size, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def size(self):
+        return sum(size for mtime, size, path in self._entries())
@@ -0,0 +1,362 @@
+from bisect import bisect_right
+from lex import StreamLexer, IteratorLexer, iterTokens
+from parse import Parser
+from emit import Emitter, EmitterException, patchBranch
+
+# Lexes, parses and emits a source, returns the emitter holding the opcode script and the machine code
+def assemble(source, verbose=False):
+    emitter = Emitter()
+    parser = Parser(StreamLexer(source), emitter, verbose)
+    parser.program()
+    return emitter
+
+# Returns the machine code of a source, taken from the cache when it was assembled before
+def assembleCached(source, cache):
+    image = cache.get(source)
+    if image is None:
+        image = assemble(source).getMachineCode()
+        cache.put(source, image)
+    return image
+
+# Assembles a source given as an iterable of lines (like an open file) one statement at a time.
+# Yields (opcode script line, machine code) per statement as soon as it is parsed, so the
+# memory use does not grow with the source and the output can be used before assembly ends
+def assembleStream(lines, verbose=False):
+    emitter = Emitter(keepProgram=False)
+    parser = Parser(IteratorLexer(iterTokens(lines)), emitter, verbose)
+    for statement in parser.statements():
+        yield from emitter.takeStatements()
+    emitter.finish()
+    yield from emitter.takeStatements()
+
+# Distinct line texts whose results are remembered by an IncrementalAssembler
+MAX_REMEMBERED_LINES = 65536
+
+# Lines are kept in blocks of at most this many lines
+BLOCK_LINES = 256
+
+#####################################################################
+# AssembledLine - the result of one source line: its opcode script
+# line and machine code, or the error it failed with. Blank lines
+# have no script line and no code. A line does not depend on where
+# it is: the labels it defines and its branches are kept with
+# offsets from the start of the line, and the displacements of the
+# branches are filled in when the program is put together
+#####################################################################
+class AssembledLine:
+    __slots__ = ('text', 'script', 'code', 'error', 'labels', 'branches')
+
+    def __init__(self, text, script=None, code=b'', error=None, labels=(), branches=()):
+        self.text = text
+        self.script = script
+        self.code = code
+        self.error = error
+        # (label, offset) pairs and (position, size, label, end) branches
+        self.labels = labels
+        self.branches = branches
+
+# Assembles one line on its own, branches to labels are left unresolved
+def _assembleSingleLine(text):
+    emitter = Emitter(keepProgram=False, resolveLabels=False)
+    parser = Parser(IteratorLexer(iterTokens((text,))), emitter)
+    parser.program()
+    emitter.finish()
+    statements = emitter.takeStatements()
+    script, code = statements[0] if statements else (None, b'')
+    return AssembledLine(text, script, code, labels=tuple(emitter.labels.items()),
+        branches=tuple(emitter.unresolvedBranches()))
+
+#####################################################################
+# AssembledBlock - consecutive lines together with their joined
+# machine code and the labels, branches and errors of the lines,
+# kept with offsets from the start of the block and line numbers
+# within the block. A block is immutable apart from its index and
+# the link errors of its branches, an edit replaces whole blocks
+#####################################################################
+class AssembledBlock:
+    __slots__ = ('lines', 'index', 'size', 'code', 'labels', 'branches', 'targets', 'externalLabels',
+        'errors', 'linkErrors')
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.index = 0
+        # (label, offset, line) definitions, (line, position, size, label, end) branches and (line, message) errors
+        self.labels = []
+        self.branches = []
+        self.errors = []
+        offset = 0
+        for number, line in enumerate(lines):
+            if line.error is not None:
+                self.errors.append((number, line.error))
+            for label, labelOffset in line.labels:
+                self.labels.append((label, offset + labelOffset, number))
+            for position, size, label, end in line.branches:
+                self.branches.append((number, offset + position, size, label, offset + end))
+            offset += len(line.code)
+        self.size = offset
+        self.code = b''.join(line.code for line in lines)
+
+        # branch indexes by target label, and the targets that are not defined in the block
+        self.targets = {}
+        for index, branch in enumerate(self.branches):
+            self.targets.setdefault(branch[3], []).append(index)
+        defined = {label for label, offset, number in self.labels}
+        self.externalLabels = [label for label in self.targets if label not in defined]
+        # (line, message) of the branches that could not be patched, by branch index
+        self.linkErrors = {}
+
+#####################################################################
+# IncrementalAssembler - keeps the assembled result of every line of
+# a source. An edit re-lexes and re-parses only the replaced lines
+# (lines seen before are not even re-parsed).
+# The lines are kept in blocks, so an edit only rebuilds the blocks
+# it touches. The first line and code offset of every block are
+# recomputed lazily, and only past an edit that changed the number
+# of lines or the size of the code.
+# The program is linked once in full, afterwards an edit splices the
+# code of its blocks into the linked code and patches the branches
+# of the new blocks, the branches to labels it defined or removed
+# and the branches that jump across a change of the code size. Every
+# other branch moved together with its target
+#####################################################################
+class IncrementalAssembler:
+    def __init__(self, source=''):
+        self._remembered = {}
+        self.setSource(source)
+
+    # Assembles a single line on its own, statements never span lines
+    def _assembleLine(self, text):
+        result = self._remembered.get(text)
+        if result is not None:
+            return result
+        if not text.strip():
+            result = AssembledLine(text)
+        else:
+            try:
+                result = _assembleSingleLine(text)
+            except SystemExit as error:
+                # the lexer and the parser abort with sys.exit, the error stays with its line
+                result = AssembledLine(text, error=str(error))
+            except Exception as error:
+                result = AssembledLine(text, error=str(error))
+        if len(self._remembered) >= MAX_REMEMBERED_LINES:
+            self._remembered.clear()
+        self._remembered[text] = result
+        return result
+
+    def setSource(self, source):
+        self._blocks = [AssembledBlock([])]
+        # first line number and code offset of every block, valid for the blocks before len(_firstLines)
+        self._firstLines = [0]
+        self._offsets = [0]
+        # the linked code, None until the program is linked in full
+        self._code = None
+        # every error until the next edit
+        self._checked = None
+        self.edit(0, 0, source.split('\n') if source else [])
+
+    # Computes the first line and code offset of every block
+    def _computeBlockStarts(self):
+        firstLines = self._firstLines
+        offsets = self._offsets
+        for index in range(len(firstLines), len(self._blocks)):
+            previous = self._blocks[index - 1]
+            firstLines.append(firstLines[index - 1] + len(previous.lines))
+            offsets.append(offsets[index - 1] + previous.size)
+
+    # Returns the index of the block holding the line, the line after the last one is in the last block
+    def _blockOf(self, lineNumber):
+        self._computeBlockStarts()
+        return max(0, bisect_right(self._firstLines, lineNumber) - 1)
+
+    def __len__(self):
+        self._computeBlockStarts()
+        return self._firstLines[-1] + len(self._blocks[-1].lines)
+
+    # Every line result in order
+    @property
+    def lines(self):
+        return [line for block in self._blocks for line in block.lines]
+
+    # Replaces the lines [start, stop) with newLines and assembles only them.
+    # Returns the number of lines that were assembled
+    def edit(self, start, stop, newLines):
+        if not 0 <= start <= stop <= len(self):
+            raise IndexError("Edit range %d-%d is outside the %d lines of the source" % (start, stop, len(self)))
+        results = [self._assembleLine(text) for text in newLines]
+
+        # merge the touched blocks, splice the new lines in and split them again
+        first = self._blockOf(start)
+        last = self._blockOf(stop)
+        base = self._firstLines[first]
+        regionStart = self._offsets[first]
+        removed = self._blocks[first:last + 1]
+        merged = [line for block in removed for line in block.lines]
+        merged[start - base:stop - base] = results
+        added = [AssembledBlock(merged[index:index + BLOCK_LINES]) for index in range(0, len(merged), BLOCK_LINES)]
+        if not added and len(self._blocks) == len(removed):
+            added = [AssembledBlock([])]
+
+        oldLineCount = sum(len(block.lines) for block in removed)
+        oldSize = sum(block.size for block in removed)
+        newSize = sum(block.size for block in added)
+        self._blocks[first:last + 1] = added
+        renumbered = self._blocks[first:] if len(added) != len(removed) else added
+        for index, block in enumerate(renumbered, first):
+            block.index = index
+
+        if len(merged) == oldLineCount and newSize == oldSize and len(self._firstLines) > last + 1:
+            # the blocks after the edit keep their starts, only the rebuilt blocks get new ones
+            firstLines, offsets = [base], [regionStart]
+            for block in added[:-1]:
+                firstLines.append(firstLines[-1] + len(block.lines))
+                offsets.append(offsets[-1] + block.size)
+            self._firstLines[first:last + 1] = firstLines
+            self._offsets[first:last + 1] = offsets
+        else:
+            del self._firstLines[first + 1:]
+            del self._offsets[first + 1:]
+
+        self._checked = None
+        if self._code is not None:
+            self._relink(first, removed, added, regionStart, oldSize, newSize)
+        return len(results)
+
+    # Replaces a single line
+    def setLine(self, lineNumber, text):
+        self.edit(lineNumber, lineNumber + 1, [text])
+
+    # Returns the offset of the machine code of a line from the start of the program
+    def offsetOf(self, lineNumber):
+        index = self._blockOf(lineNumber)
+        block = self._blocks[index]
+        return self._offsets[index] + sum(len(line.code) for line in block.lines[:lineNumber - self._firstLines[index]])
+
+    # Adds the labels and branches of a block to the label tables, the labels it defines are added to changed
+    def _record(self, block, changed):
+        for entry in block.labels:
+            label = entry[0]
+            definitions = self._definitions.setdefault(label, [])
+            definitions.append((block,) + entry[1:])
+            if len(definitions) > 1:
+                self._duplicates.add(label)
+            changed.add(label)
+        for label in block.targets:
+            self._references.setdefault(label, set()).add(block)
+
+    # Removes the labels and branches of a block from the label tables
+    def _forget(self, block, changed):
+        for label in {entry[0] for entry in block.labels}:
+            definitions = [entry for entry in self._definitions[label] if entry[0] is not block]
+            if definitions:
+                self._definitions[label] = definitions
+            else:
+                del self._definitions[label]
+            if len(definitions) < 2:
+                self._duplicates.discard(label)
+            changed.add(label)
+        for label in block.targets:
+            references = self._references[label]
+            references.discard(block)
+            if not references:
+                del self._references[label]
+
+    # Fills in the displacement of a branch of a block, the last definition of a label is its target
+    def _patch(self, block, branchIndex):
+        number, position, size, label, end = block.branches[branchIndex]
+        start = self._offsets[block.index]
+        definitions = self._definitions.get(label)
+        block.linkErrors.pop(branchIndex, None)
+        if definitions is None:
+            block.linkErrors[branchIndex] = (number, "Undefined label: " + label)
+            return
+        target, offset, line = definitions[-1]
+        try:
+            patchBranch(self._code, start + position, size, self._offsets[target.index] + offset - start - end, label)
+        except EmitterException as error:
+            block.linkErrors[branchIndex] = (number, str(error))
+
+    # Puts the machine code of the blocks together and fills in the displacements of every branch
+    def _link(self):
+        self._code = bytearray(b''.join(block.code for block in self._blocks))
+        # label definitions as (block, offset, line), the blocks with branches to a label, and the labels defined twice
+        self._definitions = {}
+        self._references = {}
+        self._duplicates = set()
+        changed = set()
+        for block in self._blocks:
+            self._record(block, changed)
+        self._computeBlockStarts()
+        for block in self._blocks:
+            for branchIndex in range(len(block.branches)):
+                self._patch(block, branchIndex)
+
+    # Updates the linked code after an edit replaced the removed blocks with the added ones, from block first on
+    def _relink(self, first, removed, added, regionStart, oldSize, newSize):
+        self._code[regionStart:regionStart + oldSize] = b''.join(block.code for block in added)
+        changed = set()
+        for block in removed:
+            self._forget(block, changed)
+        for block in added:
+            self._record(block, changed)
+        if self._duplicates:
+            # which definition a branch goes to depends on the order of every definition, link it all again
+            self._code = None
+            return
+        self._computeBlockStarts()
+
+        for block in added:
+            for branchIndex in range(len(block.branches)):
+                self._patch(block, branchIndex)
+        for label in changed:
+            for block in self._references.get(label, ()):
+                if block not in added:
+                    for branchIndex in block.targets[label]:
+                        self._patch(block, branchIndex)
+        if newSize == oldSize:
+            return
+
+        # a branch jumps across the size change when only one of itself and its target comes after the edit.
+        # Without duplicates a label defined in the block of the branch never is such a target
+        after = first + len(added)
+        for block in self._blocks[:first] + self._blocks[after:]:
+            moved = block.index >= after
+            for label in block.externalLabels:
+                definitions = self._definitions.get(label)
+                if label in changed or definitions is None:
+                    continue
+                if (definitions[0][0].index >= after) != moved:
+                    for branchIndex in block.targets[label]:
+                        self._patch(block, branchIndex)
+
+    # Returns every error as a sorted list of (line number, message)
+    def _check(self):
+        if self._checked is None:
+            if self._code is None:
+                self._link()
+            self._computeBlockStarts()
+            linkErrors = []
+            lineErrors = []
+            for block in self._blocks:
+                base = self._firstLines[block.index]
+                linkErrors.extend((base + number, message) for number, message in block.linkErrors.values())
+                lineErrors.extend((base + number, message) for number, message in block.errors)
+            for label in self._duplicates:
+                for block, offset, number in self._definitions[label][1:]:
+                    linkErrors.append((self._firstLines[block.index] + number, "Label defined twice: " + label))
+            self._checked = sorted(lineErrors + linkErrors)
+        return self._checked
+
+    # Returns (line number, message) for every line that failed to assemble or whose labels do not resolve
+    def errors(self):
+        return list(self._check())
+
+    def getMachineCode(self):
+        # a line that failed to assemble fails the whole source, as it does for assemble()
+        errors = self._check()
+        if errors:
+            raise EmitterException("Line %d: %s" % (errors[0][0] + 1, errors[0][1]))
+        return bytes(self._code)
+
+    def getProgramScript(self):
+        return ''.join(line.script + '\n' for block in self._blocks for line in block.lines if line.script is not None)
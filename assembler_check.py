@@ -0,0 +1,136 @@
+from assembler import IncrementalAssembler, assemble
+from differential import DifferentialChecker
+
+# Instructions of the generated sources besides labels and branches, {} is a random number
+PLAIN_LINES = ('mov ax, {}', 'inc bx', 'add ax, bx', 'nop', 'mov [bx+si+4], ax', 'push ax', 'dec cx', 'mov word ptr [{}], 1')
+
+# Lines that fail to assemble, the edits bring them in now and then and fix them again
+INVALID_LINES = ('mov qq, 2', 'add ax', 'jmp', 'mov ax, bx, cx', 'inc 5', 'mov [bx+cx], ax')
+
+# Branches with a 16-bit displacement, they reach any label of a generated source
+NEAR_BRANCH_MNEMONICS = ('jmp', 'call')
+
+# Branches with an 8-bit displacement, they only go back to the label a few lines before them
+SHORT_BRANCH_MNEMONICS = ('jnz', 'jz', 'loop', 'jc')
+
+# Returns the label a branch line goes to, None for every other line
+def branchTarget(line):
+    parts = line.split()
+    return parts[1] if len(parts) == 2 and parts[0] in NEAR_BRANCH_MNEMONICS + SHORT_BRANCH_MNEMONICS else None
+
+#####################################################################
+# AssemblerChecker - applies random edits to an IncrementalAssembler
+# and compares its machine code with a full assembly of the edited
+# source. Edits replace, insert and delete short runs and long runs
+# of lines with labels and branches in them, so labels move and code
+# sizes change on either side of the branches. After an edit the
+# branches to removed labels are edited into nops, like a user fixing
+# the errors. Now and then an edit brings in lines that fail to
+# assemble, which are fixed after the next comparison, and a label
+# is defined twice and removed again
+#####################################################################
+class AssemblerChecker(DifferentialChecker):
+    DESCRIPTION = "Checks the incremental assembler against full assembly on random edits"
+    OPTIONS = {
+        'sequences': ('sequences', 60, None),
+        'edits': ('edits', 40, "edits per sequence"),
+    }
+
+    def __init__(self):
+        super().__init__()
+        self.linked = 0
+        # the number of label names handed out
+        self.labels = 0
+
+    # Returns count random source lines. Labels get new names, near branches go to any of the
+    # defined labels, short branches close a small loop and a few lines are invalid
+    def newLines(self, rng, count, defined):
+        lines = []
+        while len(lines) < count:
+            kind = rng.random()
+            if kind < 0.05:
+                self.labels += 1
+                label = 'l%d' % self.labels
+                body = [rng.choice(PLAIN_LINES).format(rng.randint(0, 0xFFFF)) for i in range(rng.randint(0, 5))]
+                lines += [label + ':'] + body + ['%s %s' % (rng.choice(SHORT_BRANCH_MNEMONICS), label)]
+            elif kind < 0.1:
+                self.labels += 1
+                lines.append('l%d:' % self.labels)
+                defined.append('l%d' % self.labels)
+            elif kind < 0.2 and defined:
+                lines.append('%s %s' % (rng.choice(NEAR_BRANCH_MNEMONICS), rng.choice(defined)))
+            elif kind < 0.21:
+                lines.append(rng.choice(INVALID_LINES))
+            elif kind < 0.3:
+                lines.append('')
+            else:
+                lines.append(rng.choice(PLAIN_LINES).format(rng.randint(0, 0xFFFF)))
+        return lines
+
+    # Returns the machine code of a source or the message it fails with
+    @staticmethod
+    def outcome(build):
+        try:
+            return build(), None
+        except (SystemExit, Exception) as error:
+            return None, str(error)
+
+    # Compares the incremental assembler with a full assembly of the lines
+    def compare(self, sequence, step, assembler, lines):
+        case = "edit %d of sequence %d" % (step, sequence)
+        # the parser of a whole source does not take leading blank lines
+        source = '\n'.join(lines).lstrip('\n')
+        expected, expectedError = AssemblerChecker.outcome(lambda: assemble(source).getMachineCode())
+        got, error = AssemblerChecker.outcome(assembler.getMachineCode)
+        self.expect('failure', case, error is not None, expectedError is not None)
+        self.expect('machine code', case, got, expected)
+        self.expect('line count', case, len(assembler), len(lines))
+        if error is None:
+            self.linked += 1
+
+    def checkSequence(self, sequence, rng, edits):
+        defined = []
+        lines = self.newLines(rng, rng.randrange(900), defined)
+        assembler = IncrementalAssembler('\n'.join(lines))
+        for step in range(edits):
+            # mostly edits of a few lines like an editor makes, sometimes a paste or a deleted region
+            wide = rng.random() < 0.2
+            start = rng.randint(0, len(lines))
+            stop = min(len(lines), start + rng.randrange(300 if wide else 4))
+            defined = [line[:-1] for line in lines[:start] + lines[stop:] if line.endswith(':')]
+            newLines = self.newLines(rng, rng.randrange(300 if wide else 4), defined)
+            lines[start:stop] = newLines
+            assembler.edit(start, stop, newLines)
+
+            defined = set(defined)
+            for number, line in enumerate(lines):
+                if branchTarget(line) is not None and branchTarget(line) not in defined:
+                    lines[number] = 'nop'
+                    assembler.setLine(number, 'nop')
+            if rng.random() < 0.5:
+                # several edits before the next link
+                continue
+            self.compare(sequence, step, assembler, lines)
+            for number, line in enumerate(lines):
+                if line in INVALID_LINES:
+                    lines[number] = 'nop'
+                    assembler.setLine(number, 'nop')
+
+            if defined and rng.random() < 0.1:
+                number = rng.randint(0, len(lines))
+                duplicate = rng.choice(sorted(defined)) + ':'
+                lines.insert(number, duplicate)
+                assembler.edit(number, number, [duplicate])
+                self.compare(sequence, step, assembler, lines)
+                del lines[number]
+                assembler.edit(number, number + 1, [])
+
+    def run(self, rng, sequences, edits):
+        for sequence in range(sequences):
+            self.checkSequence(sequence, rng, edits)
+
+    def summary(self):
+        return "%s, %d sources linked" % (super().summary(), self.linked)
+
+if __name__ == "__main__":
+    AssemblerChecker.main()
@@ -0,0 +1,264 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from assembler import assemble
+from cpu import CPU8086
+from jit import DEFAULT_THRESHOLD
+
+# Instructions a batch program may execute before it is stopped
+DEFAULT_MAX_STEPS = 1000000
+
+# Memory returned with every result, (start, stop)
+DEFAULT_MEMORY_WINDOW = (0, 16)
+
+# Loaded program snapshots kept by a runner, the oldest is dropped first
+MAX_CHECKPOINTS = 64
+
+# Assembled sources kept by a runner, the oldest is dropped first
+MAX_IMAGES = 256
+
+# Instructions a job with a timeout runs between two looks at the clock
+TIMEOUT_CHECK_STEPS = 20000
+
+#################################################################
+# BatchTimeout - A job did not halt within its time limit
+#################################################################
+class BatchTimeout(Exception):
+    pass
+
+#####################################################################
+# BatchJob - one program of a batch together with the state it
+# starts from. The program is an assembly source (str) or a machine
+# code image (bytes). registers maps register names to values and
+# memory maps physical addresses to the bytes stored there. A job
+# stops after maxSteps instructions, and fails when it runs longer
+# than timeout seconds (None never times out)
+#####################################################################
+class BatchJob:
+    __slots__ = ('program', 'registers', 'memory', 'maxSteps', 'timeout')
+
+    def __init__(self, program, registers=None, memory=None, maxSteps=DEFAULT_MAX_STEPS, timeout=None):
+        self.program = program
+        self.registers = registers or {}
+        self.memory = memory or {}
+        self.maxSteps = maxSteps
+        self.timeout = timeout
+
+#####################################################################
+# BatchResult - the final state of one job. error holds the message
+# of the exception that stopped the job, or None
+#####################################################################
+class BatchResult:
+    __slots__ = ('index', 'registers', 'flags', 'memory', 'steps', 'halted', 'error')
+
+    def __init__(self, index, registers, flags, memory, steps, halted, error=None):
+        self.index = index
+        self.registers = registers
+        self.flags = flags
+        self.memory = memory
+        self.steps = steps
+        self.halted = halted
+        self.error = error
+
+    def asDict(self):
+        return {'index': self.index, 'registers': self.registers, 'flags': self.flags,
+            'memory': self.memory.hex(), 'steps': self.steps, 'halted': self.halted, 'error': self.error}
+
+#####################################################################
+# BatchRun - the results of a batch in job order and how long the
+# batch took
+#####################################################################
+class BatchRun:
+    def __init__(self, results, elapsed, workers):
+        self.results = results
+        self.elapsed = elapsed
+        self.workers = workers
+
+    @property
+    def programsPerSecond(self):
+        return len(self.results) / self.elapsed if self.elapsed > 0 else float('inf')
+
+    @property
+    def failures(self):
+        return [result for result in self.results if result.error is not None]
+
+# Builds the jobs running one program from each of the given initial states.
+# A state is a dict with optional 'registers' and 'memory' entries
+def jobsForStates(program, states, maxSteps=DEFAULT_MAX_STEPS):
+    return [BatchJob(program, state.get('registers'), state.get('memory'), maxSteps) for state in states]
+
+#####################################################################
+# BatchRunner - runs jobs one after the other on a single CPU8086.
+# Sources are assembled once per runner, and every image is loaded
+# once into a fresh CPU and snapshotted. Later jobs running the same
+# image restore that snapshot, which only copies back the pages the
+# previous job wrote and keeps the decoded instructions
+#####################################################################
+class BatchRunner:
+    def __init__(self, memoryWindow=DEFAULT_MEMORY_WINDOW, jitThreshold=None):
+        self.memoryWindow = memoryWindow
+        self.cpu = CPU8086()
+        if jitThreshold is not None:
+            self.cpu.enableJit(jitThreshold)
+        # machine code images by source, and snapshots of the CPU with an image just loaded by image
+        self._images = {}
+        self._checkpoints = {}
+
+    # Returns the machine code of a program, assembling sources on first use
+    def image(self, program):
+        if not isinstance(program, str):
+            return bytes(program)
+        image = self._images.get(program)
+        if image is None:
+            try:
+                image = assemble(program).getMachineCode()
+            except SystemExit as error:
+                # the lexer and the parser abort with sys.exit, a bad program must not end the batch
+                raise ValueError(str(error))
+            if len(self._images) >= MAX_IMAGES:
+                del self._images[next(iter(self._images))]
+            self._images[program] = image
+        return image
+
+    # Puts the CPU in its state right after loading the image into a reset CPU
+    def _start(self, image):
+        checkpoint = self._checkpoints.get(image)
+        if checkpoint is not None:
+            self.cpu.restore(checkpoint)
+            return
+        self.cpu.reset()
+        self.cpu.loadProgram(image)
+        if len(self._checkpoints) >= MAX_CHECKPOINTS:
+            del self._checkpoints[next(iter(self._checkpoints))]
+        self._checkpoints[image] = self.cpu.snapshot()
+
+    # Runs a single job from the freshly loaded image and collects its final state
+    def runJob(self, index, job):
+        cpu = self.cpu
+        error = None
+        try:
+            self._start(self.image(job.program))
+            for name, value in job.registers.items():
+                cpu.regFile.setByName(name, value)
+            for address, data in job.memory.items():
+                cpu.memory[address:address + len(data)] = data
+            self._execute(job)
+        except Exception as exception:
+            # any failure is reported in the result, the rest of the batch still runs
+            error = "%s: %s" % (type(exception).__name__, exception)
+
+        start, stop = self.memoryWindow
+        return BatchResult(index, cpu.regFile.asDict(), cpu.flags.getWord(), bytes(cpu.memory[start:stop]),
+            cpu.steps, cpu.halted, error)
+
+    # Runs the loaded job until it halts or used up its instructions. A job with a timeout runs
+    # in slices of TIMEOUT_CHECK_STEPS instructions and the clock is read between them
+    def _execute(self, job):
+        cpu = self.cpu
+        # the run loop of the CPU only stops when its step count equals the limit
+        if job.maxSteps is not None and job.maxSteps < 0:
+            raise ValueError("maxSteps must not be negative, got %d" % job.maxSteps)
+        if job.timeout is None:
+            cpu.run(job.maxSteps)
+            return
+        deadline = time.perf_counter() + job.timeout
+        remaining = job.maxSteps
+        while not cpu.halted and remaining != 0:
+            if time.perf_counter() > deadline:
+                raise BatchTimeout("no hlt within %gs" % job.timeout)
+            budget = TIMEOUT_CHECK_STEPS if remaining is None else min(remaining, TIMEOUT_CHECK_STEPS)
+            steps = cpu.run(budget)
+            if remaining is not None:
+                remaining -= steps
+
+    def run(self, jobs):
+        start = time.perf_counter()
+        results = [self.runJob(index, job) for index, job in enumerate(jobs)]
+        return BatchRun(results, time.perf_counter() - start, 1)
+
+#####################################################################
+# Pool mode - the batch is split into chunks that are run by worker
+# processes. Every worker keeps its own BatchRunner, so workers and
+# their assembled programs are reused across batches
+#####################################################################
+
+# The runner of the current worker process
+_workerRunner = None
+
+# Initializer of a worker process (or of the single worker thread of an in-process executor)
+def initWorker(memoryWindow=DEFAULT_MEMORY_WINDOW, jitThreshold=None):
+    global _workerRunner
+    _workerRunner = BatchRunner(memoryWindow, jitThreshold)
+
+def _runChunk(chunk):
+    first, jobs = chunk
+    return [_workerRunner.runJob(first + offset, job) for offset, job in enumerate(jobs)]
+
+# Runs a single job on the runner of the current worker, returns its result as a dict
+def runWorkerJob(job):
+    return _workerRunner.runJob(0, job).asDict()
+
+class BatchPool:
+    def __init__(self, processes=None, memoryWindow=DEFAULT_MEMORY_WINDOW, jitThreshold=None, chunkSize=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.chunkSize = chunkSize
+        self._pool = multiprocessing.Pool(self.processes, initWorker, (memoryWindow, jitThreshold))
+
+    def run(self, jobs):
+        jobs = list(jobs)
+        # a few chunks per worker keep the workers busy when the jobs take uneven time
+        chunkSize = self.chunkSize or max(1, -(-len(jobs) // (self.processes * 4)))
+        chunks = [(first, jobs[first:first + chunkSize]) for first in range(0, len(jobs), chunkSize)]
+
+        start = time.perf_counter()
+        results = []
+        for chunkResults in self._pool.imap(_runChunk, chunks):
+            results.extend(chunkResults)
+        return BatchRun(results, time.perf_counter() - start, self.processes)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+def main():
+    argParser = argparse.ArgumentParser(description="Runs many programs in one process or a pool of processes")
+    argParser.add_argument('sources', nargs='+', help="assembly source files")
+    argParser.add_argument('--repeat', type=int, default=1, help="times every source is run")
+    argParser.add_argument('--processes', type=int, default=0, help="worker processes, 0 runs in this process")
+    argParser.add_argument('--max-steps', type=int, default=DEFAULT_MAX_STEPS)
+    argParser.add_argument('--timeout', type=float, help="seconds a program may run before it fails")
+    argParser.add_argument('--jit', action='store_true', help="run the programs with the block compiling tier")
+    argParser.add_argument('--json', action='store_true', help="print every result as a JSON line")
+    args = argParser.parse_args()
+
+    programs = []
+    for path in args.sources:
+        with open(path, 'r') as inputFile:
+            programs.append(inputFile.read())
+    jobs = [BatchJob(program, maxSteps=args.max_steps, timeout=args.timeout) for program in programs for i in range(args.repeat)]
+    jitThreshold = DEFAULT_THRESHOLD if args.jit else None
+
+    if args.processes > 0:
+        with BatchPool(args.processes, jitThreshold=jitThreshold) as pool:
+            batch = pool.run(jobs)
+    else:
+        batch = BatchRunner(jitThreshold=jitThreshold).run(jobs)
+
+    if args.json:
+        for result in batch.results:
+            print(json.dumps(result.asDict()))
+    for result in batch.failures:
+        print("job %d: %s" % (result.index, result.error))
+    print("%d programs in %.3fs with %d worker(s): %.0f programs/s" %
+        (len(batch.results), batch.elapsed, batch.workers, batch.programsPerSecond))
+
+if __name__ == "__main__":
+    main()
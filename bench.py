@@ -0,0 +1,391 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+from registers import FlagsRegister
+from cpu import CPU8086
+from lex import Lexer, TokenType, tokenize
+from batch import BatchJob, BatchRunner, BatchPool, jobsForStates
+from assembler import assemble, assembleStream
+from vector import VectorCPU, np
+from server import localLoadTest
+
+# resource only exists on Unix, the peak resident size is not reported elsewhere
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#####################################################################
+# Benchmarks - small timing harnesses for the hot parts of the
+# simulator. Run as:
+#   python bench.py [benchmark name ...] [--json FILE] [--baseline FILE]
+# Every benchmark returns a dict of metrics, the results of a run can
+# be saved and compared against a stored baseline
+#####################################################################
+
+# Metrics where a smaller value is better, every other metric is a rate
+LOWER_IS_BETTER = {'peakKiB', 'maxRssKiB', 'p50Ms', 'p99Ms', 'maxMs', 'errors'}
+
+# A metric regresses when it is this much worse than the baseline
+DEFAULT_REGRESSION_THRESHOLD = 0.10
+
+# Generates deterministic operand pairs for the arithmetic benchmarks
+def _operands(count, width):
+    mask = 0xFFFF if width == 16 else 0xFF
+    return [((i * 40503) & mask, (i * 9973 + 17) & mask) for i in range(count)]
+
+# Times `count` add/sub operations recording their flags.
+# Lazy mode reads the flags once every `readEvery` operations (like a conditional jump at the
+# end of a loop body), eager mode computes every flag after every operation
+def benchFlags(count=200000, readEvery=16):
+    results = {}
+    for width in (8, 16):
+        mask = 0xFFFF if width == 16 else 0xFF
+        operands = _operands(count, width)
+
+        for mode in ('eager', 'lazy'):
+            flags = FlagsRegister()
+            materializeEvery = 1 if mode == 'eager' else readEvery
+            start = time.perf_counter()
+            for i, (a, b) in enumerate(operands):
+                if i & 1:
+                    flags.pending = (FlagsRegister.SUB, a, b, a - b, width, None)
+                else:
+                    flags.pending = (FlagsRegister.ADD, a, b, a + b, width, None)
+                if i % materializeEvery == 0:
+                    flags.zero
+            elapsed = time.perf_counter() - start
+            results['%s-%d' % (mode, width)] = count / elapsed
+
+    for name, opsPerSecond in results.items():
+        print("flags %-9s %12.0f ops/s" % (name, opsPerSecond))
+    for width in (8, 16):
+        print("flags speedup %d-bit: %.2fx" % (width, results['lazy-%d' % width] / results['eager-%d' % width]))
+    return results
+
+# Builds an assembly source of `lines` lines mixing every statement form the parser accepts
+def syntheticSource(lines):
+    templates = (
+        'mov ax, %dh',
+        'add bl, %db',
+        'mov [%dh], 1010b',
+        'sub cx, [%dh]',
+        'inc dx',
+        'mov bx, %d',
+        'add ah, cl',
+        'mov [%dh], dl',
+    )
+    statements = []
+    for i in range(lines):
+        template = templates[i % len(templates)]
+        if '%d' in template:
+            statements.append(template % ((i * 7) % 100))
+        else:
+            statements.append(template)
+    return '\n'.join(statements)
+
+# Builds a straight-line program of `lines` mov/add/sub/inc/dec statements that assembles
+def arithmeticSource(lines):
+    templates = (
+        'add ax, bx',
+        'mov [%dh], al',
+        'sub cx, ax',
+        'add dx, %dh',
+        'inc bx',
+        'mov ax, [%dh]',
+        'add ah, cl',
+        'dec cx',
+    )
+    statements = []
+    for i in range(lines):
+        template = templates[i % len(templates)]
+        if '%d' in template:
+            statements.append(template % ((i * 7) % 100))
+        else:
+            statements.append(template)
+    return '\n'.join(statements)
+
+# Execution workloads, each is re-run from its first instruction for every pass.
+# Format: 'workload name' : function building the source of a pass
+def _addLoopSource(lines=256):
+    templates = ('add ax, bx', 'add cx, 1', 'add dx, ax', 'add bx, cx')
+    return '\n'.join(['mov bx, 3', 'mov cx, 5'] + [templates[i % len(templates)] for i in range(lines)])
+
+def _movCopySource(lines=256):
+    statements = []
+    for i in range(lines // 2):
+        # the lexer only takes decimal digits before the h suffix
+        statements.append('mov ax, [%dh]' % (i * 2))
+        statements.append('mov [%dh], ax' % (2000 + i * 2))
+    return '\n'.join(statements)
+
+def _mixedRegisterSource(lines=256):
+    templates = ('add al, bl', 'mov ch, dl', 'add ax, cx', 'sub bh, 3h', 'inc dl', 'mov bx, ax', 'add ah, cl', 'dec cx')
+    return '\n'.join(templates[i % len(templates)] for i in range(lines))
+
+# A loop calling a short subroutine twice per iteration, branches and stack accesses dominate
+def _callLoopSource(iterations=32):
+    return '\n'.join(['mov cx, %d' % iterations,
+        'top:', 'call bump', 'call bump', 'loop top', 'jmp done',
+        'bump:', 'add ax, 1', 'add bx, ax', 'ret',
+        'done:'])
+
+# Walks two word arrays with indexed addressing: reads [bx+si] and [si+disp], stores through a
+# BP based address (relative to SS) and updates an element in place
+def _arrayWalkSource(elements=64):
+    return '\n'.join(['mov cx, %d' % elements, 'mov si, 0', 'mov bx, 512', 'mov bp, 1024',
+        'walk:', 'mov ax, [bx+si]', 'add ax, [si+2]', 'mov [bp+si+4], ax',
+        'add word ptr [bx+si+256], 1', 'add si, 2', 'loop walk'])
+
+WORKLOADS = {
+    'add-loop': _addLoopSource,
+    'mov-copy': _movCopySource,
+    'mixed-8-16': _mixedRegisterSource,
+    'call-loop': _callLoopSource,
+    'array-walk': _arrayWalkSource,
+}
+
+# Workloads that only use the mov/add subset of the opcode script path (CPU8086.runProgram)
+SCRIPT_WORKLOADS = {'add-loop', 'mov-copy'}
+
+# Runs `passes` passes of an image and returns the executed instructions per second.
+# A timed run counts clocks, the others fast-forward
+def _runPasses(image, passes, jit, timed=False):
+    cpu = CPU8086()
+    cpu.loadProgram(image)
+    if jit:
+        cpu.enableJit()
+    if timed:
+        cpu.enableTiming()
+    start = time.perf_counter()
+    for i in range(passes):
+        cpu.regFile.ip = 0
+        cpu.run()
+    return cpu.steps / (time.perf_counter() - start)
+
+# Runs `passes` passes of the opcode script of a source and returns the executed lines per second
+def _runScriptPasses(script, passes):
+    cpu = CPU8086()
+    start = time.perf_counter()
+    for i in range(passes):
+        cpu.runProgram(script)
+    return len(script) * passes / (time.perf_counter() - start)
+
+# Returns the peak of the Python allocations made by func, in KiB
+def _peakKiB(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+# Times every execution workload in the interpreter, with the block compiler and on the
+# opcode script path, reports MIPS and the peak allocations of a single pass
+def benchExecute(passes=400):
+    results = {}
+    for name, buildSource in WORKLOADS.items():
+        emitter = assemble(buildSource())
+        image = emitter.getMachineCode()
+        metrics = {
+            'mips': _runPasses(image, passes, False) / 1e6,
+            'mipsJit': _runPasses(image, passes, True) / 1e6,
+            'mipsTimed': _runPasses(image, passes, False, True) / 1e6,
+            'peakKiB': _peakKiB(lambda: _runPasses(image, 1, False)),
+        }
+        if name in SCRIPT_WORKLOADS:
+            script = emitter.getProgramScript().split('\n')
+            metrics['mipsScript'] = _runScriptPasses(script, max(1, passes // 10)) / 1e6
+        results[name] = metrics
+        print("execute %-10s %s" % (name, ', '.join("%s %.3f" % item for item in metrics.items())))
+    return results
+
+# Times rep movsb/stosw/scasb over a 60000 byte buffer, run in bulk and one iteration per execution
+# (as the interpreter would dispatch them without the block operations). Reports bytes per second
+def benchStrings(size=60000):
+    source = '\n'.join(['mov ax, 3000h', 'mov es, ax', 'cld',
+        'mov cx, %d' % size, 'mov si, 0', 'mov di, 0', 'rep movsb',
+        'mov cx, %d' % (size // 2), 'mov di, 0', 'rep stosw',
+        'mov cx, %d' % size, 'mov di, 0', 'mov al, 1', 'repne scasb'])
+    image = assemble(source).getMachineCode()
+    results = {}
+    for name, repeatLimit in (('bulk', None), ('iterated', 1)):
+        cpu = CPU8086()
+        cpu.loadProgram(image)
+        cpu.repeatLimit = repeatLimit
+        start = time.perf_counter()
+        cpu.run()
+        results[name] = 3 * size / (time.perf_counter() - start)
+    for name, bytesPerSecond in results.items():
+        print("strings %-8s %14.0f bytes/s" % (name, bytesPerSecond))
+    print("strings speedup: %.0fx" % (results['bulk'] / results['iterated']))
+    return results
+
+# Times assembling a large source from text to machine code
+def benchAssemble(lines=50000):
+    source = arithmeticSource(lines)
+    start = time.perf_counter()
+    assemble(source).getMachineCode()
+    elapsed = time.perf_counter() - start
+    peak = _peakKiB(lambda: assemble(arithmeticSource(lines // 10)).getMachineCode())
+    print("assemble: %d lines in %.3fs (%.0f lines/s), peak %.0f KiB per %d lines" %
+        (lines, elapsed, lines / elapsed, peak, lines // 10))
+
+    # the streaming pipeline, its peak does not grow with the source
+    sourceLines = source.split('\n')
+    start = time.perf_counter()
+    for statement in assembleStream(sourceLines):
+        pass
+    streamElapsed = time.perf_counter() - start
+    streamPeak = _peakKiB(lambda: sum(1 for statement in assembleStream(sourceLines[:lines // 10])))
+    print("assembleStream: %d lines in %.3fs (%.0f lines/s), peak %.0f KiB per %d lines" %
+        (lines, streamElapsed, lines / streamElapsed, streamPeak, lines // 10))
+    return {'lines/s': lines / elapsed, 'peakKiB': peak,
+        'stream': {'lines/s': lines / streamElapsed, 'peakKiB': streamPeak}}
+
+# Times the table driven tokenize against the character by character Lexer
+def benchLexer(lines=100000, legacyLines=10000):
+    source = syntheticSource(lines)
+    start = time.perf_counter()
+    stream = tokenize(source)
+    elapsed = time.perf_counter() - start
+    print("tokenize: %d lines, %d tokens in %.3fs (%.0f lines/s)" % (lines, len(stream), elapsed, lines / elapsed))
+
+    # the legacy lexer is timed on a smaller source, it is much slower
+    lexer = Lexer(syntheticSource(legacyLines))
+    start = time.perf_counter()
+    while lexer.getNextToken().kind is not TokenType.EOF:
+        pass
+    legacyElapsed = time.perf_counter() - start
+    print("Lexer:    %d lines in %.3fs (%.0f lines/s)" % (legacyLines, legacyElapsed, legacyLines / legacyElapsed))
+    print("tokenize speedup: %.1fx" % ((lines / elapsed) / (legacyLines / legacyElapsed)))
+    return {'tokenize': lines / elapsed, 'Lexer': legacyLines / legacyElapsed}
+
+# Times batches of small programs in this process and in worker pools of growing size.
+# Every pool runs a warm up batch first, the timed batch reuses its workers
+def benchBatch(programs=4000, lines=20):
+    jobs = [BatchJob(arithmeticSource(lines)) for i in range(programs)]
+    results = {}
+    batch = BatchRunner().run(jobs)
+    if batch.failures:
+        print("batch: %s" % batch.failures[0].error)
+    results['in-process'] = batch.programsPerSecond
+    processes = 1
+    while processes <= (os.cpu_count() or 1):
+        with BatchPool(processes) as pool:
+            pool.run(jobs[:processes * 10])
+            batch = pool.run(jobs)
+        results['pool-%d' % processes] = batch.programsPerSecond
+        processes *= 2
+
+    for name, programsPerSecond in results.items():
+        print("batch %-10s %10.0f programs/s" % (name, programsPerSecond))
+    return results
+
+# Runs one straight-line program over many initial states, lane by lane in a BatchRunner
+# and in lockstep on a VectorCPU
+def benchVector(lanes=4096, lines=64):
+    if np is None:
+        print("vector: NumPy is not installed")
+        return {}
+    image = assemble(arithmeticSource(lines)).getMachineCode()
+    states = [{'registers': {'ax': i * 3, 'bx': i * 5, 'cx': i * 7, 'dx': i * 11}} for i in range(lanes)]
+
+    batch = BatchRunner().run(jobsForStates(image, states))
+    start = time.perf_counter()
+    cpu = VectorCPU(lanes)
+    cpu.loadProgram(image)
+    cpu.setStates(states)
+    cpu.run()
+    elapsed = time.perf_counter() - start
+
+    results = {'batch': batch.programsPerSecond, 'vector': lanes / elapsed}
+    for name, statesPerSecond in results.items():
+        print("vector %-6s %10.0f states/s" % (name, statesPerSecond))
+    print("vector speedup: %.1fx" % (results['vector'] / results['batch']))
+    return results
+
+# Sends requests to a simulation server started in this process, with worker processes and with the
+# jobs run in the server process, and reports requests per second and the p50/p99 latencies
+def benchServer(requests=1000, concurrency=16):
+    results = {}
+    for name, workers in (('pool', None), ('in-process', 0)):
+        report = asyncio.run(localLoadTest(requests=requests, concurrency=concurrency, workers=workers))
+        print("server %-10s %s" % (name, report))
+        results[name] = report.asDict()
+    return results
+
+BENCHMARKS = {
+    'execute': benchExecute,
+    'strings': benchStrings,
+    'assemble': benchAssemble,
+    'flags': benchFlags,
+    'lexer': benchLexer,
+    'batch': benchBatch,
+    'vector': benchVector,
+    'server': benchServer,
+}
+
+# Yields (path, value) for every numeric metric of nested results, the path joins the keys with '.'
+def _flattenMetrics(results, prefix=''):
+    for key, value in results.items():
+        path = prefix + str(key)
+        if isinstance(value, dict):
+            yield from _flattenMetrics(value, path + '.')
+        elif isinstance(value, (int, float)):
+            yield path, value
+
+# Compares results against a baseline, returns the descriptions of the regressed metrics.
+# Metrics missing from either side are skipped
+def compareResults(results, baseline, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    baselineMetrics = dict(_flattenMetrics(baseline))
+    regressions = []
+    for path, value in _flattenMetrics(results):
+        reference = baselineMetrics.get(path)
+        if not reference:
+            continue
+        if path.rsplit('.', 1)[-1] in LOWER_IS_BETTER:
+            change = (value - reference) / reference
+        else:
+            change = (reference - value) / reference
+        if change > threshold:
+            regressions.append("%s: %.4g -> %.4g (%.1f%% worse)" % (path, reference, value, change * 100))
+    return regressions
+
+def main():
+    argParser = argparse.ArgumentParser(description="Runs the simulator benchmarks")
+    argParser.add_argument('names', nargs='*', metavar='name',
+        help="benchmarks to run (%s), all by default" % ', '.join(BENCHMARKS))
+    argParser.add_argument('--json', metavar='FILE', help="save the results to FILE")
+    argParser.add_argument('--baseline', metavar='FILE', help="compare the results against a saved run")
+    argParser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+        help="relative change counted as a regression")
+    args = argParser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            argParser.error("unknown benchmark: " + name)
+
+    results = {}
+    for name in args.names or list(BENCHMARKS):
+        results[name] = BENCHMARKS[name]()
+    if resource is not None:
+        results['process'] = {'maxRssKiB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+        print("peak resident size: %d KiB" % results['process']['maxRssKiB'])
+
+    if args.json:
+        with open(args.json, 'w') as resultsFile:
+            json.dump(results, resultsFile, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as baselineFile:
+            regressions = compareResults(results, json.load(baselineFile), args.threshold)
+        for regression in regressions:
+            print("regression: " + regression)
+        print("%d regression(s) against %s" % (len(regressions), args.baseline))
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,14 @@
-from registers import FlagsRegister, MP16BitRegister
-from opcode_enums import OperandType, RegType
-from alu import ALU
-from memory import Memory
+from registers import FlagsRegister, RegisterFile, MP16BitRegister, MPSegmentRegister
+from opcode_enums import OperandType, RegType, REG16_CODES, SEGMENT_CODES, parseMemoryOperand
+from memory import Memory, MemoryException
+from decoder import Decoder, Operand
+from semantics import bindInstruction, effectiveAddress
+from loader import Loader, DEFAULT_LOAD_SEGMENT
+from jit import BlockCompiler, DEFAULT_THRESHOLD
+from timing import instructionCycles, takenCycles, repeatCycles
+from scheduler import Scheduler, NEVER
 import math
+import time
 from enum import Enum
 
 class PrintMode(Enum):
@@ -10,86 +16,647 @@ class PrintMode(Enum):
     BINARY = 1
     HEX = 2
 
+# The number of memory cells shown by printState
+MEMORY_DUMP_SIZE = 10
+
+# Opcode of the hlt instruction, placed after every loaded program
+HLT_OPCODE = 0xF4
+
+# Clocks the 8086 takes to acknowledge a hardware interrupt and enter its handler
+INTERRUPT_ACKNOWLEDGE_CYCLES = 61
+
+#####################################################################
+# DecodedInstruction - a line of the opcode script resolved once into
+# a compact record: the operation is bound, the destination and source
+# are resolved and immediates are already integers
+#####################################################################
+class DecodedInstruction:
+    __slots__ = ('text', 'operation', 'dest', 'location', 'readSource', 'sourceArg')
+
+    def __init__(self, text, operation, dest, location, readSource, sourceArg):
+        self.text = text
+        self.operation = operation
+        self.dest = dest
+        self.location = location
+        self.readSource = readSource
+        self.sourceArg = sourceArg
+
+#####################################################################
+# CPUSnapshot - the state of a CPU8086 at one point of its run: the
+# registers, the flags, IP, the cycle counter and a copy-on-write
+# snapshot of the memory. A snapshot can be restored any number of
+# times. Scheduled events are not part of a snapshot
+#####################################################################
+class CPUSnapshot:
+    __slots__ = ('words', 'segments', 'ip', 'flags', 'halted', 'steps', 'cycles', 'memory')
+
+    def __init__(self, words, segments, ip, flags, halted, steps, cycles, memory):
+        self.words = words
+        self.segments = segments
+        self.ip = ip
+        self.flags = flags
+        self.halted = halted
+        self.steps = steps
+        self.cycles = cycles
+        self.memory = memory
+
+# Source reader used for immediates, the value was already parsed at decode time
+def _immediate(value):
+    return value
+
 class CPU8086:
-    def __init__(self):
+    def __init__(self, memory=None):
         # Operations and their methods
-        # Format: 'command name' : (handling function, parameters to function)
+        # Format: 'command name' : (decoding function, parameters to function)
         self.ops = { \
-            'mov': (self.arithTwoOperandOperation, self.mov), \
-            'add': (self.arithTwoOperandOperation, self.add), \
+            'mov': (self.decodeTwoOperandOperation, self.mov), \
+            'add': (self.decodeTwoOperandOperation, self.add), \
             }
 
         # set up the flags
         self.flags = FlagsRegister()
-        self.mpRegs = {"a": MP16BitRegister(), \
-            "b": MP16BitRegister(), \
-            "c": MP16BitRegister(), \
-            "d": MP16BitRegister()}
+        # set up the registers, all of them live in one compact register file
+        self.regFile = RegisterFile()
+        self.mpRegs = {"a": MP16BitRegister(self.regFile, RegisterFile.AX), \
+            "b": MP16BitRegister(self.regFile, RegisterFile.BX), \
+            "c": MP16BitRegister(self.regFile, RegisterFile.CX), \
+            "d": MP16BitRegister(self.regFile, RegisterFile.DX)}
+        # the registers without 8-bit halves, by their full name
+        self.namedRegs = {name: MP16BitRegister(self.regFile, index) \
+            for index, name in enumerate(RegisterFile.WORD_NAMES[RegisterFile.SP:], RegisterFile.SP)}
+        self.namedRegs.update((name, MPSegmentRegister(self.regFile, index)) \
+            for index, name in enumerate(RegisterFile.SEGMENT_NAMES))
         
-        # set up the memory
-        self.memory = Memory(10)
+        # set up the memory, a fresh zeroed one unless a memory (like a mapped RAM image) is given
+        self.memory = Memory() if memory is None else memory
+
+        # decoded instructions by instruction address (the line number in the script)
+        self._decodeCache = {}
+
+        # machine code execution - decoded instructions by physical address
+        self.decoder = Decoder(self.memory)
+        self._instructionCache = {}
+        self._codePagesWatched = False
+        # the length of the longest instruction decoded so far, prefixes make them arbitrarily long
+        self._longestInstruction = 1
+        self.halted = False
+        self.steps = 0
+
+        # an optional trace.Tracer, tracing is off by default
+        self.tracer = None
+
+        # an optional profiler.Profiler, profiling is off by default
+        self.profiler = None
+
+        # an optional debugger.Debugger, it attaches itself
+        self.debugger = None
+
+        # the optional block compiling tier, see enableJit
+        self.jit = None
+
+        # clocks executed in timed mode, see enableTiming. Timed events are due at a value of this counter
+        self.cycles = 0
+        self.timing = False
+        self.scheduler = Scheduler()
+        # vectors of the hardware interrupts waiting for the interrupt flag
+        self._interruptRequests = []
+
+        # the most iterations a repeated string instruction runs in one execution, None runs all of them.
+        # iterations is the number the last one ran
+        self.repeatLimit = None
+        self.iterations = 0
+
+    ############################################################################
+    # Machine code execution
+    ############################################################################
+
+    # Loads a machine code image at segment:0000, points CS:IP at it and places a hlt right after it
+    def loadProgram(self, image, segment=DEFAULT_LOAD_SEGMENT):
+        address = Loader(self.memory).loadImage(bytes(image) + bytes((HLT_OPCODE,)), segment)
+        self.regFile.segments[RegisterFile.CS] = segment
+        self.regFile.ip = 0
+        self.halted = False
+        self.invalidateInstructions()
+        return address
+
+    # Returns the CPU to its power on state: cleared registers, flags and memory, no cached instructions,
+    # no scheduled events. The tracer and the block compiling tier stay attached
+    def reset(self):
+        self.invalidateInstructions()
+        self._decodeCache.clear()
+        self.memory.clear()
+        self.regFile.clear()
+        self.flags.setWord(0)
+        self.halted = False
+        self.steps = 0
+        self.cycles = 0
+        self.scheduler.clear()
+        self._interruptRequests.clear()
+
+    # Loads machine code chunks (whole instructions) one after the other at segment:0000 and runs every
+    # instruction as soon as its bytes are loaded, so a program can run while it is still being assembled.
+    # A hlt is placed after the last chunk. Returns the number of executed instructions
+    def runStream(self, chunks, segment=DEFAULT_LOAD_SEGMENT):
+        self.regFile.segments[RegisterFile.CS] = segment
+        self.regFile.ip = 0
+        self.halted = False
+        self.invalidateInstructions()
+
+        start = segment << 4
+        end = start
+        steps = 0
+        for chunk in chunks:
+            if end + len(chunk) - start >= 0x10000 or end + len(chunk) >= len(self.memory):
+                raise MemoryException("Program does not fit in its code segment")
+            self.memory[end:end + len(chunk)] = chunk
+            end += len(chunk)
+            # run the instructions that were loaded completely
+            while not self.halted and start + self.regFile.ip < end:
+                steps += self.run(1)
+            if self.halted:
+                return steps
+        self.memory.writeByte(end, HLT_OPCODE)
+        return steps + self.run()
+
+    # Saves the registers, flags, IP and memory. Only the memory pages written since the previous
+    # snapshot or restore are copied
+    def snapshot(self):
+        regFile = self.regFile
+        return CPUSnapshot(tuple(regFile.words), tuple(regFile.segments), regFile.ip, self.flags.getWord(),
+            self.halted, self.steps, self.cycles, self.memory.snapshot())
+
+    # Returns to a snapshot. Decoded instructions and compiled blocks on restored pages are dropped
+    # through the code page watchers, the others stay valid
+    def restore(self, snapshot):
+        regFile = self.regFile
+        regFile.words[:] = snapshot.words
+        regFile.segments[:] = snapshot.segments
+        regFile.ip = snapshot.ip
+        self.flags.setWord(snapshot.flags)
+        self.halted = snapshot.halted
+        self.steps = snapshot.steps
+        self.cycles = snapshot.cycles
+        self.memory.restore(snapshot.memory)
+
+    # Drops every decoded instruction and compiled block
+    def invalidateInstructions(self):
+        self._instructionCache.clear()
+        if self._codePagesWatched:
+            self.memory.unwatchPages(self._onCodeWrite)
+            self._codePagesWatched = False
+        if self.jit is not None:
+            self.jit.reset()
+
+    # Turns on the block compiling tier, blocks are compiled once an address was reached threshold times
+    def enableJit(self, threshold=DEFAULT_THRESHOLD):
+        if self.jit is None:
+            self.jit = BlockCompiler(self, threshold)
+        self.jit.threshold = threshold
+        return self.jit
+
+    def disableJit(self):
+        if self.jit is not None:
+            self.jit.reset()
+            self.jit = None
+
+    # Turns on timed mode: every instruction adds its clocks to the cycle counter, scheduled events run when
+    # they come due and hardware interrupts are delivered. Timed runs are always interpreted
+    def enableTiming(self):
+        self.timing = True
+        return self.scheduler
+
+    # Fast-forward mode, the default: no cycle accounting, scheduled events and hardware interrupts wait
+    # until timed mode is back on
+    def disableTiming(self):
+        self.timing = False
+
+    # Requests a hardware interrupt, it is delivered in timed mode once the interrupt flag is set.
+    # A vector that is already waiting is not requested twice
+    def requestInterrupt(self, vector):
+        if vector not in self._interruptRequests:
+            self._interruptRequests.append(vector)
+
+    # Pushes a word on the stack at SS:SP
+    def push(self, value):
+        words = self.regFile.words
+        sp = (words[RegisterFile.SP] - 2) & 0xFFFF
+        words[RegisterFile.SP] = sp
+        self.memory.writeWord(((self.regFile.segments[RegisterFile.SS] << 4) + sp) & 0xFFFFF, value)
+
+    # Pops a word from the stack at SS:SP
+    def pop(self):
+        words = self.regFile.words
+        sp = words[RegisterFile.SP]
+        words[RegisterFile.SP] = (sp + 2) & 0xFFFF
+        return self.memory.readWord(((self.regFile.segments[RegisterFile.SS] << 4) + sp) & 0xFFFFF)
+
+    # Enters the handler of an interrupt vector: pushes FLAGS, CS and IP, clears the interrupt and trap
+    # flags and loads CS:IP from the interrupt vector table
+    def interrupt(self, vector):
+        regFile = self.regFile
+        self.push(self.flags.getWord())
+        self.push(regFile.segments[RegisterFile.CS])
+        self.push(regFile.ip)
+        self.flags.interrupt = False
+        self.flags.trap = False
+        regFile.segments[RegisterFile.CS], regFile.ip = self.memory.getInterruptVector(vector)
+
+    # iret - pops IP, CS and FLAGS
+    def returnFromInterrupt(self):
+        regFile = self.regFile
+        regFile.ip = self.pop()
+        regFile.segments[RegisterFile.CS] = self.pop()
+        self.flags.setWord(self.pop())
+
+    # Called by the memory when a page holding decoded instructions is written
+    def _onCodeWrite(self, start, stop):
+        cache = self._instructionCache
+        # an instruction written to may start up to the longest decoded length before the write.
+        # A write wider than the cache (a restored page) looks at the cached addresses instead
+        first = start - self._longestInstruction + 1
+        addresses = range(first, stop)
+        if len(addresses) > len(cache):
+            addresses = [address for address in cache if first <= address < stop]
+        for address in addresses:
+            instruction = cache.get(address)
+            if instruction is not None and address + instruction.length > start:
+                del cache[address]
+
+    # Decodes the instruction at the physical address and caches it
+    def _decodeAt(self, address):
+        instruction = bindInstruction(self, self.decoder.decode(address))
+        instruction.cycles = instructionCycles(instruction)
+        instruction.takenCycles = takenCycles(instruction)
+        instruction.repeatCycles = repeatCycles(instruction)
+        self._instructionCache[address] = instruction
+        if instruction.length > self._longestInstruction:
+            self._longestInstruction = instruction.length
+        self.memory.watchPages(address, address + instruction.length, self._onCodeWrite)
+        self._codePagesWatched = True
+        return instruction
+
+    # Returns the decoded instruction at the physical address
+    def instructionAt(self, address):
+        instruction = self._instructionCache.get(address)
+        if instruction is None:
+            instruction = self._decodeAt(address)
+        return instruction
+
+    # Fetches, decodes and executes a single instruction at CS:IP
+    def step(self):
+        return self.run(1)
+
+    # Runs until a hlt instruction or until maxSteps instructions were executed
+    # Returns the number of executed instructions
+    def run(self, maxSteps=None):
+        if self.debugger is not None and self.debugger.active:
+            return self._runDebugged(maxSteps)
+        if self.profiler is not None:
+            return self._runProfiled(maxSteps)
+        if self.tracer is not None:
+            return self._runTraced(maxSteps)
+        if self.timing:
+            return self._runTimed(maxSteps)
+        if self.jit is not None:
+            return self._runJit(maxSteps)
+
+        regFile = self.regFile
+        segments = regFile.segments
+        cache = self._instructionCache
+        decodeAt = self._decodeAt
+        limit = -1 if maxSteps is None else maxSteps
+
+        steps = 0
+        self.halted = False
+        try:
+            while steps != limit and not self.halted:
+                ip = regFile.ip
+                address = ((segments[RegisterFile.CS] << 4) + ip) & 0xFFFFF
+                instruction = cache.get(address)
+                if instruction is None:
+                    instruction = decodeAt(address)
+
+                # IP points at the next instruction while the current one executes
+                regFile.ip = (ip + instruction.length) & 0xFFFF
+                instruction.execute()
+                steps += 1
+        finally:
+            self.steps += steps
+        return steps
+
+    # The run loop with the block compiling tier. Compiled blocks run as a whole when they fit in
+    # the remaining step budget, every other instruction is interpreted and counted towards promotion
+    def _runJit(self, maxSteps):
+        jit = self.jit
+        blocks = jit.blocks
+        visit = jit.visit
+        regFile = self.regFile
+        segments = regFile.segments
+        cache = self._instructionCache
+        decodeAt = self._decodeAt
+        limit = -1 if maxSteps is None else maxSteps
+
+        steps = 0
+        self.halted = False
+        try:
+            while steps != limit and not self.halted:
+                ip = regFile.ip
+                address = ((segments[RegisterFile.CS] << 4) + ip) & 0xFFFFF
+                block = blocks.get(address)
+                if block is None:
+                    block = visit(address)
+                if block is not None and (limit < 0 or steps + len(block) <= limit):
+                    executed = block.function()
+                    steps += executed
+                    jit.blockExecutions += 1
+                    jit.blockInstructions += executed
+                    continue
+
+                instruction = cache.get(address)
+                if instruction is None:
+                    instruction = decodeAt(address)
+                regFile.ip = (ip + instruction.length) & 0xFFFF
+                instruction.execute()
+                steps += 1
+        finally:
+            self.steps += steps
+        return steps
+
+    # Runs in timed mode until the cycle counter reached the deadline, a hlt without a pending
+    # interrupt or maxSteps instructions. Returns the number of executed instructions
+    def runFor(self, cycles, maxSteps=None):
+        timing = self.timing
+        self.timing = True
+        try:
+            return self._runTimed(maxSteps, self.cycles + cycles)
+        finally:
+            self.timing = timing
+
+    # The run loop of timed mode. Due events run before the next instruction and a requested
+    # interrupt is delivered once the interrupt flag is set. A hlt waits for the next interrupt
+    # when interrupts are enabled and an event is scheduled, the clock jumps to that event.
+    # A repeated string instruction stops at the next event and resumes after it
+    def _runTimed(self, maxSteps, deadline=NEVER):
+        regFile = self.regFile
+        segments = regFile.segments
+        flags = self.flags
+        scheduler = self.scheduler
+        requests = self._interruptRequests
+        cache = self._instructionCache
+        decodeAt = self._decodeAt
+        limit = -1 if maxSteps is None else maxSteps
+
+        steps = 0
+        cycles = self.cycles
+        self.halted = False
+        try:
+            while steps != limit and cycles < deadline:
+                if cycles >= scheduler.nextCycle:
+                    # callbacks see the current cycle
+                    self.cycles = cycles
+                    scheduler.runDue(cycles)
+                if requests and flags.interrupt:
+                    self.interrupt(requests.pop(0))
+                    cycles += INTERRUPT_ACKNOWLEDGE_CYCLES
+                    self.halted = False
+                if self.halted:
+                    if not flags.interrupt or not scheduler:
+                        break
+                    cycles = max(cycles, min(scheduler.nextCycle, deadline))
+                    continue
+
+                ip = regFile.ip
+                address = ((segments[RegisterFile.CS] << 4) + ip) & 0xFFFFF
+                instruction = cache.get(address)
+                if instruction is None:
+                    instruction = decodeAt(address)
+                nextIp = (ip + instruction.length) & 0xFFFF
+                regFile.ip = nextIp
+                if instruction.repeatCycles:
+                    self.repeatLimit = max(1, (min(scheduler.nextCycle, deadline) - cycles) // instruction.repeatCycles)
+                    instruction.execute()
+                    self.repeatLimit = None
+                    cycles += instruction.repeatCycles * self.iterations
+                else:
+                    instruction.execute()
+                cycles += instruction.cycles
+                if instruction.takenCycles and regFile.ip != nextIp:
+                    cycles += instruction.takenCycles
+                steps += 1
+        finally:
+            self.cycles = cycles
+            self.steps += steps
+        return steps
+
+    # The run loop of a debugger with stop points. A breakpoint stops the run before its instruction,
+    # except for the first instruction so a run can resume from a breakpoint. Watchpoints request a
+    # stop from their memory listener and conditions are checked after every instruction. With
+    # watchpoints set, repeated string instructions run one iteration at a time
+    def _runDebugged(self, maxSteps):
+        debugger = self.debugger
+        breakpoints = debugger.breakpoints
+        conditions = debugger.conditions
+        regFile = self.regFile
+        segments = regFile.segments
+        cache = self._instructionCache
+        limit = -1 if maxSteps is None else maxSteps
+        self.repeatLimit = 1 if debugger.watchpoints else None
+
+        steps = 0
+        self.halted = False
+        try:
+            while steps != limit and not self.halted:
+                ip = regFile.ip
+                address = ((segments[RegisterFile.CS] << 4) + ip) & 0xFFFFF
+                if steps and address in breakpoints:
+                    debugger.hitBreakpoint(address)
+                    break
+                instruction = cache.get(address)
+                if instruction is None:
+                    instruction = self._decodeAt(address)
+
+                regFile.ip = (ip + instruction.length) & 0xFFFF
+                instruction.execute()
+                steps += 1
+                if conditions:
+                    debugger.checkConditions()
+                if debugger.stopReason is not None:
+                    break
+        finally:
+            # the shell survives faults, a later run must not keep single stepping string instructions
+            self.repeatLimit = None
+            self.steps += steps
+        return steps
+
+    # The run loop with the tracer notified around every instruction
+    def _runTraced(self, maxSteps):
+        tracer = self.tracer
+        tracer.attach(self)
+        regFile = self.regFile
+        segments = regFile.segments
+        limit = -1 if maxSteps is None else maxSteps
+
+        steps = 0
+        self.halted = False
+        try:
+            while steps != limit and not self.halted:
+                ip = regFile.ip
+                address = ((segments[RegisterFile.CS] << 4) + ip) & 0xFFFFF
+                instruction = self._instructionCache.get(address)
+                if instruction is None:
+                    instruction = self._decodeAt(address)
+
+                tracer.beforeInstruction(address)
+                regFile.ip = (ip + instruction.length) & 0xFFFF
+                instruction.execute()
+                steps += 1
+                tracer.afterInstruction(self)
+        finally:
+            self.steps += steps
+        return steps
+
+    # The run loop timing every instruction for the profiler, the tracer is notified too when set
+    def _runProfiled(self, maxSteps):
+        profiler = self.profiler
+        profiler.attach(self)
+        record = profiler.record
+        tracer = self.tracer
+        if tracer is not None:
+            tracer.attach(self)
+        clock = time.perf_counter
+        regFile = self.regFile
+        segments = regFile.segments
+        limit = -1 if maxSteps is None else maxSteps
+
+        steps = 0
+        self.halted = False
+        try:
+            while steps != limit and not self.halted:
+                ip = regFile.ip
+                address = ((segments[RegisterFile.CS] << 4) + ip) & 0xFFFFF
+                instruction = self._instructionCache.get(address)
+                if instruction is None:
+                    instruction = self._decodeAt(address)
+
+                if tracer is not None:
+                    tracer.beforeInstruction(address)
+                profiler.counting = True
+                start = clock()
+                regFile.ip = (ip + instruction.length) & 0xFFFF
+                instruction.execute()
+                elapsed = clock() - start
+                profiler.counting = False
+                record(address, instruction, elapsed)
+                steps += 1
+                if tracer is not None:
+                    tracer.afterInstruction(self)
+        finally:
+            self.steps += steps
+        return steps
+
+    ############################################################################
+    # Opcode script execution
+    ############################################################################
 
     def runProgram(self, commands):
-        for command in commands:
-            commandParts = command.split(' ')
-            commandFunc, params = self.resolveCommandFunc(commandParts[0])
-            if params is not None:
-                commandFunc(commandParts, params)
+        cache = self._decodeCache
+        for address, command in enumerate(commands):
+            # decode the line only if it was not seen at this address before
+            decoded = cache.get(address)
+            if decoded is None or decoded.text != command:
+                decoded = self.decode(command)
+                cache[address] = decoded
+
+            # blank lines decode to an empty operation
+            if decoded.operation is None:
+                continue
+
+            decoded.operation(decoded.dest, decoded.location, decoded.readSource(decoded.sourceArg))
+
+    # Decodes a single line of the opcode script into a DecodedInstruction
+    def decode(self, command):
+        commandParts = command.split()
+        if not commandParts:
+            return DecodedInstruction(command, None, None, None, None, None)
+
+        decodeFunc, operation = self.resolveCommandFunc(commandParts[0].lower())
+        return decodeFunc(command, commandParts, operation)
 
     def resolveCommandFunc(self, commandName):
         return self.ops[commandName]
 
     def resolveMPRegister(self, regText):
+        regText = regText.lower()
+        if regText in self.namedRegs:
+            return self.namedRegs[regText]
         mp16bitRegister = self.mpRegs[regText[0]]
         return mp16bitRegister[regText[1]]
 
     def resolveDestinationRegister(self, commandParts):
         return self.resolveMPRegister(commandParts[2])
 
+    # Memory destinations resolve to (memory, effective address function)
     def resolveDestination(self, commandParts):
         destType = commandParts[1]
         if int(destType) == RegType.MEMORY.value:
-            return (self.memory, int(commandParts[2], 16)) # destination addresses alaways in hex form 
+            return (self.memory, self.resolveMemoryOperand(commandParts[2]))
         else:
             return (self.resolveDestinationRegister(commandParts), None)
 
-    def resolveOperandValue(self, sourceType, source, destType):
+    # Builds the effective address function of a memory operand of the opcode script, the same one the
+    # machine code path uses. The script path reads and writes single bytes
+    def resolveMemoryOperand(self, text):
+        width, segment, base, index, displacement = parseMemoryOperand(text)
+        if base is None and index is None:
+            operand = Operand.direct(displacement, 8)
+        else:
+            operand = Operand.indexed(REG16_CODES.get(base), REG16_CODES.get(index), displacement, 8, displacement != 0)
+        if segment is not None:
+            operand.segment = SEGMENT_CODES[segment]
+        return effectiveAddress(self, operand)
+
+    # Source reader used for memory operands, the argument is the effective address function
+    def readMemorySource(self, location):
+        return self.memory.readByte(location())
+
+    # Returns a (reader, argument) pair, calling reader(argument) yields the source value
+    def resolveOperandSource(self, sourceType, source, destType):
         sourceType = int(sourceType)
 
+        # Determine the size of the destination register
+        mask = 0xFFFF
+        if int(destType) == RegType.REG8BIT.value or int(destType) == RegType.MEMORY.value:
+            mask = 0xFF
+
         # The source is a register
         if sourceType == OperandType.REGISTER.value:
-            return self.resolveMPRegister(source).get_value_bits()
+            register = self.resolveMPRegister(source)
+            return (type(register).get_value, register)
         
+        # the source is a decimal number
+        elif sourceType == OperandType.DEC_NUMBER.value:
+            return (_immediate, int(source) & mask)
+
         # the source is a hex number
         elif sourceType == OperandType.HEX_NUMBER.value:
-            value = int(source, 16)
+            return (_immediate, int(source, 16) & mask)
 
         # the source is a binary number
         elif sourceType == OperandType.BIN_NUMBER.value:
-            value = int(source, 2)
+            return (_immediate, int(source, 2) & mask)
 
         # the source is placed inside a memory address
         elif sourceType == OperandType.MEMORY_ADDRESS.value:
-            value = int(ALU.binArrToDec(self.memory[int(source, 16)])) # memory address is always in HEX
-
-        # Determine the size of the destination register
-        sizeOfReg = 16
-        if int(destType) == RegType.REG8BIT.value or int(destType) == RegType.MEMORY.value:
-            sizeOfReg = 8
+            return (self.readMemorySource, self.resolveMemoryOperand(source))
 
-        # convert the value to binary array
-        binVal = bin(value)
-        binArr = [0 for i in range(sizeOfReg - len(binVal) + 2)]
-        for i in range(2, len(binVal)):
-            binArr.append(int(binVal[i]))
-        return binArr
+        raise Exception("Unknown source type: " + str(sourceType))
 
     def getRegisterValue(self, register, printMode):
         if printMode == PrintMode.DECIMAL:
-            result = ALU.binArrToDec(register.get_value_bits())
+            result = register.get_value()
         return result
 
-    def printState(self):
+    def printState(self, memStart=0, memEnd=MEMORY_DUMP_SIZE):
         # print the registers
         axVal = self.getRegisterValue(self.mpRegs['a'], PrintMode.DECIMAL)
         bxVal = self.getRegisterValue(self.mpRegs['b'], PrintMode.DECIMAL)
@@ -100,8 +667,8 @@ class CPU8086:
 
         # print the memory
         memString = ''
-        for i in range(len(self.memory)):
-            memString += str(i) + ": " + str(int(ALU.binArrToDec(self.memory[i]))) + ", "
+        for i, value in enumerate(self.memory[memStart:memEnd], memStart):
+            memString += str(i) + ": " + str(value) + ", "
         
         print(memString)
 
@@ -109,38 +676,36 @@ class CPU8086:
     # Arithmetic two operands operations
     ############################################################################
 
-    # A genaral function for performing two operands operations
+    # A genaral function for decoding two operands operations
     # The operation is a pointer to a function that carries out a specific operation
-    def arithTwoOperandOperation(self, commandParts, operation):
+    def decodeTwoOperandOperation(self, command, commandParts, operation):
         # get relevant parts for the operation
-        #print(commandParts)
         destType = commandParts[1]
         dest, location = self.resolveDestination(commandParts)
         typeOfSource = commandParts[3]
+        source = commandParts[4]
+        readSource, sourceArg = self.resolveOperandSource(typeOfSource, source, destType)
 
-        # check if source is a memory address
-        if len(commandParts) > 6:
-            source = commandParts[5] # 4 is type of number. currently only hex when using memory
-        else:
-            source = commandParts[4]
-        binArr = self.resolveOperandValue(typeOfSource, source, destType)
-
-        # perform the operation
-        operation(destType, dest, location, typeOfSource, source, binArr)
-
-        # check for flag changes
-        self.printState()
+        return DecodedInstruction(command, operation, dest, location, readSource, sourceArg)
 
     # mov operation - mov value from register/number into destination register
-    def mov(self, destType, dest, location, typeOfSource, source, binArr):
+    def mov(self, dest, location, value):
         # destination is a memory
-        if int(destType) == RegType.MEMORY.value:
-            dest[location] = binArr
+        if location is not None:
+            dest.writeByte(location(), value)
         else: # destination is a register
-            dest.set_value_bits(binArr)
+            dest.set_value(value)
 
     # add operation - add the tource value into the destination register
-    def add(self, destType, dest, location, typeOfSource, source, binArr):
-        destBits = dest.get_value_bits()
-        resultArr, isCarry = ALU.addTwoBinaryArrays(destBits, binArr)
-        dest.set_value_bits(resultArr)
+    def add(self, dest, location, value):
+        # destination is a memory
+        if location is not None:
+            address = location()
+            a = dest.readByte(address)
+            dest.writeByte(address, a + value)
+            width = 8
+        else: # destination is a register, set_value drops the carry
+            a = dest.get_value()
+            dest.set_value(a + value)
+            width = dest.limit()
+        self.flags.pending = (FlagsRegister.ADD, a, value, a + value, width, None)
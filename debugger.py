@@ -0,0 +1,454 @@
+import ast
+import cmd
+from enum import Enum
+from assembler import IncrementalAssembler
+from loader import DEFAULT_LOAD_SEGMENT
+from registers import RegisterFile
+
+#################################################################
+# DebuggerException - An exception that occured while debugging
+#################################################################
+class DebuggerException(Exception):
+    pass
+
+class StopReason(Enum):
+    STEPPED = 0
+    BREAKPOINT = 1
+    WATCHPOINT = 2
+    CONDITION = 3
+    HALTED = 4
+    LIMIT = 5
+
+# The 8-bit registers a condition can use, by name
+# Format: 'name' : (register file index, shift)
+BYTE_REGISTERS = {
+    'al': (RegisterFile.AX, 0), 'cl': (RegisterFile.CX, 0), 'dl': (RegisterFile.DX, 0), 'bl': (RegisterFile.BX, 0),
+    'ah': (RegisterFile.AX, 8), 'ch': (RegisterFile.CX, 8), 'dh': (RegisterFile.DX, 8), 'bh': (RegisterFile.BX, 8),
+}
+
+# The flags a condition can use, by name
+# Format: 'name' : FlagsRegister attribute
+FLAG_NAMES = {
+    'cf': 'carry', 'pf': 'parity', 'af': 'auxiliary', 'zf': 'zero', 'sf': 'sign', 'of': 'overflow',
+    'tf': 'trap', 'if': 'interrupt', 'df': 'direction',
+}
+
+# The syntax a condition may use: comparisons and arithmetic on registers, flags and numbers
+_CONDITION_NODES = (ast.Expression, ast.Compare, ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.Name, ast.Load,
+    ast.Constant, ast.cmpop, ast.boolop, ast.operator, ast.unaryop)
+
+# Parses an address, either physical (a Python integer literal) or SEGMENT:OFFSET in hex
+def parseAddress(text):
+    try:
+        if ':' in text:
+            segment, offset = text.split(':')
+            return ((int(segment, 16) << 4) + int(offset, 16)) & 0xFFFFF
+        return int(text, 0)
+    except ValueError:
+        raise DebuggerException("Bad address: " + text)
+
+#####################################################################
+# RegisterView - the register file and flags seen as a mapping from
+# register names to values, conditions are evaluated against it
+#####################################################################
+class RegisterView:
+    def __init__(self, cpu):
+        self.regFile = cpu.regFile
+        self.flags = cpu.flags
+
+    def __getitem__(self, name):
+        if name in BYTE_REGISTERS:
+            index, shift = BYTE_REGISTERS[name]
+            return (self.regFile.words[index] >> shift) & 0xFF
+        if name in FLAG_NAMES:
+            return int(getattr(self.flags, FLAG_NAMES[name]))
+        return self.regFile.getByName(name)
+
+#####################################################################
+# Condition - a register condition like "ax == 0x10". It stops a
+# run when it becomes true, not for as long as it holds. It is checked
+# in a sandbox: only register and flag names, numbers, comparisons
+# and arithmetic are accepted
+#####################################################################
+class Condition:
+    def __init__(self, text):
+        self.text = text
+        # if is a Python keyword, the interrupt flag is spelled if_ in the compiled condition
+        source = ' '.join('if_' if word == 'if' else word for word in text.replace('(', ' ( ').replace(')', ' ) ').split())
+        try:
+            tree = ast.parse(source, mode='eval')
+        except SyntaxError:
+            raise DebuggerException("Bad condition: " + text)
+        for node in ast.walk(tree):
+            if not isinstance(node, _CONDITION_NODES):
+                raise DebuggerException("Unsupported syntax in condition: " + text)
+            if isinstance(node, ast.Name) and not self._isKnownName(node.id):
+                raise DebuggerException("Unknown register in condition: " + node.id)
+        self._code = compile(tree, '<condition>', 'eval')
+        self.holds = False
+
+    @staticmethod
+    def _isKnownName(name):
+        name = 'if' if name == 'if_' else name
+        return (name in RegisterFile.WORD_NAMES or name in RegisterFile.SEGMENT_NAMES or name == 'ip'
+            or name in BYTE_REGISTERS or name in FLAG_NAMES)
+
+    def evaluate(self, view):
+        return bool(eval(self._code, {'__builtins__': {}}, _ConditionNames(view)))
+
+    # Returns True when the condition just became true
+    def check(self, view):
+        held = self.holds
+        self.holds = self.evaluate(view)
+        return self.holds and not held
+
+# Maps the names of a compiled condition to register values
+class _ConditionNames:
+    def __init__(self, view):
+        self.view = view
+
+    def __getitem__(self, name):
+        return self.view['if' if name == 'if_' else name]
+
+#####################################################################
+# Watchpoint - stops the run after an instruction wrote into the
+# physical range [start, stop). It listens to the page tracking of
+# the memory, so only writes to its pages reach it and no memory
+# access is checked otherwise
+#####################################################################
+class Watchpoint:
+    def __init__(self, debugger, start, stop):
+        self.debugger = debugger
+        self.start = start
+        self.stop = stop
+        self.hits = 0
+
+    def onWrite(self, start, stop):
+        if start < self.stop and stop > self.start:
+            self.hits += 1
+            self.debugger.requestStop(StopReason.WATCHPOINT, self)
+
+    def __str__(self):
+        return "%05x-%05x" % (self.start, self.stop - 1)
+
+#####################################################################
+# SourceMap - the physical address of the machine code of every
+# source line, for a program loaded at segment:0000
+#####################################################################
+class SourceMap:
+    def __init__(self, source, segment=DEFAULT_LOAD_SEGMENT):
+        assembler = IncrementalAssembler(source)
+        errors = assembler.errors()
+        if errors:
+            raise DebuggerException("Line %d: %s" % (errors[0][0] + 1, errors[0][1]))
+        self.texts = source.split('\n')
+        # 1 based line number -> physical address, and back
+        self.lineAddresses = {}
+        self.addressLines = {}
+        address = segment << 4
+        for number, line in enumerate(assembler.lines, 1):
+            if line.code:
+                self.lineAddresses[number] = address
+                self.addressLines[address] = number
+            address += len(line.code)
+        self.image = assembler.getMachineCode()
+
+    def addressOf(self, lineNumber):
+        address = self.lineAddresses.get(lineNumber)
+        if address is None:
+            raise DebuggerException("Line %d has no code" % lineNumber)
+        return address
+
+    def lineAt(self, address):
+        return self.addressLines.get(address)
+
+#####################################################################
+# Debugger - breakpoints, watchpoints and register conditions for a
+# CPU8086. Breakpoints are a set of physical addresses checked once
+# per instruction by the debugged run loop of the CPU. That loop only
+# runs while the debugger has something to check, otherwise the CPU
+# keeps its usual loops and pays nothing
+#####################################################################
+class Debugger:
+    def __init__(self, cpu, sourceMap=None):
+        self.cpu = cpu
+        self.sourceMap = sourceMap
+        self.breakpoints = set()
+        self.watchpoints = []
+        self.conditions = []
+        self.view = RegisterView(cpu)
+        # why the last run stopped, and the breakpoint address, watchpoint or condition behind it
+        self.stopReason = None
+        self.stoppedBy = None
+        cpu.debugger = self
+
+    # True when the CPU has to run its debugged loop
+    @property
+    def active(self):
+        return bool(self.breakpoints or self.watchpoints or self.conditions)
+
+    def detach(self):
+        for watchpoint in list(self.watchpoints):
+            self.removeWatchpoint(watchpoint)
+        if self.cpu.debugger is self:
+            self.cpu.debugger = None
+
+    ############################################################################
+    # Stop points
+    ############################################################################
+
+    def addBreakpoint(self, address):
+        self.breakpoints.add(address)
+        return address
+
+    def addLineBreakpoint(self, lineNumber):
+        if self.sourceMap is None:
+            raise DebuggerException("No source is loaded")
+        return self.addBreakpoint(self.sourceMap.addressOf(lineNumber))
+
+    def removeBreakpoint(self, address):
+        self.breakpoints.discard(address)
+
+    def addWatchpoint(self, start, stop=None):
+        watchpoint = Watchpoint(self, start, start + 1 if stop is None else stop)
+        self.cpu.memory.watchPages(watchpoint.start, watchpoint.stop, watchpoint.onWrite)
+        self.watchpoints.append(watchpoint)
+        return watchpoint
+
+    def removeWatchpoint(self, watchpoint):
+        self.cpu.memory.unwatchPages(watchpoint.onWrite)
+        self.watchpoints.remove(watchpoint)
+
+    def addCondition(self, text):
+        condition = Condition(text)
+        condition.holds = condition.evaluate(self.view)
+        self.conditions.append(condition)
+        return condition
+
+    def removeCondition(self, condition):
+        self.conditions.remove(condition)
+
+    def clear(self):
+        self.breakpoints.clear()
+        for watchpoint in list(self.watchpoints):
+            self.removeWatchpoint(watchpoint)
+        self.conditions.clear()
+
+    ############################################################################
+    # Called by the debugged run loop
+    ############################################################################
+
+    def requestStop(self, reason, stoppedBy=None):
+        if self.stopReason is None:
+            self.stopReason = reason
+            self.stoppedBy = stoppedBy
+
+    def hitBreakpoint(self, address):
+        self.requestStop(StopReason.BREAKPOINT, address)
+
+    # Returns the first condition that became true, or None. Every condition is evaluated so
+    # each one knows whether it holds
+    def checkConditions(self):
+        view = self.view
+        became = None
+        for condition in self.conditions:
+            if condition.check(view) and became is None:
+                became = condition
+        if became is not None:
+            self.requestStop(StopReason.CONDITION, became)
+        return became
+
+    ############################################################################
+    # Execution
+    ############################################################################
+
+    # Runs count instructions, ignoring breakpoints. Watchpoints and conditions still stop it early
+    def step(self, count=1):
+        breakpoints = self.breakpoints
+        self.breakpoints = set()
+        try:
+            self._run(count)
+        finally:
+            self.breakpoints = breakpoints
+        if self.stopReason is None:
+            self.stopReason = StopReason.HALTED if self.cpu.halted else StopReason.STEPPED
+        return self.stopReason
+
+    # Runs until a stop point, a hlt or maxSteps instructions
+    def cont(self, maxSteps=None):
+        self._run(maxSteps)
+        if self.stopReason is None:
+            self.stopReason = StopReason.HALTED if self.cpu.halted else StopReason.LIMIT
+        return self.stopReason
+
+    # Runs until the instruction at the address is reached or until any other stop point
+    def runUntil(self, address, maxSteps=None):
+        temporary = address not in self.breakpoints
+        self.breakpoints.add(address)
+        try:
+            return self.cont(maxSteps)
+        finally:
+            if temporary:
+                self.breakpoints.discard(address)
+
+    def runUntilLine(self, lineNumber, maxSteps=None):
+        if self.sourceMap is None:
+            raise DebuggerException("No source is loaded")
+        return self.runUntil(self.sourceMap.addressOf(lineNumber), maxSteps)
+
+    # A halted program stays halted, the instruction after the hlt is not run
+    def _run(self, maxSteps):
+        self.stopReason = None
+        self.stoppedBy = None
+        if self.cpu.halted:
+            self.stopReason = StopReason.HALTED
+            return 0
+        return self.cpu.run(maxSteps)
+
+    # The physical address of the next instruction
+    @property
+    def address(self):
+        regFile = self.cpu.regFile
+        return ((regFile.segments[RegisterFile.CS] << 4) + regFile.ip) & 0xFFFFF
+
+    # Describes the next instruction: its address, source line and mnemonic
+    def location(self):
+        address = self.address
+        text = "%04x:%04x (%05x)" % (self.cpu.regFile.segments[RegisterFile.CS], self.cpu.regFile.ip, address)
+        if self.sourceMap is not None:
+            lineNumber = self.sourceMap.lineAt(address)
+            if lineNumber is not None:
+                text += " line %d: %s" % (lineNumber, self.sourceMap.texts[lineNumber - 1].strip())
+        return text
+
+    def describeStop(self):
+        reason = self.stopReason
+        if reason is StopReason.BREAKPOINT:
+            return "breakpoint at %05x" % self.stoppedBy
+        if reason is StopReason.WATCHPOINT:
+            return "watchpoint %s written" % self.stoppedBy
+        if reason is StopReason.CONDITION:
+            return "condition %s became true" % self.stoppedBy.text
+        if reason is StopReason.HALTED:
+            return "halted"
+        if reason is StopReason.LIMIT:
+            return "step limit reached"
+        return "stepped"
+
+def formatRegisters(cpu):
+    regFile = cpu.regFile
+    words = ' '.join("%s=%04x" % (name, value) for name, value in zip(RegisterFile.WORD_NAMES, regFile.words))
+    segments = ' '.join("%s=%04x" % (name, value) for name, value in zip(RegisterFile.SEGMENT_NAMES, regFile.segments))
+    flags = ' '.join(name for name, attribute in FLAG_NAMES.items() if getattr(cpu.flags, attribute))
+    return "%s\n%s ip=%04x flags=[%s]" % (words, segments, regFile.ip, flags)
+
+#####################################################################
+# DebuggerShell - the interactive front end of a Debugger
+#####################################################################
+class DebuggerShell(cmd.Cmd):
+    intro = "8086 debugger, type help for the commands"
+    prompt = "(dbg) "
+
+    def __init__(self, debugger, maxSteps=None):
+        cmd.Cmd.__init__(self)
+        self.debugger = debugger
+        self.maxSteps = maxSteps
+
+    def onecmd(self, line):
+        try:
+            return cmd.Cmd.onecmd(self, line)
+        except DebuggerException as error:
+            print(error)
+        except Exception as error:
+            # a fault of the simulated program stops the command, not the debugger
+            print("%s: %s" % (type(error).__name__, error))
+
+    def emptyline(self):
+        pass
+
+    def _report(self):
+        print("%s - %s" % (self.debugger.describeStop(), self.debugger.location()))
+
+    # Parses "line N" or an address
+    def _target(self, arg):
+        parts = arg.split()
+        if len(parts) == 2 and parts[0] == 'line':
+            return self.debugger.sourceMap.addressOf(int(parts[1])) if self.debugger.sourceMap else None
+        if len(parts) != 1:
+            raise DebuggerException("Expected an address or line N")
+        return parseAddress(parts[0])
+
+    def do_step(self, arg):
+        "step [N] - run N instructions (1 by default)"
+        self.debugger.step(int(arg) if arg else 1)
+        self._report()
+
+    def do_continue(self, arg):
+        "continue - run until a breakpoint, watchpoint, condition or hlt"
+        self.debugger.cont(self.maxSteps)
+        self._report()
+
+    def do_until(self, arg):
+        "until ADDR | until line N - run until the address or source line is reached"
+        target = self._target(arg)
+        if target is None:
+            raise DebuggerException("No source is loaded")
+        self.debugger.runUntil(target, self.maxSteps)
+        self._report()
+
+    def do_break(self, arg):
+        "break ADDR | break line N - stop before the instruction at the address or source line"
+        if not arg:
+            for address in sorted(self.debugger.breakpoints):
+                print("%05x" % address)
+            return
+        target = self._target(arg)
+        if target is None:
+            raise DebuggerException("No source is loaded")
+        print("breakpoint at %05x" % self.debugger.addBreakpoint(target))
+
+    def do_delete(self, arg):
+        "delete ADDR | delete line N - remove a breakpoint, delete all removes every stop point"
+        if arg == 'all':
+            self.debugger.clear()
+            return
+        self.debugger.removeBreakpoint(self._target(arg))
+
+    def do_watch(self, arg):
+        "watch START[-END] - stop after an instruction writes into the physical range"
+        start, separator, end = arg.partition('-')
+        stop = parseAddress(end) + 1 if separator else None
+        print("watchpoint %s" % self.debugger.addWatchpoint(parseAddress(start), stop))
+
+    def do_cond(self, arg):
+        "cond EXPR - stop once an expression over registers and flags holds, like ax == 0x10"
+        self.debugger.addCondition(arg)
+
+    def do_regs(self, arg):
+        "regs - show the registers and flags"
+        print(formatRegisters(self.debugger.cpu))
+
+    def do_mem(self, arg):
+        "mem ADDR [COUNT] - show COUNT bytes of memory (16 by default)"
+        parts = arg.split()
+        if not parts:
+            raise DebuggerException("Expected an address")
+        start = parseAddress(parts[0])
+        count = int(parts[1], 0) if len(parts) > 1 else 16
+        data = bytes(self.debugger.cpu.memory[start:start + count])
+        for offset in range(0, len(data), 16):
+            print("%05x  %s" % (start + offset, ' '.join("%02x" % value for value in data[offset:offset + 16])))
+
+    def do_where(self, arg):
+        "where - show the next instruction"
+        print(self.debugger.location())
+
+    def do_quit(self, arg):
+        "quit - leave the debugger"
+        return True
+
+    do_s = do_step
+    do_c = do_continue
+    do_b = do_break
+    do_q = do_quit
+    do_EOF = do_quit
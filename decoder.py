@@ -0,0 +1,505 @@
+from enum import Enum
+from registers import RegisterFile
+
+#################################################################
+# DecodeException - An exception that occured while decoding
+#################################################################
+class DecodeException(Exception):
+    pass
+
+class OperandKind(Enum):
+    REGISTER = 0
+    IMMEDIATE = 1
+    MEMORY = 2
+    SEGMENT = 3
+    RELATIVE = 4
+
+# The operations of the 0x80-0x83 immediate group, indexed by the reg field of the ModR/M byte.
+# The same order is used by the 0x00-0x3F arithmetic block, indexed by bits 3-5 of the opcode
+GROUP1_MNEMONICS = ('add', 'or', 'adc', 'sbb', 'and', 'sub', 'xor', 'cmp')
+
+# The operations of the 0xF6/0xF7 group, indexed by the reg field of the ModR/M byte (test is not supported yet)
+GROUP3_MNEMONICS = (None, None, 'not', 'neg', 'mul', 'imul', 'div', 'idiv')
+
+# The conditional jumps 0x70-0x7F, indexed by the low 4 bits of the opcode
+JCC_MNEMONICS = ('jo', 'jno', 'jb', 'jae', 'je', 'jne', 'jbe', 'ja',
+    'js', 'jns', 'jp', 'jnp', 'jl', 'jge', 'jle', 'jg')
+
+# The loops and jcxz 0xE0-0xE3, indexed by the low 2 bits of the opcode
+LOOP_MNEMONICS = ('loopne', 'loope', 'loop', 'jcxz')
+
+# The operations of the 0xFF group, indexed by the reg field of the ModR/M byte (far call/jmp are not supported)
+GROUP5_MNEMONICS = ('inc', 'dec', 'call', None, 'jmp', None, 'push', None)
+
+# The string instructions, bit 0 of the opcode is the width
+# Format: opcode : 'mnemonic'
+STRING_OPCODES = {
+    0xA4: 'movsb',
+    0xA5: 'movsw',
+    0xA6: 'cmpsb',
+    0xA7: 'cmpsw',
+    0xAA: 'stosb',
+    0xAB: 'stosw',
+    0xAC: 'lodsb',
+    0xAD: 'lodsw',
+    0xAE: 'scasb',
+    0xAF: 'scasw',
+}
+
+# The repeat prefixes of the string instructions. movs/stos/lods repeat under either of them
+# Format: prefix byte : 'repeat mode'
+REPEAT_PREFIXES = {
+    0xF3: 'repe',
+    0xF2: 'repne',
+}
+
+# The segment override prefixes, the memory operand of the instruction after them is relative to the
+# segment register instead of its default one
+# Format: prefix byte : segment register index
+SEGMENT_PREFIXES = {
+    0x26: RegisterFile.ES,
+    0x2E: RegisterFile.CS,
+    0x36: RegisterFile.SS,
+    0x3E: RegisterFile.DS,
+}
+
+# The registers added by the effective address of every r/m value with mod 00-10. r/m 110 with
+# mod 00 is a direct address instead of [bp]
+# Format: (base register or None, index register or None)
+RM_REGISTERS = (
+    (RegisterFile.BX, RegisterFile.SI),
+    (RegisterFile.BX, RegisterFile.DI),
+    (RegisterFile.BP, RegisterFile.SI),
+    (RegisterFile.BP, RegisterFile.DI),
+    (None, RegisterFile.SI),
+    (None, RegisterFile.DI),
+    (RegisterFile.BP, None),
+    (RegisterFile.BX, None),
+)
+
+# The single byte instructions that set or clear one flag
+# Format: opcode : 'mnemonic'
+FLAG_CONTROL_OPCODES = {
+    0xF5: 'cmc',
+    0xF8: 'clc',
+    0xF9: 'stc',
+    0xFA: 'cli',
+    0xFB: 'sti',
+    0xFC: 'cld',
+    0xFD: 'std',
+}
+
+#####################################################################
+# Operand - a decoded operand of an instruction
+# reg is the register code for registers, value is the immediate,
+# the displacement of a memory operand or the sign extended
+# displacement of a branch from the next instruction, and segment is
+# the index of the segment register a memory operand is relative to.
+# The effective address of a memory operand is its displacement plus
+# its base and index registers (None when absent), mode names its
+# addressing mode like the timing tables do ('disp', 'bx+si+disp')
+#####################################################################
+class Operand:
+    __slots__ = ('kind', 'width', 'reg', 'value', 'segment', 'base', 'index', 'mode')
+
+    def __init__(self, kind, width, reg=0, value=0, segment=RegisterFile.DS, base=None, index=None, mode=None):
+        self.kind = kind
+        self.width = width
+        self.reg = reg
+        self.value = value
+        self.segment = segment
+        self.base = base
+        self.index = index
+        self.mode = mode
+
+    @staticmethod
+    def register(code, width):
+        return Operand(OperandKind.REGISTER, width, reg=code)
+
+    @staticmethod
+    def immediate(value, width):
+        return Operand(OperandKind.IMMEDIATE, width, value=value)
+
+    @staticmethod
+    def direct(displacement, width):
+        return Operand(OperandKind.MEMORY, width, value=displacement, mode='disp')
+
+    # A memory operand addressed through registers, displaced tells whether the encoding has a
+    # displacement (even a zero one). Addresses based on BP are relative to SS
+    @staticmethod
+    def indexed(base, index, displacement, width, displaced):
+        if base is not None and index is not None:
+            mode = RegisterFile.WORD_NAMES[base] + '+' + RegisterFile.WORD_NAMES[index]
+        else:
+            mode = 'base' if base is not None else 'index'
+        if displaced:
+            mode += '+disp'
+        segment = RegisterFile.SS if base == RegisterFile.BP else RegisterFile.DS
+        return Operand(OperandKind.MEMORY, width, value=displacement, segment=segment, base=base, index=index, mode=mode)
+
+    @staticmethod
+    def segmentRegister(code):
+        return Operand(OperandKind.SEGMENT, 16, reg=code)
+
+    @staticmethod
+    def relative(displacement, width):
+        return Operand(OperandKind.RELATIVE, width, value=displacement)
+
+#####################################################################
+# Instruction - a decoded instruction. execute and the clock counts
+# are filled in by the CPU once the instruction is decoded, a branch
+# takes takenCycles more when it is taken and a repeated string
+# instruction repeatCycles more per iteration. repeat is the mode of
+# the repeat prefix of a string instruction and override the segment
+# register of a segment override prefix, None without the prefixes
+#####################################################################
+class Instruction:
+    __slots__ = ('address', 'length', 'opcode', 'mnemonic', 'width', 'dest', 'source', 'execute', 'cycles',
+        'takenCycles', 'repeatCycles', 'repeat', 'override')
+
+    def __init__(self, address, length, opcode, mnemonic, width, dest=None, source=None):
+        self.address = address
+        self.length = length
+        self.opcode = opcode
+        self.mnemonic = mnemonic
+        self.width = width
+        self.dest = dest
+        self.source = source
+        self.execute = None
+        self.cycles = 0
+        self.takenCycles = 0
+        self.repeatCycles = 0
+        self.repeat = None
+        self.override = None
+
+#####################################################################
+# Decoder - a table driven 8086 decoder. The first byte of an
+# instruction indexes a 256 entry table of decoding functions
+#####################################################################
+class Decoder:
+    def __init__(self, memory):
+        self.memory = memory
+        self.table = [None] * 256
+        self._buildTable()
+
+    # Decodes the instruction at the given physical address
+    def decode(self, address):
+        opcode = self.memory.readByte(address)
+        decodeFunc = self.table[opcode]
+        if decodeFunc is None:
+            raise DecodeException("Unknown opcode 0x%02x at address 0x%05x" % (opcode, address))
+        return decodeFunc(address, opcode)
+
+    def _buildTable(self):
+        table = self.table
+
+        # arithmetic and logic operations in all of their r/m, reg and accumulator forms
+        for index, mnemonic in enumerate(GROUP1_MNEMONICS):
+            base = index << 3
+            for opcode in range(base, base + 4):
+                table[opcode] = self._decodeModRMForm(mnemonic)
+            table[base + 4] = self._decodeAccumulatorImmediate(mnemonic)
+            table[base + 5] = self._decodeAccumulatorImmediate(mnemonic)
+
+        # inc/dec reg16
+        for opcode in range(0x40, 0x48):
+            table[opcode] = self._decodeRegister16('inc')
+        for opcode in range(0x48, 0x50):
+            table[opcode] = self._decodeRegister16('dec')
+
+        # immediate group
+        for opcode in range(0x80, 0x84):
+            table[opcode] = self._decodeGroup1
+
+        # mov in all of its forms
+        for opcode in range(0x88, 0x8C):
+            table[opcode] = self._decodeModRMForm('mov')
+        table[0x8C] = self._decodeMovSegment
+        table[0x8E] = self._decodeMovSegment
+        for opcode in range(0xA0, 0xA4):
+            table[opcode] = self._decodeMovOffset
+        for opcode in range(0xB0, 0xC0):
+            table[opcode] = self._decodeMovImmediate
+        table[0xC6] = self._decodeMovRMImmediate
+        table[0xC7] = self._decodeMovRMImmediate
+
+        # not/neg/mul/imul/div/idiv r/m
+        table[0xF6] = self._decodeGroup3
+        table[0xF7] = self._decodeGroup3
+
+        # inc/dec r/m8 and the inc/dec/call/jmp/push r/m16 group
+        table[0xFE] = self._decodeIncDecRM
+        table[0xFF] = self._decodeGroup5
+
+        # push/pop reg16 and segment registers, pop cs does not exist
+        for opcode in range(0x50, 0x58):
+            table[opcode] = self._decodeRegister16('push')
+        for opcode in range(0x58, 0x60):
+            table[opcode] = self._decodeRegister16('pop')
+        for opcode in (0x06, 0x0E, 0x16, 0x1E):
+            table[opcode] = self._decodeStackSegment
+        for opcode in (0x07, 0x17, 0x1F):
+            table[opcode] = self._decodeStackSegment
+        table[0x8F] = self._decodePopRM
+        table[0x9C] = self._decodeNoOperands('pushf')
+        table[0x9D] = self._decodeNoOperands('popf')
+
+        # jumps, calls and returns within the code segment
+        for opcode in range(0x70, 0x80):
+            table[opcode] = self._decodeShortBranch(JCC_MNEMONICS[opcode & 0xF])
+        for opcode in range(0xE0, 0xE4):
+            table[opcode] = self._decodeShortBranch(LOOP_MNEMONICS[opcode & 3])
+        table[0xEB] = self._decodeShortBranch('jmp')
+        table[0xE8] = self._decodeNearBranch('call')
+        table[0xE9] = self._decodeNearBranch('jmp')
+        table[0xC3] = self._decodeNoOperands('ret')
+        table[0xC2] = self._decodeReturnImmediate
+
+        table[0x90] = self._decodeNoOperands('nop')
+        table[0xF4] = self._decodeNoOperands('hlt')
+
+        # interrupts
+        table[0xCC] = self._decodeInterrupt
+        table[0xCD] = self._decodeInterrupt
+        table[0xCF] = self._decodeNoOperands('iret')
+
+        # string instructions and their repeat prefixes
+        for opcode in STRING_OPCODES:
+            table[opcode] = self._decodeString
+        for opcode in REPEAT_PREFIXES:
+            table[opcode] = self._decodePrefixed
+
+        # segment override prefixes
+        for opcode in SEGMENT_PREFIXES:
+            table[opcode] = self._decodePrefixed
+
+        # flag control
+        for opcode, mnemonic in FLAG_CONTROL_OPCODES.items():
+            table[opcode] = self._decodeNoOperands(mnemonic)
+
+    ############################################################################
+    # Operand fetching
+    ############################################################################
+
+    def _fetchImmediate(self, address, width):
+        if width == 16:
+            return self.memory.readWord(address)
+        return self.memory.readByte(address)
+
+    # Decodes the ModR/M byte at the given address
+    # Returns (reg field, r/m operand, number of bytes used by the ModR/M byte and displacement)
+    def _decodeModRM(self, address, width):
+        modrm = self.memory.readByte(address)
+        mod = modrm >> 6
+        reg = (modrm >> 3) & 7
+        rm = modrm & 7
+
+        if mod == 0b11:
+            return reg, Operand.register(rm, width), 1
+        if mod == 0b00 and rm == 0b110:
+            return reg, Operand.direct(self.memory.readWord(address + 1), width), 3
+
+        # mod 00 has no displacement, 01 a sign extended 8-bit one and 10 a 16-bit one
+        base, index = RM_REGISTERS[rm]
+        if mod == 0b00:
+            displacement, size = 0, 1
+        elif mod == 0b01:
+            displacement = self.memory.readByte(address + 1)
+            if displacement & 0x80:
+                displacement |= 0xFF00
+            size = 2
+        else:
+            displacement, size = self.memory.readWord(address + 1), 3
+        return reg, Operand.indexed(base, index, displacement, width, mod != 0b00), size
+
+    ############################################################################
+    # Decoding functions, each one receives the address and the first byte
+    ############################################################################
+
+    # op r/m, reg or op reg, r/m - bit 0 is the width and bit 1 the direction
+    def _decodeModRMForm(self, mnemonic):
+        def decode(address, opcode):
+            width = 16 if opcode & 1 else 8
+            reg, rm, size = self._decodeModRM(address + 1, width)
+            regOperand = Operand.register(reg, width)
+            if opcode & 2:
+                return Instruction(address, 1 + size, opcode, mnemonic, width, regOperand, rm)
+            return Instruction(address, 1 + size, opcode, mnemonic, width, rm, regOperand)
+        return decode
+
+    # op al, imm8 or op ax, imm16
+    def _decodeAccumulatorImmediate(self, mnemonic):
+        def decode(address, opcode):
+            width = 16 if opcode & 1 else 8
+            value = self._fetchImmediate(address + 1, width)
+            return Instruction(address, 1 + width // 8, opcode, mnemonic, width,
+                Operand.register(RegisterFile.AX, width), Operand.immediate(value, width))
+        return decode
+
+    # op reg16 with the register encoded in the low 3 bits
+    def _decodeRegister16(self, mnemonic):
+        def decode(address, opcode):
+            return Instruction(address, 1, opcode, mnemonic, 16, Operand.register(opcode & 7, 16))
+        return decode
+
+    def _decodeNoOperands(self, mnemonic):
+        def decode(address, opcode):
+            return Instruction(address, 1, opcode, mnemonic, 0)
+        return decode
+
+    # jcc/loop/jcxz/jmp with a sign extended 8-bit displacement
+    def _decodeShortBranch(self, mnemonic):
+        def decode(address, opcode):
+            displacement = self.memory.readByte(address + 1)
+            if displacement & 0x80:
+                displacement -= 0x100
+            return Instruction(address, 2, opcode, mnemonic, 8, Operand.relative(displacement, 8))
+        return decode
+
+    # call/jmp with a 16-bit displacement
+    def _decodeNearBranch(self, mnemonic):
+        def decode(address, opcode):
+            displacement = self.memory.readWord(address + 1)
+            if displacement & 0x8000:
+                displacement -= 0x10000
+            return Instruction(address, 3, opcode, mnemonic, 16, Operand.relative(displacement, 16))
+        return decode
+
+    # 0xC2 ret imm16 - returns and releases imm16 bytes of arguments
+    def _decodeReturnImmediate(self, address, opcode):
+        return Instruction(address, 3, opcode, 'ret', 16, Operand.immediate(self.memory.readWord(address + 1), 16))
+
+    # 0x06/0x0E/0x16/0x1E push sreg - 0x07/0x17/0x1F pop sreg, the segment register is in bits 3-4
+    def _decodeStackSegment(self, address, opcode):
+        mnemonic = 'pop' if opcode & 1 else 'push'
+        return Instruction(address, 1, opcode, mnemonic, 16, Operand.segmentRegister((opcode >> 3) & 3))
+
+    # 0xA4-0xAF movs/cmps/stos/lods/scas, the operands are implied by SI, DI and the accumulator
+    def _decodeString(self, address, opcode):
+        return Instruction(address, 1, opcode, STRING_OPCODES[opcode], 16 if opcode & 1 else 8)
+
+    # 0xF2 repne - 0xF3 rep/repe - 0x26 es: - 0x2E cs: - 0x36 ss: - 0x3E ds:, the prefixes are part of
+    # the instruction after them. A repeat prefix repeats a string instruction, an override prefix replaces
+    # the segment of its memory operand, or the DS source of a string instruction. Of two override prefixes
+    # the one closer to the opcode wins. The prefixes are walked in a loop, any number of them may come
+    # in any order
+    def _decodePrefixed(self, address, opcode):
+        repeat = None
+        override = None
+        position = address
+        while opcode in REPEAT_PREFIXES or opcode in SEGMENT_PREFIXES:
+            if opcode in SEGMENT_PREFIXES:
+                override = SEGMENT_PREFIXES[opcode]
+            elif repeat is not None:
+                raise DecodeException("Repeat prefix 0x%02x after another one at address 0x%05x" % (opcode, position))
+            else:
+                repeat = REPEAT_PREFIXES[opcode]
+            position += 1
+            opcode = self.memory.readByte(position)
+
+        decodeFunc = self.table[opcode]
+        if decodeFunc is None:
+            raise DecodeException("Unknown opcode 0x%02x at address 0x%05x" % (opcode, position))
+        instruction = decodeFunc(position, opcode)
+        if repeat is not None and instruction.opcode not in STRING_OPCODES:
+            raise DecodeException("Repeat prefix before a non string instruction at address 0x%05x" % address)
+        instruction.address = address
+        instruction.length += position - address
+        instruction.repeat = repeat
+        if override is not None:
+            instruction.override = override
+            for operand in (instruction.dest, instruction.source):
+                if operand is not None and operand.kind is OperandKind.MEMORY:
+                    operand.segment = override
+        return instruction
+
+    # 0xCC int 3 - 0xCD int imm8
+    def _decodeInterrupt(self, address, opcode):
+        if opcode == 0xCC:
+            return Instruction(address, 1, opcode, 'int', 8, Operand.immediate(3, 8))
+        vector = self.memory.readByte(address + 1)
+        return Instruction(address, 2, opcode, 'int', 8, Operand.immediate(vector, 8))
+
+    # 0x80 op r/m8, imm8 - 0x81 op r/m16, imm16 - 0x83 op r/m16, sign extended imm8
+    def _decodeGroup1(self, address, opcode):
+        width = 16 if opcode & 1 else 8
+        reg, rm, size = self._decodeModRM(address + 1, width)
+        immediateAddress = address + 1 + size
+        if opcode == 0x83:
+            value = self.memory.readByte(immediateAddress)
+            if value & 0x80:
+                value |= 0xFF00
+            immediateSize = 1
+        else:
+            value = self._fetchImmediate(immediateAddress, width)
+            immediateSize = width // 8
+        return Instruction(address, 1 + size + immediateSize, opcode, GROUP1_MNEMONICS[reg], width,
+            rm, Operand.immediate(value, width))
+
+    # 0x8C mov r/m16, sreg - 0x8E mov sreg, r/m16
+    def _decodeMovSegment(self, address, opcode):
+        reg, rm, size = self._decodeModRM(address + 1, 16)
+        segment = Operand.segmentRegister(reg & 3)
+        if opcode == 0x8E:
+            return Instruction(address, 1 + size, opcode, 'mov', 16, segment, rm)
+        return Instruction(address, 1 + size, opcode, 'mov', 16, rm, segment)
+
+    # 0xA0-0xA3 mov between the accumulator and a direct address
+    def _decodeMovOffset(self, address, opcode):
+        width = 16 if opcode & 1 else 8
+        accumulator = Operand.register(RegisterFile.AX, width)
+        memory = Operand.direct(self.memory.readWord(address + 1), width)
+        if opcode & 2:
+            return Instruction(address, 3, opcode, 'mov', width, memory, accumulator)
+        return Instruction(address, 3, opcode, 'mov', width, accumulator, memory)
+
+    # 0xB0-0xBF mov reg, imm
+    def _decodeMovImmediate(self, address, opcode):
+        width = 16 if opcode & 8 else 8
+        value = self._fetchImmediate(address + 1, width)
+        return Instruction(address, 1 + width // 8, opcode, 'mov', width,
+            Operand.register(opcode & 7, width), Operand.immediate(value, width))
+
+    # 0xC6 mov r/m8, imm8 - 0xC7 mov r/m16, imm16
+    def _decodeMovRMImmediate(self, address, opcode):
+        width = 16 if opcode & 1 else 8
+        reg, rm, size = self._decodeModRM(address + 1, width)
+        if reg != 0:
+            raise DecodeException("Unknown opcode extension %d for 0x%02x at address 0x%05x" % (reg, opcode, address))
+        value = self._fetchImmediate(address + 1 + size, width)
+        return Instruction(address, 1 + size + width // 8, opcode, 'mov', width,
+            rm, Operand.immediate(value, width))
+
+    # 0xF6 op r/m8 - 0xF7 op r/m16
+    # not/neg operate on the r/m operand, mul/div use it as the source of an accumulator operation
+    def _decodeGroup3(self, address, opcode):
+        width = 16 if opcode & 1 else 8
+        reg, rm, size = self._decodeModRM(address + 1, width)
+        mnemonic = GROUP3_MNEMONICS[reg]
+        if mnemonic is None:
+            raise DecodeException("Unknown opcode extension %d for 0x%02x at address 0x%05x" % (reg, opcode, address))
+        if reg < 4:
+            return Instruction(address, 1 + size, opcode, mnemonic, width, rm)
+        return Instruction(address, 1 + size, opcode, mnemonic, width, None, rm)
+
+    # 0xFE inc/dec r/m8
+    def _decodeIncDecRM(self, address, opcode):
+        reg, rm, size = self._decodeModRM(address + 1, 8)
+        if reg > 1:
+            raise DecodeException("Unknown opcode extension %d for 0x%02x at address 0x%05x" % (reg, opcode, address))
+        return Instruction(address, 1 + size, opcode, ('inc', 'dec')[reg], 8, rm)
+
+    # 0xFF inc/dec/call/jmp/push r/m16, call and jmp take the new IP from the operand
+    def _decodeGroup5(self, address, opcode):
+        reg, rm, size = self._decodeModRM(address + 1, 16)
+        mnemonic = GROUP5_MNEMONICS[reg]
+        if mnemonic is None:
+            raise DecodeException("Unknown opcode extension %d for 0x%02x at address 0x%05x" % (reg, opcode, address))
+        return Instruction(address, 1 + size, opcode, mnemonic, 16, rm)
+
+    # 0x8F pop r/m16
+    def _decodePopRM(self, address, opcode):
+        reg, rm, size = self._decodeModRM(address + 1, 16)
+        if reg != 0:
+            raise DecodeException("Unknown opcode extension %d for 0x%02x at address 0x%05x" % (reg, opcode, address))
+        return Instruction(address, 1 + size, opcode, 'pop', 16, rm)
@@ -0,0 +1,67 @@
+import argparse
+import random
+import sys
+
+# The failures a check prints before its summary
+REPORTED_FAILURES = 20
+
+# Returns the first index where two byte sequences differ, None when they are equal
+def firstDifference(got, expected):
+    got, expected = bytes(got), bytes(expected)
+    if got == expected:
+        return None
+    return next((index for index, (a, b) in enumerate(zip(got, expected)) if a != b), min(len(got), len(expected)))
+
+#####################################################################
+# DifferentialChecker - the common part of the differential checks.
+# A check subclasses it with the generators and comparisons of its
+# tier: run generates the cases from a seeded random number generator
+# and compares through expect, which keeps every mismatch as a failure
+# message. main parses the options, runs the check, prints the first
+# failures and a summary and exits with 1 when a check failed
+#####################################################################
+class DifferentialChecker:
+    # The description of the check for --help, and its command line options besides --seed
+    # Format: 'option' : ('parameter of run', default, 'help' or None)
+    DESCRIPTION = None
+    OPTIONS = {}
+
+    def __init__(self):
+        self.checks = 0
+        self.failures = []
+
+    # Counts one compared value of a case, a mismatch is kept as a failure
+    def expect(self, name, case, got, expected):
+        self.checks += 1
+        if got != expected:
+            self.failures.append("%s of %s: got %r, expected %r" % (name, case, got, expected))
+
+    # Runs check(*arguments), when any of its comparisons fail the description of the case follows the failures
+    def checkCase(self, description, check, *arguments):
+        failures = len(self.failures)
+        check(*arguments)
+        if len(self.failures) > failures:
+            self.failures.append(description)
+
+    # Generates and checks the cases, the options are the parameters named in OPTIONS
+    def run(self, rng, **options):
+        raise NotImplementedError
+
+    def summary(self):
+        return "%d checks, %d failures" % (self.checks, len(self.failures))
+
+    @classmethod
+    def main(cls):
+        argParser = argparse.ArgumentParser(description=cls.DESCRIPTION)
+        for option, (parameter, default, help) in cls.OPTIONS.items():
+            argParser.add_argument('--' + option, dest=parameter, type=int, default=default, help=help)
+        argParser.add_argument('--seed', type=int, default=8086)
+        options = vars(argParser.parse_args())
+        seed = options.pop('seed')
+
+        checker = cls()
+        checker.run(random.Random(seed), **options)
+        for failure in checker.failures[:REPORTED_FAILURES]:
+            print(failure)
+        print(checker.summary())
+        sys.exit(1 if checker.failures else 0)
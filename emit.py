@@ -1,17 +1,499 @@
+from opcode_enums import RegType, OperandType, REG8_CODES, REG16_CODES, SEGMENT_CODES, ADDRESS_RM_CODES, parseMemoryOperand
 
+#################################################################
+# EmitterException - An exception that occured while emitting
+#################################################################
+class EmitterException(Exception):
+    pass
+
+# Bumped whenever the encoding of any instruction changes, invalidates cached assembled programs
+ASSEMBLER_VERSION = 3
+
+# ModR/M byte for a direct 16-bit address (mod = 00, r/m = 110)
+DIRECT_ADDRESS_RM = 0b110
+
+# The segment override prefix of segment register code n is 0x26 | n << 3
+SEGMENT_PREFIX_BASE = 0x26
+
+# Two operand arithmetic encodings
+# Format: 'command name' : (r/m <- reg base opcode, reg <- r/m base opcode, immediate group extension)
+# The base opcodes are the byte forms, the word form is always base + 1
+ARITH_OPCODES = {
+    'add': (0x00, 0x02, 0),
+    'or': (0x08, 0x0A, 1),
+    'adc': (0x10, 0x12, 2),
+    'sbb': (0x18, 0x1A, 3),
+    'and': (0x20, 0x22, 4),
+    'sub': (0x28, 0x2A, 5),
+    'xor': (0x30, 0x32, 6),
+    'cmp': (0x38, 0x3A, 7),
+}
+
+# mov r/m16, sreg and mov sreg, r/m16
+MOV_FROM_SEGMENT = 0x8C
+MOV_TO_SEGMENT = 0x8E
+
+# Single operand encodings
+# Format: 'command name' : (16-bit register base opcode, extension of the FE group)
+INC_DEC_OPCODES = {
+    'inc': (0x40, 0),
+    'dec': (0x48, 1),
+}
+
+# Accumulator multiply/divide encodings, the extension of the F6/F7 group
+MUL_DIV_EXTENSIONS = {
+    'mul': 4,
+    'div': 6,
+}
+
+# Stack encodings
+# Format: 'command name' : (16-bit register base opcode, segment register base opcode)
+STACK_OPCODES = {
+    'push': (0x50, 0x06),
+    'pop': (0x58, 0x07),
+}
+
+# String command encodings, the word form is always the byte form + 1
+# Format: 'command name' : opcode
+STRING_OPCODES = {
+    'movsb': 0xA4,
+    'movsw': 0xA5,
+    'cmpsb': 0xA6,
+    'cmpsw': 0xA7,
+    'stosb': 0xAA,
+    'stosw': 0xAB,
+    'lodsb': 0xAC,
+    'lodsw': 0xAD,
+    'scasb': 0xAE,
+    'scasw': 0xAF,
+}
+
+# Repeat prefixes of the string commands, rep and repe are the same byte
+# Format: 'prefix name' : prefix byte
+REPEAT_PREFIXES = {
+    'rep': 0xF3,
+    'repe': 0xF3,
+    'repz': 0xF3,
+    'repne': 0xF2,
+    'repnz': 0xF2,
+}
+
+# Encodings of the commands without operands
+# Format: 'command name' : opcode
+NO_OPERAND_OPCODES = {
+    'ret': 0xC3,
+    'iret': 0xCF,
+    'hlt': 0xF4,
+    'nop': 0x90,
+    'clc': 0xF8,
+    'stc': 0xF9,
+    'cmc': 0xF5,
+    'cli': 0xFA,
+    'sti': 0xFB,
+    'cld': 0xFC,
+    'std': 0xFD,
+}
+
+# The condition encoded in the low 4 bits of the conditional jumps 0x70-0x7F, aliases share a code
+CONDITION_CODES = {
+    'jo': 0x0, 'jno': 0x1, 'jb': 0x2, 'jnae': 0x2, 'jc': 0x2, 'jae': 0x3, 'jnb': 0x3, 'jnc': 0x3,
+    'je': 0x4, 'jz': 0x4, 'jne': 0x5, 'jnz': 0x5, 'jbe': 0x6, 'jna': 0x6, 'ja': 0x7, 'jnbe': 0x7,
+    'js': 0x8, 'jns': 0x9, 'jp': 0xA, 'jpe': 0xA, 'jnp': 0xB, 'jpo': 0xB,
+    'jl': 0xC, 'jnge': 0xC, 'jge': 0xD, 'jnl': 0xD, 'jle': 0xE, 'jng': 0xE, 'jg': 0xF, 'jnle': 0xF,
+}
+
+# Branch encodings, the displacement to the label follows the opcode. jmp and call always take
+# the 16-bit form, so the size of every instruction is known before its label is
+# Format: 'command name' : (opcode, size of the displacement in bytes)
+BRANCH_OPCODES = {
+    'jmp': (0xE9, 2),
+    'call': (0xE8, 2),
+    'loopne': (0xE0, 1),
+    'loopnz': (0xE0, 1),
+    'loope': (0xE1, 1),
+    'loopz': (0xE1, 1),
+    'loop': (0xE2, 1),
+    'jcxz': (0xE3, 1),
+}
+BRANCH_OPCODES.update((name, (0x70 + condition, 1)) for name, condition in CONDITION_CODES.items())
+
+def _modrm(mod, reg, rm):
+    return (mod << 6) | (reg << 3) | rm
+
+def _imm(value, isWord):
+    if isWord:
+        return bytes((value & 0xFF, (value >> 8) & 0xFF))
+    return bytes((value & 0xFF,))
+
+def _parseNumber(numberType, text):
+    numberType = int(numberType)
+    if numberType == OperandType.DEC_NUMBER.value:
+        return int(text)
+    elif numberType == OperandType.HEX_NUMBER.value:
+        return int(text, 16)
+    elif numberType == OperandType.BIN_NUMBER.value:
+        return int(text, 2)
+    raise EmitterException("Expected a number type, got: " + str(numberType))
+
+# Returns (register code, is 16-bit) for a register name
+def _register(text):
+    text = text.lower()
+    if text in REG16_CODES:
+        return REG16_CODES[text], True
+    if text in REG8_CODES:
+        return REG8_CODES[text], False
+    raise EmitterException("Unknown register: " + text)
+
+#####################################################################
+# MemoryOperand - a memory operand of the opcode script encoded for a
+# reg field: the segment override prefix (empty when the segment is
+# the default one), the ModR/M byte with its displacement, and the
+# width named by byte/word ptr or None
+#####################################################################
+class MemoryOperand:
+    def __init__(self, prefix, modrm, width):
+        self.prefix = prefix
+        self.modrm = modrm
+        self.width = width
+
+    # Returns the width of the access, checked against the width of a register operand or the
+    # default width for an immediate operand
+    def accessWidth(self, registerWidth=None, defaultWidth=8):
+        if registerWidth is None:
+            return self.width or defaultWidth
+        if self.width is not None and self.width != registerWidth:
+            raise EmitterException("Operand size mismatch: a %d-bit memory operand with a %d-bit register" % (self.width, registerWidth))
+        return registerWidth
+
+    # The machine code of an instruction whose opcode is followed by this operand and then the immediate bytes
+    def encode(self, opcode, immediate=b''):
+        return self.prefix + bytes((opcode,)) + self.modrm + immediate
+
+# Encodes a memory operand of the opcode script with the given reg field, the shortest
+# displacement is picked: none, a sign extended byte or a word. [bp] needs a zero displacement
+def _memory(reg, text):
+    width, segment, base, index, displacement = parseMemoryOperand(text)
+    if base is None and index is None:
+        modrm = bytes((_modrm(0b00, reg, DIRECT_ADDRESS_RM),)) + _imm(displacement, True)
+        default = 'ds'
+    else:
+        rm = ADDRESS_RM_CODES[(base, index)]
+        if displacement == 0 and rm != DIRECT_ADDRESS_RM:
+            modrm = bytes((_modrm(0b00, reg, rm),))
+        elif displacement < 0x80 or displacement >= 0xFF80:
+            modrm = bytes((_modrm(0b01, reg, rm),)) + _imm(displacement, False)
+        else:
+            modrm = bytes((_modrm(0b10, reg, rm),)) + _imm(displacement, True)
+        default = 'ss' if base == 'bp' else 'ds'
+    prefix = b''
+    if segment is not None and segment != default:
+        if segment not in SEGMENT_CODES:
+            raise EmitterException("Unknown segment register: " + segment)
+        prefix = bytes((SEGMENT_PREFIX_BASE | (SEGMENT_CODES[segment] << 3),))
+    return MemoryOperand(prefix, modrm, width)
+
+# Encodes the parts of one instruction of the opcode script into 8086 machine code.
+# Branches are encoded by encodeBranch
+def encodeInstruction(parts):
+    command = parts[0].lower()
+    if command in NO_OPERAND_OPCODES:
+        return bytes((NO_OPERAND_OPCODES[command],))
+    if command in STRING_OPCODES:
+        return bytes((STRING_OPCODES[command],))
+    if command in REPEAT_PREFIXES:
+        if len(parts) < 2 or parts[1].lower() not in STRING_OPCODES:
+            raise EmitterException("A repeat prefix needs a string command")
+        return bytes((REPEAT_PREFIXES[command], STRING_OPCODES[parts[1].lower()]))
+    if command in STACK_OPCODES:
+        return _encodeStack(command, parts)
+    if command == 'int':
+        return _encodeInt(parts)
+    if command in INC_DEC_OPCODES:
+        return _encodeIncDec(command, parts)
+    if command in MUL_DIV_EXTENSIONS:
+        return _encodeMulDiv(command, parts)
+    if command == 'mov' or command in ARITH_OPCODES:
+        return _encodeTwoOperands(command, parts)
+    raise EmitterException("Cannot encode command: " + command)
+
+# Encodes a branch with a zero displacement.
+# Returns (machine code, position of the displacement, its size in bytes, label)
+def encodeBranch(parts):
+    opcode, size = BRANCH_OPCODES[parts[0].lower()]
+    return bytes((opcode,)) + bytes(size), 1, size, parts[2]
+
+# Stores the displacement of a branch, short branches reach -128 to 127 bytes
+def patchBranch(code, position, size, displacement, label):
+    if size == 1:
+        if not -128 <= displacement <= 127:
+            raise EmitterException("Label %s is out of the range of a short jump (%d bytes)" % (label, displacement))
+        code[position] = displacement & 0xFF
+    else:
+        code[position] = displacement & 0xFF
+        code[position + 1] = (displacement >> 8) & 0xFF
+
+# push/pop reg16, sreg or a word in memory
+def _encodeStack(command, parts):
+    registerBase, segmentBase = STACK_OPCODES[command]
+    text = parts[3].lower()
+    if int(parts[1]) == RegType.MEMORY.value:
+        extension, opcode = (6, 0xFF) if command == 'push' else (0, 0x8F)
+        memory = _memory(extension, text)
+        if memory.accessWidth(defaultWidth=16) != 16:
+            raise EmitterException("%s needs a word operand" % command)
+        return memory.encode(opcode)
+    if int(parts[1]) == RegType.SEGMENT.value:
+        if command == 'pop' and text == 'cs':
+            raise EmitterException("Cannot pop into cs")
+        return bytes((segmentBase | (SEGMENT_CODES[text] << 3),))
+    regCode, isWord = _register(text)
+    if not isWord:
+        raise EmitterException("%s needs a 16-bit register, got: %s" % (command, text))
+    return bytes((registerBase + regCode,))
+
+# int imm8, int 3 has its own single byte encoding
+def _encodeInt(parts):
+    vector = _parseNumber(parts[1], parts[2])
+    if not 0 <= vector <= 0xFF:
+        raise EmitterException("Interrupt vector out of range: " + parts[2])
+    if vector == 3:
+        return bytes((0xCC,))
+    return bytes((0xCD, vector))
+
+# inc/dec reg or memory, memory is a byte unless word ptr says otherwise
+def _encodeIncDec(command, parts):
+    shortBase, extension = INC_DEC_OPCODES[command]
+    if int(parts[1]) == RegType.MEMORY.value:
+        memory = _memory(extension, parts[3])
+        return memory.encode(0xFE + (memory.accessWidth() == 16))
+    regCode, isWord = _register(parts[3])
+    if isWord:
+        return bytes((shortBase + regCode,))
+    return bytes((0xFE, _modrm(0b11, extension, regCode)))
+
+# mul/div reg or memory, memory is a byte unless word ptr says otherwise
+def _encodeMulDiv(command, parts):
+    if int(parts[1]) == RegType.MEMORY.value:
+        memory = _memory(MUL_DIV_EXTENSIONS[command], parts[3])
+        return memory.encode(0xF6 + (memory.accessWidth() == 16))
+    regCode, isWord = _register(parts[3])
+    return bytes((0xF6 + isWord, _modrm(0b11, MUL_DIV_EXTENSIONS[command], regCode)))
+
+# mov between a segment register and a 16-bit register or memory
+def _encodeMovSegment(command, parts):
+    if command != 'mov':
+        raise EmitterException("%s cannot use a segment register" % command)
+    destType = int(parts[1])
+    sourceType = int(parts[3])
+
+    # sreg, reg16 or sreg, [address]
+    if destType == RegType.SEGMENT.value:
+        segmentCode = SEGMENT_CODES[parts[2].lower()]
+        if sourceType == OperandType.REGISTER.value:
+            regCode, isWord = _register(parts[4])
+            if not isWord:
+                raise EmitterException("Expected a 16-bit register, got: " + parts[4])
+            return bytes((MOV_TO_SEGMENT, _modrm(0b11, segmentCode, regCode)))
+        if sourceType == OperandType.MEMORY_ADDRESS.value:
+            memory = _memory(segmentCode, parts[4])
+            memory.accessWidth(16)
+            return memory.encode(MOV_TO_SEGMENT)
+        raise EmitterException("Cannot move an immediate into a segment register")
+
+    # [address], sreg
+    segmentCode = SEGMENT_CODES[parts[4].lower()]
+    if destType == RegType.MEMORY.value:
+        memory = _memory(segmentCode, parts[2])
+        memory.accessWidth(16)
+        return memory.encode(MOV_FROM_SEGMENT)
+
+    # reg16, sreg
+    regCode, isWord = _register(parts[2])
+    if not isWord:
+        raise EmitterException("Expected a 16-bit register, got: " + parts[2])
+    return bytes((MOV_FROM_SEGMENT, _modrm(0b11, segmentCode, regCode)))
+
+def _isSegmentOperand(parts):
+    if int(parts[1]) == RegType.SEGMENT.value:
+        return True
+    return int(parts[3]) == OperandType.REGISTER.value and parts[4].lower() in SEGMENT_CODES
+
+def _encodeTwoOperands(command, parts):
+    if _isSegmentOperand(parts):
+        return _encodeMovSegment(command, parts)
+    destType = int(parts[1])
+    sourceType = int(parts[3])
+
+    # the destination is in memory
+    if destType == RegType.MEMORY.value:
+
+        # [address], reg
+        if sourceType == OperandType.REGISTER.value:
+            regCode, isWord = _register(parts[4])
+            memory = _memory(regCode, parts[2])
+            memory.accessWidth(16 if isWord else 8)
+            opcode = 0x88 if command == 'mov' else ARITH_OPCODES[command][0]
+            return memory.encode(opcode + isWord)
+
+        # [address], immediate - memory destinations are a single byte unless word ptr says otherwise
+        value = _parseNumber(sourceType, parts[4])
+        extension = 0 if command == 'mov' else ARITH_OPCODES[command][2]
+        memory = _memory(extension, parts[2])
+        isWord = memory.accessWidth() == 16
+        opcode = 0xC6 if command == 'mov' else 0x80
+        return memory.encode(opcode + isWord, _imm(value, isWord))
+
+    # the destination is a register
+    destCode, isWord = _register(parts[2])
+
+    # reg, reg
+    if sourceType == OperandType.REGISTER.value:
+        sourceCode, _ = _register(parts[4])
+        opcode = 0x8A if command == 'mov' else ARITH_OPCODES[command][1]
+        return bytes((opcode + isWord, _modrm(0b11, destCode, sourceCode)))
+
+    # reg, [address]
+    if sourceType == OperandType.MEMORY_ADDRESS.value:
+        memory = _memory(destCode, parts[4])
+        memory.accessWidth(16 if isWord else 8)
+        opcode = 0x8A if command == 'mov' else ARITH_OPCODES[command][1]
+        return memory.encode(opcode + isWord)
+
+    # reg, immediate
+    value = _parseNumber(sourceType, parts[4])
+    if command == 'mov':
+        opcode = (0xB8 if isWord else 0xB0) + destCode
+        return bytes((opcode,)) + _imm(value, isWord)
+    extension = ARITH_OPCODES[command][2]
+    return bytes((0x80 + isWord, _modrm(0b11, extension, destCode))) + _imm(value, isWord)
+
+#####################################################################
+# Emitter - collects the opcode script and the machine code of the
+# parsed statements. Labels are offsets into the machine code, a
+# branch to a label that is not defined yet waits for it with a zero
+# displacement. A streaming emitter (keepProgram off) does not
+# accumulate the opcode script and the machine code, every ended
+# statement waits as (script line, machine code) until
+# takeStatements, statements with a branch waiting for its label are
+# held back together with the statements after them.
+# With resolveLabels off nothing is held back and the waiting
+# branches are left to the caller, see unresolvedBranches
+#####################################################################
 class Emitter:
-    def __init__(self):
+    def __init__(self, keepProgram=True, resolveLabels=True):
+        self.keepProgram = keepProgram
+        self.resolveLabels = resolveLabels
         self._parts = []
+        self._instruction = []
+        self._code = bytearray()
+        # streaming: [script line, machine code, branches waiting for a label] per ended statement
+        self._statements = []
+        # size of the machine code emitted so far and the offset of every label
+        self._offset = 0
+        self.labels = {}
+        # branches waiting for a label: (code buffer, position of the displacement, size, label, end of the
+        # branch as a program offset, streamed statement or None)
+        self._unresolved = []
     
     def addOpcodePart(self, part):
-        self._parts.append(str(part))
-        self._parts.append(' ')
+        part = str(part)
+        if self.keepProgram:
+            self._parts.append(part)
+            self._parts.append(' ')
+        self._instruction.append(part)
 
     def endOpcode(self):
-        self._parts.append('\n')
+        if self.keepProgram:
+            self._parts.append('\n')
+        self._encodePendingInstruction()
+
+    # Defines a label at the current offset and completes the branches waiting for it
+    def defineLabel(self, name):
+        if name in self.labels:
+            raise EmitterException("Label defined twice: " + name)
+        self.labels[name] = self._offset
+        if not any(branch[3] == name for branch in self._unresolved):
+            return
+        waiting = self._unresolved
+        self._unresolved = []
+        for branch in waiting:
+            if branch[3] != name:
+                self._unresolved.append(branch)
+                continue
+            buffer, position, size, label, end, statement = branch
+            patchBranch(buffer, position, size, self._offset - end, label)
+            if statement is not None:
+                statement[2] -= 1
+
+    # Encodes the instruction collected so far into machine code
+    def _encodePendingInstruction(self):
+        if not self._instruction:
+            return
+        parts = self._instruction
+        self._instruction = []
+        if parts[0].lower() in BRANCH_OPCODES:
+            code, position, size, label = encodeBranch(parts)
+        else:
+            code, label = encodeInstruction(parts), None
+
+        start = self._offset
+        self._offset += len(code)
+        if self.keepProgram:
+            self._code += code
+            buffer, statement = self._code, None
+            if label is not None:
+                position += start
+        else:
+            statement = [''.join(part + ' ' for part in parts), bytearray(code), 0]
+            self._statements.append(statement)
+            buffer = statement[1]
+
+        if label is None:
+            return
+        if label in self.labels:
+            patchBranch(buffer, position, size, self.labels[label] - self._offset, label)
+            return
+        self._unresolved.append((buffer, position, size, label, self._offset, statement))
+        if statement is not None and self.resolveLabels:
+            statement[2] += 1
+
+    def _checkLabels(self):
+        if self.resolveLabels and self._unresolved:
+            raise EmitterException("Undefined label: " + self._unresolved[0][3])
+
+    # Ends the last statement, a program does not have to end with a newline.
+    # Every label has to be defined by now
+    def finish(self):
+        self._encodePendingInstruction()
+        self._checkLabels()
+
+    # Returns the (script line, machine code) pairs of the statements ended since the last call,
+    # up to the first statement still waiting for a label
+    def takeStatements(self):
+        ready = 0
+        while ready < len(self._statements) and self._statements[ready][2] == 0:
+            ready += 1
+        statements = [(script, bytes(code)) for script, code, waiting in self._statements[:ready]]
+        del self._statements[:ready]
+        return statements
+
+    # Returns (position, size, label, end) of every branch still waiting for its label, positions and
+    # ends are offsets from the start of the code of this emitter
+    def unresolvedBranches(self):
+        branches = []
+        for buffer, position, size, label, end, statement in self._unresolved:
+            if statement is not None:
+                # a streamed statement is a single instruction ending at end
+                position += end - len(buffer)
+            branches.append((position, size, label, end))
+        return branches
     
     def getProgramScript(self):
-        res = ""
-        for part in self._parts:
-            res += part
-        return res
\ No newline at end of file
+        return ''.join(self._parts)
+
+    # Returns the program as 8086 machine code
+    def getMachineCode(self):
+        # the last statement of a program is not followed by a newline
+        self._encodePendingInstruction()
+        self._checkLabels()
+        return bytes(self._code)
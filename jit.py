@@ -0,0 +1,447 @@
+from decoder import OperandKind, JCC_MNEMONICS
+from registers import FlagsRegister, RegisterFile
+from semantics import JCC_CONDITIONS
+
+# Number of times an address has to be reached by the interpreter before a block is compiled there
+DEFAULT_THRESHOLD = 50
+
+# Longest block that is compiled, in instructions
+MAX_BLOCK_LENGTH = 64
+
+# Instructions a block stops before, they always run in the interpreter. int and iret load CS:IP,
+# and so do div and idiv on a divide error
+BLOCK_ENDING_MNEMONICS = {'hlt', 'int', 'iret', 'div', 'idiv'}
+
+# Instructions that end a block as its last instruction, the block returns with IP at their target
+BRANCH_MNEMONICS = {'jmp', 'call', 'ret', 'loop', 'loope', 'loopne', 'jcxz'} | set(JCC_MNEMONICS)
+
+# Names of the local variables holding the registers inside a compiled block
+WORD_NAMES = ('ax', 'cx', 'dx', 'bx', 'sp', 'bp', 'si', 'di')
+SEGMENT_NAMES = ('es', 'cs', 'ss', 'ds')
+
+# Two operand operations whose flags are fully recorded as pending
+# Format: 'mnemonic' : (flags kind, raw result expression of a and b, whether the result is stored)
+BINARY_OPERATIONS = {
+    'add': (FlagsRegister.ADD, 'a + b', True),
+    'adc': (FlagsRegister.ADD, 'a + b + flags.carry', True),
+    'sub': (FlagsRegister.SUB, 'a - b', True),
+    'sbb': (FlagsRegister.SUB, 'a - b - flags.carry', True),
+    'cmp': (FlagsRegister.SUB, 'a - b', False),
+    'and': (FlagsRegister.LOGIC, 'a & b', True),
+    'or': (FlagsRegister.LOGIC, 'a | b', True),
+    'xor': (FlagsRegister.LOGIC, 'a ^ b', True),
+}
+
+# Operations that read the flags left by the instructions before them
+FLAG_READING_MNEMONICS = {'adc', 'sbb', 'inc', 'dec'}
+
+# Operations whose effect on the flags is ignored by the flag liveness analysis
+FLAGLESS_MNEMONICS = {'mov', 'not', 'nop', 'push', 'pop'}
+
+#####################################################################
+# CompiledBlock - a straight-line run of instructions, ending at a
+# branch or before an interpreted control transfer, translated into
+# a single Python function. The function returns the number of
+# instructions it executed
+#####################################################################
+class CompiledBlock:
+    def __init__(self, start, end, instructions, source, function, invalid):
+        self.start = start
+        self.end = end
+        self.instructions = instructions
+        self.source = source
+        self.function = function
+        self.invalid = invalid
+
+    def __len__(self):
+        return len(self.instructions)
+
+#####################################################################
+# _BlockBuilder - generates the Python source of one block
+#####################################################################
+class _BlockBuilder:
+    def __init__(self, instructions):
+        self.instructions = instructions
+        self.lines = []
+        self.usedWords = set()
+        self.usedSegments = set()
+        self.writtenWords = set()
+        self.writtenSegments = set()
+        self.temporaries = 0
+        # the expression of the IP a block leaves with, set by a branch at its end
+        self.nextIp = None
+        # the condition function of a conditional jump at the end of the block
+        self.condition = None
+
+    def emit(self, line, indent=1):
+        self.lines.append('    ' * indent + line)
+
+    def temporary(self):
+        self.temporaries += 1
+        return 't%d' % self.temporaries
+
+    def _segmentName(self, index):
+        self.usedSegments.add(index)
+        return SEGMENT_NAMES[index]
+
+    # Emits the address computation of the word at SS:SP, returns the name holding it
+    def stackAddress(self):
+        self.usedWords.add(RegisterFile.SP)
+        name = self.temporary()
+        self.emit('%s = ((%s << 4) + sp) & 0xFFFFF' % (name, self._segmentName(RegisterFile.SS)))
+        return name
+
+    def adjustStackPointer(self, delta):
+        self.usedWords.add(RegisterFile.SP)
+        self.writtenWords.add(RegisterFile.SP)
+        self.emit('sp = (sp %+d) & 0xFFFF' % delta)
+
+    # Emits the address computation of a memory operand, returns the name holding it.
+    # The base and index registers are added as locals of the block
+    def address(self, operand):
+        name = self.temporary()
+        registers = [reg for reg in (operand.base, operand.index) if reg is not None]
+        if not registers:
+            self.emit('%s = ((%s << 4) + %d) & 0xFFFFF' % (name, self._segmentName(operand.segment), operand.value))
+            return name
+        self.usedWords.update(registers)
+        offset = ' + '.join([WORD_NAMES[reg] for reg in registers] + ([str(operand.value)] if operand.value else []))
+        self.emit('%s = ((%s << 4) + ((%s) & 0xFFFF)) & 0xFFFFF' % (name, self._segmentName(operand.segment), offset))
+        return name
+
+    # Returns an expression reading the operand, address is the name of a precomputed memory address
+    def read(self, operand, address=None):
+        kind = operand.kind
+        if kind is OperandKind.REGISTER:
+            if operand.width == 16:
+                self.usedWords.add(operand.reg)
+                return WORD_NAMES[operand.reg]
+            if operand.reg < 4:
+                self.usedWords.add(operand.reg)
+                return '(%s & 0xFF)' % WORD_NAMES[operand.reg]
+            self.usedWords.add(operand.reg - 4)
+            return '(%s >> 8)' % WORD_NAMES[operand.reg - 4]
+        if kind is OperandKind.IMMEDIATE:
+            return str(operand.value)
+        if kind is OperandKind.SEGMENT:
+            return self._segmentName(operand.reg)
+        if address is None:
+            address = self.address(operand)
+        return '%s(%s)' % ('readWord' if operand.width == 16 else 'readByte', address)
+
+    # Emits a statement storing the expression into the operand
+    def write(self, operand, expression, address=None):
+        kind = operand.kind
+        if kind is OperandKind.REGISTER:
+            if operand.width == 16:
+                reg = operand.reg
+                self.emit('%s = (%s) & 0xFFFF' % (WORD_NAMES[reg], expression))
+            elif operand.reg < 4:
+                reg = operand.reg
+                self.emit('%s = (%s & 0xFF00) | ((%s) & 0xFF)' % (WORD_NAMES[reg], WORD_NAMES[reg], expression))
+            else:
+                reg = operand.reg - 4
+                self.emit('%s = (%s & 0xFF) | (((%s) & 0xFF) << 8)' % (WORD_NAMES[reg], WORD_NAMES[reg], expression))
+            self.usedWords.add(reg)
+            self.writtenWords.add(reg)
+        elif kind is OperandKind.SEGMENT:
+            self.emit('%s = (%s) & 0xFFFF' % (self._segmentName(operand.reg), expression))
+            self.writtenSegments.add(operand.reg)
+        else:
+            if address is None:
+                address = self.address(operand)
+            self.emit('%s(%s, %s)' % ('writeWord' if operand.width == 16 else 'writeByte', address, expression))
+
+    # The statements storing the register locals back into the register file
+    def writeBackLines(self, indent):
+        lines = ['    ' * indent + 'words[%d] = %s' % (reg, WORD_NAMES[reg]) for reg in sorted(self.writtenWords)]
+        lines += ['    ' * indent + 'segments[%d] = %s' % (reg, SEGMENT_NAMES[reg]) for reg in sorted(self.writtenSegments)]
+        return lines
+
+    # Emits a check that leaves the block when one of its own bytes was overwritten
+    def emitInvalidationExit(self, offset, executed):
+        self.lines.append(('__exit__', offset, executed))
+
+    # Computes which instructions have to record their flags. Flags are live at the end of the block,
+    # an instruction that overwrites all flags hides the flags of the instructions before it
+    def flagLiveness(self):
+        live = [False] * len(self.instructions)
+        liveAfter = True
+        for index in range(len(self.instructions) - 1, -1, -1):
+            mnemonic = self.instructions[index].mnemonic
+            live[index] = liveAfter
+            if mnemonic in FLAGLESS_MNEMONICS:
+                continue
+            if mnemonic in ('inc', 'dec'):
+                continue
+            if mnemonic in BINARY_OPERATIONS or mnemonic == 'neg':
+                liveAfter = mnemonic in FLAG_READING_MNEMONICS
+            else:
+                # instructions run through the interpreter may read any flag
+                liveAfter = True
+        return live
+
+    def build(self):
+        live = self.flagLiveness()
+        offset = 0
+        for index, instruction in enumerate(self.instructions):
+            offset += instruction.length
+            self.emit('# %05x %s' % (instruction.address, instruction.mnemonic))
+            if instruction.mnemonic in BRANCH_MNEMONICS:
+                self.branch(index, instruction, offset)
+            else:
+                self.instruction(index, instruction, live[index], offset)
+
+        # registers are loaded at the start of the block and written back at every exit
+        body = []
+        for line in self.lines:
+            if isinstance(line, tuple):
+                tag, exitOffset, executed = line
+                body.append('    if invalid[0]:')
+                body += self.writeBackLines(2)
+                body.append('        regFile.ip = (ip + %d) & 0xFFFF' % exitOffset)
+                body.append('        return %d' % executed)
+            else:
+                body.append(line)
+
+        source = ['def block():']
+        source += ['    %s = words[%d]' % (WORD_NAMES[reg], reg) for reg in sorted(self.usedWords)]
+        source += ['    %s = segments[%d]' % (SEGMENT_NAMES[reg], reg) for reg in sorted(self.usedSegments)]
+        source.append('    ip = regFile.ip')
+        source += body
+        source += self.writeBackLines(1)
+        if self.nextIp is None:
+            source.append('    regFile.ip = (ip + %d) & 0xFFFF' % offset)
+        elif self.nextIp == 'execute':
+            # the branch runs through the interpreter once the registers are back in the register file
+            source.append('    regFile.ip = (ip + %d) & 0xFFFF' % offset)
+            source.append('    instructions[%d].execute()' % (len(self.instructions) - 1))
+        else:
+            source.append('    regFile.ip = %s' % self.nextIp)
+        source.append('    return %d' % len(self.instructions))
+        return '\n'.join(source) + '\n'
+
+    def instruction(self, index, instruction, flagsLive, offset):
+        mnemonic = instruction.mnemonic
+        dest = instruction.dest
+        width = instruction.width
+        writesMemory = dest is not None and dest.kind is OperandKind.MEMORY
+
+        if mnemonic == 'nop':
+            self.emit('pass')
+            return
+
+        if mnemonic == 'mov':
+            self.write(dest, self.read(instruction.source))
+
+        elif mnemonic in BINARY_OPERATIONS:
+            kind, expression, store = BINARY_OPERATIONS[mnemonic]
+            address = self.address(dest) if writesMemory else None
+            self.emit('a = %s' % self.read(dest, address))
+            self.emit('b = %s' % self.read(instruction.source))
+            self.emit('r = %s' % expression)
+            if store:
+                self.write(dest, 'r', address)
+            else:
+                writesMemory = False
+            if flagsLive:
+                self.emit('flags.pending = (%d, a, b, r, %d, None)' % (kind, width))
+
+        elif mnemonic in ('inc', 'dec'):
+            address = self.address(dest) if writesMemory else None
+            self.emit('a = %s' % self.read(dest, address))
+            self.emit('r = a %s 1' % ('+' if mnemonic == 'inc' else '-'))
+            self.write(dest, 'r', address)
+            if flagsLive:
+                kind = FlagsRegister.INC if mnemonic == 'inc' else FlagsRegister.DEC
+                self.emit('setPendingIncDec(%d, a, r, %d)' % (kind, width))
+
+        elif mnemonic == 'neg':
+            address = self.address(dest) if writesMemory else None
+            self.emit('b = %s' % self.read(dest, address))
+            self.write(dest, '-b', address)
+            if flagsLive:
+                self.emit('flags.pending = (%d, 0, b, -b, %d, None)' % (FlagsRegister.SUB, width))
+
+        elif mnemonic == 'not':
+            address = self.address(dest) if writesMemory else None
+            self.write(dest, '~%s' % self.read(dest, address), address)
+
+        elif mnemonic == 'push':
+            # the 8086 pushes the decremented value of sp
+            self.adjustStackPointer(-2)
+            address = self.stackAddress()
+            self.emit('writeWord(%s, %s)' % (address, self.read(dest)))
+            writesMemory = True
+
+        elif mnemonic == 'pop':
+            address = self.stackAddress()
+            self.adjustStackPointer(2)
+            self.write(dest, 'readWord(%s)' % address)
+
+        else:
+            self.callOut(index, offset)
+            writesMemory = True
+
+        if writesMemory:
+            self.emitInvalidationExit(offset, index + 1)
+
+    # Emits the branch at the end of the block, it computes the IP the block leaves with.
+    # Branches through a register or memory run in the interpreter
+    def branch(self, index, instruction, offset):
+        mnemonic = instruction.mnemonic
+        target = instruction.dest
+        fallThrough = '(ip + %d) & 0xFFFF' % offset
+        if target is None or target.kind is not OperandKind.RELATIVE:
+            if mnemonic != 'ret':
+                self.nextIp = 'execute'
+                return
+            # ret and ret imm16
+            address = self.stackAddress()
+            self.emit('r = readWord(%s)' % address)
+            self.adjustStackPointer(2 if target is None else 2 + target.value)
+            self.nextIp = 'r'
+            return
+
+        taken = '(ip + %d) & 0xFFFF' % (offset + target.value)
+        if mnemonic == 'jmp':
+            self.nextIp = taken
+            return
+        if mnemonic == 'call':
+            self.adjustStackPointer(-2)
+            self.emit('writeWord(%s, %s)' % (self.stackAddress(), fallThrough))
+            self.nextIp = taken
+            return
+
+        if mnemonic in JCC_CONDITIONS:
+            self.condition = JCC_CONDITIONS[mnemonic]
+            condition = 'condition(flags)'
+        else:
+            self.usedWords.add(RegisterFile.CX)
+            if mnemonic == 'jcxz':
+                condition = 'not cx'
+            else:
+                self.writtenWords.add(RegisterFile.CX)
+                self.emit('cx = (cx - 1) & 0xFFFF')
+                condition = {'loop': 'cx', 'loope': 'cx and flags.testZero()',
+                    'loopne': 'cx and not flags.testZero()'}[mnemonic]
+        self.nextIp = '%s if %s else %s' % (taken, condition, fallThrough)
+
+    # Runs an instruction through its interpreter execute function. The register locals are
+    # synced with the register file around the call
+    def callOut(self, index, offset):
+        for reg in range(len(WORD_NAMES)):
+            self.usedWords.add(reg)
+            self.writtenWords.add(reg)
+        for reg in range(len(SEGMENT_NAMES)):
+            self.usedSegments.add(reg)
+            self.writtenSegments.add(reg)
+        for line in self.writeBackLines(1):
+            self.lines.append(line)
+        self.emit('regFile.ip = (ip + %d) & 0xFFFF' % offset)
+        self.emit('instructions[%d].execute()' % index)
+        for reg, name in enumerate(WORD_NAMES):
+            self.emit('%s = words[%d]' % (name, reg))
+        for reg, name in enumerate(SEGMENT_NAMES):
+            self.emit('%s = segments[%d]' % (name, reg))
+
+#####################################################################
+# BlockCompiler - the second execution tier of the CPU. It counts how
+# often the interpreter reaches each address, translates hot basic
+# blocks into Python functions and drops them when their memory is
+# written
+#####################################################################
+class BlockCompiler:
+    def __init__(self, cpu, threshold=DEFAULT_THRESHOLD, maxBlockLength=MAX_BLOCK_LENGTH):
+        self.cpu = cpu
+        self.threshold = threshold
+        self.maxBlockLength = maxBlockLength
+        self.blocks = {}
+        self.counters = {}
+        self._uncompilable = set()
+
+        self.compiledCount = 0
+        self.invalidatedCount = 0
+        self.blockExecutions = 0
+        self.blockInstructions = 0
+
+    # Counts a visit of the interpreter to an address. Returns the compiled block once it becomes hot
+    def visit(self, address):
+        count = self.counters.get(address, 0) + 1
+        if count < self.threshold or address in self._uncompilable:
+            self.counters[address] = count
+            return None
+        self.counters.pop(address, None)
+        return self.compile(address)
+
+    # Decodes the straight-line run of instructions starting at the address, up to and including a branch
+    def _collectInstructions(self, address):
+        instructions = []
+        while len(instructions) < self.maxBlockLength:
+            instruction = self.cpu.instructionAt(address)
+            if instruction.mnemonic in BLOCK_ENDING_MNEMONICS:
+                break
+            instructions.append(instruction)
+            if instruction.mnemonic in BRANCH_MNEMONICS:
+                break
+            address += instruction.length
+        return instructions
+
+    def compile(self, address):
+        instructions = self._collectInstructions(address)
+        if not instructions:
+            self._uncompilable.add(address)
+            return None
+
+        cpu = self.cpu
+        builder = _BlockBuilder(instructions)
+        source = builder.build()
+        invalid = [False]
+        namespace = {
+            'words': cpu.regFile.words,
+            'segments': cpu.regFile.segments,
+            'regFile': cpu.regFile,
+            'flags': cpu.flags,
+            'setPendingIncDec': cpu.flags.setPendingIncDec,
+            'readByte': cpu.memory.readByte,
+            'readWord': cpu.memory.readWord,
+            'writeByte': cpu.memory.writeByte,
+            'writeWord': cpu.memory.writeWord,
+            'instructions': instructions,
+            'invalid': invalid,
+            'condition': builder.condition,
+        }
+        exec(compile(source, '<block %05x>' % address, 'exec'), namespace)
+
+        end = address + sum(instruction.length for instruction in instructions)
+        block = CompiledBlock(address, end, instructions, source, namespace['block'], invalid)
+        self.blocks[address] = block
+        cpu.memory.watchPages(address, end, self._onWrite)
+        self.compiledCount += 1
+        return block
+
+    # Drops every block whose bytes overlap the written range
+    def _onWrite(self, start, stop):
+        for address, block in list(self.blocks.items()):
+            if block.start < stop and start < block.end:
+                block.invalid[0] = True
+                del self.blocks[address]
+                self.invalidatedCount += 1
+
+    # Drops every block and counter
+    def reset(self):
+        self.cpu.memory.unwatchPages(self._onWrite)
+        for block in self.blocks.values():
+            block.invalid[0] = True
+        self.blocks.clear()
+        self.counters.clear()
+        self._uncompilable.clear()
+
+    def stats(self):
+        return {
+            'compiled': self.compiledCount,
+            'invalidated': self.invalidatedCount,
+            'live': len(self.blocks),
+            'blockExecutions': self.blockExecutions,
+            'blockInstructions': self.blockInstructions,
+        }
@@ -0,0 +1,217 @@
+from assembler import assemble
+from cpu import CPU8086
+from differential import DifferentialChecker, firstDifference
+
+# Registers the generated programs write, cx is left alone because it counts the loop
+WORD_REGISTERS = ('ax', 'bx', 'dx', 'si', 'di', 'bp')
+BYTE_REGISTERS = ('al', 'ah', 'bl', 'bh', 'dl', 'dh')
+READ_ONLY_WORD_REGISTERS = ('cx',)
+READ_ONLY_BYTE_REGISTERS = ('cl', 'ch')
+
+# The registers that stay written when the address registers are kept read only
+DATA_WORD_REGISTERS = ('ax', 'dx')
+DATA_BYTE_REGISTERS = ('al', 'ah', 'dl', 'dh')
+
+ALU_MNEMONICS = ('add', 'adc', 'sub', 'sbb', 'and', 'or', 'xor', 'cmp')
+JUMP_MNEMONICS = ('jz', 'jnz', 'jc', 'jnc', 'jl', 'jge', 'jle', 'jg', 'jb', 'ja', 'js', 'jns', 'jo', 'jno', 'jp', 'jnp')
+FLAG_MNEMONICS = ('clc', 'stc', 'cmc', 'cld', 'std')
+
+# The offset of the store the self-modifying programs patch, after the 3 byte mov cx
+SELF_MODIFYING_START = 3
+
+# Memory operand forms, {} is a displacement
+ADDRESS_FORMS = ('[bx]', '[si+{}]', '[di+{}]', '[bx+si+{}]', '[bx+di+{}]', '[bp+si+{}]', '[bp+di+{}]', '[bp+{}]', '[{}]')
+
+#####################################################################
+# ProgramGenerator - random assembly programs for the differential
+# checks. A program sets up its registers, runs a loop of random
+# instructions with forward jumps and calls of a subroutine, and
+# halts. cx only counts the loop, so every program terminates unless
+# it overwrites its own code. Without addressRegisters bx, si, di and
+# bp are only read, so the addresses stay within the bounds their
+# initial values allow
+#####################################################################
+class ProgramGenerator:
+    def __init__(self, rng, segmentOverrides=True, divide=True, addressRegisters=True):
+        self.rng = rng
+        self.segmentOverrides = segmentOverrides
+        self.divide = divide
+        self.wordRegisters = WORD_REGISTERS if addressRegisters else DATA_WORD_REGISTERS
+        self.byteRegisters = BYTE_REGISTERS if addressRegisters else DATA_BYTE_REGISTERS
+        self._labels = 0
+
+    def _label(self):
+        self._labels += 1
+        return 'skip%d' % self._labels
+
+    def immediate(self, width):
+        rng = self.rng
+        return rng.choice((0, 1, 0x7F, 0x80, 0xFF, 0x7FFF, 0x8000, 0xFFFF, rng.randint(0, 0xFFFF))) & (0xFF if width == 8 else 0xFFFF)
+
+    def memory(self):
+        form = self.rng.choice(ADDRESS_FORMS).format(self.rng.randint(0, 300))
+        if self.segmentOverrides and self.rng.random() < 0.2:
+            form = self.rng.choice(('es:', 'ss:', 'ds:')) + form
+        return form
+
+    def register(self, width, written=True):
+        if not written:
+            return self.rng.choice(WORD_REGISTERS + READ_ONLY_WORD_REGISTERS if width == 16 else BYTE_REGISTERS + READ_ONLY_BYTE_REGISTERS)
+        return self.rng.choice(self.wordRegisters if width == 16 else self.byteRegisters)
+
+    # Returns one random instruction
+    def instruction(self):
+        rng = self.rng
+        width = rng.choice((8, 16))
+        size = 'byte ptr ' if width == 8 else 'word ptr '
+        kind = rng.random()
+        if kind < 0.45:
+            mnemonic = rng.choice(ALU_MNEMONICS + ('mov', 'mov'))
+            form = rng.randrange(5)
+            if form == 0:
+                return '%s %s, %s' % (mnemonic, self.register(width), self.register(width, False))
+            if form == 1:
+                return '%s %s, %d' % (mnemonic, self.register(width), self.immediate(width))
+            if form == 2:
+                return '%s %s, %s' % (mnemonic, self.register(width), self.memory())
+            if form == 3:
+                return '%s %s, %s' % (mnemonic, self.memory(), self.register(width, False))
+            return '%s %s%s, %d' % (mnemonic, size, self.memory(), self.immediate(width))
+        if kind < 0.6:
+            mnemonic = rng.choice(('inc', 'dec'))
+            return '%s %s' % (mnemonic, self.register(width) if rng.random() < 0.6 else size + self.memory())
+        if kind < 0.66:
+            return 'mul %s' % (self.register(width, False) if rng.random() < 0.6 else size + self.memory())
+        if kind < 0.67 and self.divide:
+            return 'div %s' % (self.register(width, False) if rng.random() < 0.6 else size + self.memory())
+        if kind < 0.74:
+            return rng.choice(FLAG_MNEMONICS)
+        if kind < 0.78 and self.segmentOverrides:
+            return 'mov es, %s' % self.register(16, False)
+        if kind < 0.84:
+            return 'push %s' % (self.register(16, False) if rng.random() < 0.7 else 'word ptr ' + self.memory())
+        if kind < 0.9:
+            return 'pop %s' % (self.register(16) if rng.random() < 0.7 else 'word ptr ' + self.memory())
+        return 'nop'
+
+    # Returns straight-line code with forward jumps over some of the instructions
+    def body(self, length):
+        lines = []
+        pending = []
+        for index in range(length):
+            if self.rng.random() < 0.15:
+                label = self._label()
+                lines.append('%s %s' % (self.rng.choice(JUMP_MNEMONICS), label))
+                pending.append((index + self.rng.randint(1, 4), label))
+            lines.append(self.instruction())
+            for target, label in [entry for entry in pending if entry[0] <= index]:
+                lines.append(label + ':')
+                pending.remove((target, label))
+        lines += [label + ':' for target, label in pending]
+        return lines
+
+    # Returns the source of a program. With registers the program sets them up itself,
+    # otherwise they are left to the initial state of the run
+    def program(self, length, iterations, registers=True):
+        lines = []
+        if registers:
+            lines += ['mov %s, %d' % (name, self.immediate(16)) for name in WORD_REGISTERS]
+            lines.append('mov sp, %d' % self.rng.randint(0x8000, 0xFFFE))
+        lines.append('mov cx, %d' % iterations)
+        lines.append('top:')
+        body = self.body(length)
+        for position in range(self.rng.randint(0, 2)):
+            body.insert(self.rng.randint(0, len(body)), 'call subroutine')
+        lines += body
+        lines += ['loop top', 'hlt', 'subroutine:']
+        lines += [line for line in self.body(self.rng.randint(1, 6)) if not line.startswith(('push', 'pop'))]
+        lines.append('ret')
+        return '\n'.join(lines)
+
+#####################################################################
+# JitChecker - runs random programs on the interpreter and on the
+# block compiling tier and compares the final states. The compiled
+# run goes in random step budgets, so blocks are also checked
+# against budgets they do not fit in
+#####################################################################
+class JitChecker(DifferentialChecker):
+    DESCRIPTION = "Checks the block compiling tier against the interpreter on random programs"
+    OPTIONS = {
+        'programs': ('programs', 200, None),
+        'max-steps': ('maxSteps', 20000, "instructions a program may run"),
+    }
+
+    # Returns the state of a CPU after a run for comparison
+    @staticmethod
+    def state(cpu, error):
+        return {'registers': cpu.regFile.asDict(), 'flags': cpu.flags.getWord(), 'halted': cpu.halted,
+            'steps': cpu.steps, 'error': error}
+
+    # Runs a CPU for maxSteps instructions in budgets of the given sizes, returns the exception message or None
+    @staticmethod
+    def runInBudgets(cpu, maxSteps, budgets):
+        try:
+            for budget in budgets:
+                if cpu.halted or cpu.steps >= maxSteps:
+                    break
+                cpu.run(min(budget, maxSteps - cpu.steps))
+        except Exception as exception:
+            return "%s: %s" % (type(exception).__name__, exception)
+        return None
+
+    def checkProgram(self, case, source, rng, maxSteps):
+        image = assemble(source).getMachineCode()
+        interpreter = CPU8086()
+        interpreter.loadProgram(image)
+        expectedError = JitChecker.runInBudgets(interpreter, maxSteps, [maxSteps])
+
+        compiled = CPU8086()
+        compiled.enableJit(rng.randint(1, 4))
+        compiled.loadProgram(image)
+        budgets = [rng.choice((1, 3, 7, 50, 500, maxSteps)) for i in range(maxSteps)]
+        error = JitChecker.runInBudgets(compiled, maxSteps, budgets)
+
+        expected = JitChecker.state(interpreter, expectedError)
+        got = JitChecker.state(compiled, error)
+        for name in expected:
+            self.expect(name, case, got[name], expected[name])
+        # the data below the program and the program itself, which it may have overwritten
+        self.expect('first differing memory address', case,
+            firstDifference(compiled.memory[0:0x20000], interpreter.memory[0:0x20000]), None)
+
+    # Returns a loop whose second instruction patches a displacement or immediate byte of the first, a 7 byte
+    # store with a segment override prefix, with the address and the bytes the patched store writes
+    @staticmethod
+    def selfModifyingProgram(rng):
+        patch = rng.randint(3, 6)
+        value = rng.randint(0, 0xFF)
+        source = '\n'.join(['mov cx, %d' % rng.randint(2, 5), 'top:',
+            'mov word ptr es:[bx+si+%d], %d' % (rng.randint(0x100, 0x7FFF) & ~1, rng.randint(0, 0xFFFF)),
+            'mov byte ptr cs:[%d], %d' % (SELF_MODIFYING_START + patch, value),
+            'loop top'])
+        code = bytearray(assemble(source).getMachineCode())
+        code[SELF_MODIFYING_START + patch] = value
+        address = int.from_bytes(code[SELF_MODIFYING_START + 3:SELF_MODIFYING_START + 5], 'little')
+        return source, address, bytes(code[SELF_MODIFYING_START + 5:SELF_MODIFYING_START + 7])
+
+    # Every iteration of a self-modifying loop after the first must store the patched immediate
+    def checkSelfModifying(self, case, source, address, stored, rng, maxSteps):
+        interpreter = CPU8086()
+        interpreter.loadProgram(assemble(source).getMachineCode())
+        JitChecker.runInBudgets(interpreter, maxSteps, [maxSteps])
+        self.expect('patched store', case, bytes(interpreter.memory[address:address + 2]), stored)
+        self.checkProgram(case, source, rng, maxSteps)
+
+    def run(self, rng, programs, maxSteps):
+        generator = ProgramGenerator(rng)
+        for number in range(programs):
+            case = "program %d" % number
+            if rng.random() < 0.1:
+                source, address, stored = JitChecker.selfModifyingProgram(rng)
+                self.checkCase("%s:\n%s" % (case, source), self.checkSelfModifying, case, source, address, stored, rng, maxSteps)
+            else:
+                source = generator.program(rng.randint(1, 30), rng.randint(1, 60))
+                self.checkCase("%s:\n%s" % (case, source), self.checkProgram, case, source, rng, maxSteps)
+
+if __name__ == "__main__":
+    JitChecker.main()
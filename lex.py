@@ -1,4 +1,8 @@
+from array import array
 from enum import Enum
+from itertools import accumulate
+from operator import sub
+import re
 import sys
 
 class Token:
@@ -10,17 +14,59 @@ class TokenType(Enum):
     # Single operand Commands
     INC = 0
     DEC = 1
+    MUL = 2
+    DIV = 3
+    PUSH = 4
+    POP = 5
+    INT = 6
 
     # Double operand commands
     MOV = 50
     ADD = 51
     SUB = 52
-    MUL = 53
-    DIV = 54
+    ADC = 53
+    SBB = 54
+    AND = 55
+    OR = 56
+    XOR = 57
+    CMP = 58
+
+    # Repeat prefixes, a string command follows them
+    REP = 60
+    REPE = 61
+    REPZ = 62
+    REPNE = 63
+    REPNZ = 64
+
+    # Commands without operands
+    RET = 70
+    IRET = 71
+    HLT = 72
+    NOP = 73
+    CLC = 74
+    STC = 75
+    CMC = 76
+    CLI = 77
+    STI = 78
+    CLD = 79
+    STD = 80
+
+    # String commands, they take no operands
+    MOVSB = 81
+    MOVSW = 82
+    CMPSB = 83
+    CMPSW = 84
+    STOSB = 85
+    STOSW = 86
+    LODSB = 87
+    LODSW = 88
+    SCASB = 89
+    SCASW = 90
 
     # MP-Registers
     REG8BIT = 100
     REG16BIT = 101
+    SEGREG = 102
 
     # operands
     HEX_NUMBER = 200
@@ -28,18 +74,69 @@ class TokenType(Enum):
     DEC_NUMBER = 202
     LABEL = 203
 
+    # Memory operand sizes, as in byte ptr [bx]
+    BYTE = 300
+    WORD = 301
+    PTR = 302
+
     # MISC
     NEWLINE = 1000
     EOF = 1001
     COMMA = 1002
     LEFT_BRACE = 1003
     RIGHT_BRACE = 1004
+    COLON = 1005
+    PLUS = 1006
+    MINUS = 1007
+
+    # Branch commands, their operand is a label
+    JMP = 2000
+    CALL = 2001
+    LOOP = 2002
+    LOOPE = 2003
+    LOOPZ = 2004
+    LOOPNE = 2005
+    LOOPNZ = 2006
+    JCXZ = 2007
+    JO = 2010
+    JNO = 2011
+    JB = 2012
+    JNAE = 2013
+    JC = 2014
+    JAE = 2015
+    JNB = 2016
+    JNC = 2017
+    JE = 2018
+    JZ = 2019
+    JNE = 2020
+    JNZ = 2021
+    JBE = 2022
+    JNA = 2023
+    JA = 2024
+    JNBE = 2025
+    JS = 2026
+    JNS = 2027
+    JP = 2028
+    JPE = 2029
+    JNP = 2030
+    JPO = 2031
+    JL = 2032
+    JNGE = 2033
+    JGE = 2034
+    JNL = 2035
+    JLE = 2036
+    JNG = 2037
+    JG = 2038
+    JNLE = 2039
+
+    # Keywords are the commands, all of them are below 100 except the branches
+    @staticmethod
+    def isKeyword(kind):
+        return kind.value < 100 or kind.value >= 2000
 
     @staticmethod
     def isCommand(token):
-        if token.kind.value <= 100:
-            return True
-        return False
+        return TokenType.isKeyword(token.kind)
 
     @staticmethod
     def isSingleOperand(commandToken):
@@ -47,6 +144,27 @@ class TokenType(Enum):
             return True
         return False
 
+    @staticmethod
+    def isNoOperand(commandToken):
+        return 70 <= commandToken.kind.value < 100
+
+    @staticmethod
+    def isPrefix(commandToken):
+        return 60 <= commandToken.kind.value < 70
+
+    @staticmethod
+    def isString(commandToken):
+        return 81 <= commandToken.kind.value <= 90
+
+    @staticmethod
+    def isBranch(commandToken):
+        return commandToken.kind.value >= 2000
+
+    # The words of memory operands, they are reserved like the commands and the registers
+    @staticmethod
+    def isOperandWord(kind):
+        return 300 <= kind.value < 400
+
 ###########################################################################
 # The lexer class is responsible for breaking the input strings into tokens
 ###########################################################################
@@ -84,7 +202,7 @@ class Lexer:
     def _checkIfKeyword(self, text):
         text = text.upper()
         for kind in TokenType:
-            if text == kind.name and kind.value <= 100:
+            if text == kind.name and TokenType.isKeyword(kind):
                 return kind
         return None
 
@@ -94,11 +212,22 @@ class Lexer:
         if text in ['AL', 'AH', 'BL', 'BH', 'CL', 'CH', 'DL', 'DH']:
             return TokenType.REG8BIT
         
-        if text in ['AX', 'BX', 'CX', 'DX']:
+        if text in ['AX', 'BX', 'CX', 'DX', 'SP', 'BP', 'SI', 'DI']:
             return TokenType.REG16BIT
+
+        if text in ['ES', 'CS', 'SS', 'DS']:
+            return TokenType.SEGREG
         
         return None
 
+    # Checks if the given text is a word of a memory operand (byte, word, ptr)
+    def _checkIfOperandWord(self, text):
+        text = text.upper()
+        for kind in TokenType:
+            if text == kind.name and TokenType.isOperandWord(kind):
+                return kind
+        return None
+
     # Each call returns the next token in the sequence
     def getNextToken(self):
         self._skipSpaces()
@@ -115,12 +244,18 @@ class Lexer:
             token = Token(TokenType.LEFT_BRACE, self.curChar)
         elif self.curChar == ']':
             token = Token(TokenType.RIGHT_BRACE, self.curChar)
+        elif self.curChar == ':':
+            token = Token(TokenType.COLON, self.curChar)
+        elif self.curChar == '+':
+            token = Token(TokenType.PLUS, self.curChar)
+        elif self.curChar == '-':
+            token = Token(TokenType.MINUS, self.curChar)
         
         # handle alphanumeric instances
-        elif self.curChar.isalpha():
+        elif self.curChar.isalpha() or self.curChar == '_':
             startPos = self.curPos
 
-            while self._peek().isalpha():
+            while self._peek().isalnum() or self._peek() == '_':
                 self._nextChar()
             
             text = self.source[startPos: self.curPos + 1]
@@ -130,13 +265,13 @@ class Lexer:
             if kind is not None:
                 token = Token(kind, text)
             else:
-                kind = self._checkIfRegister(text) 
+                kind = self._checkIfRegister(text) or self._checkIfOperandWord(text)
 
-                # kind is a register
+                # kind is a register or a word of a memory operand
                 if kind is not None:
                     token = Token(kind, text)
                 else:
-                    pass # Later add support for label identifiers
+                    token = Token(TokenType.LABEL, text)
 
         # handle numbers
         elif self.curChar.isdigit():
@@ -145,20 +280,175 @@ class Lexer:
             while self._peek().isdigit():
                 self._nextChar()
             
-            if self._peek() == '\n':
-                token = Token(TokenType.DEC_NUMBER, self.source[startPos: self.curPos + 1])
-            elif self._peek() == 'h':
+            if self._peek() == 'h':
                 token = Token(TokenType.HEX_NUMBER, self.source[startPos: self.curPos + 1])
                 self._nextChar()
             elif self._peek() == 'b':
                 token = Token(TokenType.BIN_NUMBER, self.source[startPos: self.curPos + 1])
                 self._nextChar()
+            elif not self._peek().isalnum():
+                token = Token(TokenType.DEC_NUMBER, self.source[startPos: self.curPos + 1])
             else:
                 self._abort("Unexpected character at the end of number: (" + self.source[startPos: self.curPos + 1] + ")")
+            if self._peek().isalnum():
+                self._abort("Unexpected character at the end of number: (" + self.source[startPos: self.curPos + 2] + ")")
         
         else:
             self._abort("Unknown character: " + self.curChar)
 
         # Done with the current token, advance to the next character
         self._nextChar()     
-        return token
\ No newline at end of file
+        return token
+
+
+# Precomputed lookups used by the table driven lexer
+_KIND_BY_VALUE = {kind.value: kind for kind in TokenType}
+_WORD_KINDS = {kind.name: kind.value for kind in TokenType if TokenType.isKeyword(kind)}
+_WORD_KINDS.update({name: TokenType.REG8BIT.value for name in ('AL', 'AH', 'BL', 'BH', 'CL', 'CH', 'DL', 'DH')})
+_WORD_KINDS.update({name: TokenType.REG16BIT.value for name in ('AX', 'BX', 'CX', 'DX', 'SP', 'BP', 'SI', 'DI')})
+_WORD_KINDS.update({name: TokenType.SEGREG.value for name in ('ES', 'CS', 'SS', 'DS')})
+_WORD_KINDS.update({kind.name: kind.value for kind in TokenType if TokenType.isOperandWord(kind)})
+
+_SINGLE_CHAR_KINDS = {
+    '\n': TokenType.NEWLINE.value,
+    ',': TokenType.COMMA.value,
+    '[': TokenType.LEFT_BRACE.value,
+    ']': TokenType.RIGHT_BRACE.value,
+    ':': TokenType.COLON.value,
+    '+': TokenType.PLUS.value,
+    '-': TokenType.MINUS.value,
+}
+_NUMBER_SUFFIX_KINDS = {
+    'h': TokenType.HEX_NUMBER.value,
+    'b': TokenType.BIN_NUMBER.value,
+}
+
+# Kind value given to characters that do not start any token
+_ERROR_KIND = 0xFFFF
+
+# Number of suffix characters to drop from a token of each kind (the text of 10h is 10)
+_SUFFIX_LENGTHS = [0] * (max(_KIND_BY_VALUE) + 1)
+for _kind in _NUMBER_SUFFIX_KINDS.values():
+    _SUFFIX_LENGTHS[_kind] = 1
+
+# A lexeme is a single character token, a word, a number with its suffix or a single
+# character that does not start any token. Splitting the source on lexemes leaves only
+# whitespace between them, so the offsets follow from the lengths of the pieces
+_LEXEME_PATTERN = re.compile(r"([\n,\[\]:+-]|[A-Za-z_][A-Za-z0-9_]*|[0-9]+[hb]?(?![A-Za-z0-9])|[^ \t\r])")
+
+# Returns the kind value of a lexeme
+def _classifyLexeme(lexeme):
+    if lexeme in _SINGLE_CHAR_KINDS:
+        return _SINGLE_CHAR_KINDS[lexeme]
+    if lexeme[0].isalpha() or lexeme[0] == '_':
+        return _WORD_KINDS.get(lexeme.upper(), TokenType.LABEL.value)
+    if lexeme[0].isdigit():
+        return _NUMBER_SUFFIX_KINDS.get(lexeme[-1], TokenType.DEC_NUMBER.value)
+    return _ERROR_KIND
+
+# Caches the kind of every distinct lexeme, so each one is classified only once
+class _LexemeKinds(dict):
+    def __missing__(self, lexeme):
+        kind = _classifyLexeme(lexeme)
+        self[lexeme] = kind
+        return kind
+
+###########################################################################
+# TokenStream - the tokens of a whole source as parallel arrays of
+# kind values and start/end offsets into the source
+###########################################################################
+class TokenStream:
+    def __init__(self, source, kinds, starts, ends):
+        self.source = source
+        self.kinds = kinds
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def kind(self, index):
+        return _KIND_BY_VALUE[self.kinds[index]]
+
+    def text(self, index):
+        return self.source[self.starts[index]:self.ends[index]]
+
+    # Builds a Token like the ones Lexer returns (Lexer gives the EOF token a '\0' text)
+    def token(self, index):
+        kind = self.kind(index)
+        if kind is TokenType.EOF:
+            return Token(kind, '\0')
+        return Token(kind, self.text(index))
+
+# Tokenizes the whole source in one pass. The per token work (matching, kind lookup and
+# offsets) is done by map over the regex results, only distinct lexemes reach Python code
+def tokenize(source):
+    # like Lexer, a null character ends the source
+    end = source.find('\0')
+    if end != -1:
+        source = source[:end]
+
+    # whitespace, lexeme, whitespace, lexeme, ..., trailing whitespace
+    pieces = _LEXEME_PATTERN.split(source)
+    lexemes = pieces[1::2]
+    kinds = array('H', map(_LexemeKinds().__getitem__, lexemes))
+    if _ERROR_KIND in kinds:
+        sys.exit("Error in lexer: Unknown character: " + lexemes[kinds.index(_ERROR_KIND)])
+
+    pieceEnds = array('I', accumulate(map(len, pieces)))
+    starts = pieceEnds[0:-1:2]
+    ends = array('I', map(sub, pieceEnds[1::2], map(_SUFFIX_LENGTHS.__getitem__, kinds)))
+
+    kinds.append(TokenType.EOF.value)
+    starts.append(len(source))
+    ends.append(len(source))
+    return TokenStream(source, kinds, starts, ends)
+
+###########################################################################
+# StreamLexer - serves a TokenStream through the getNextToken interface
+# of Lexer so the parser can consume a pre-tokenized source
+###########################################################################
+class StreamLexer:
+    def __init__(self, source):
+        self.stream = tokenize(source)
+        self._index = 0
+
+    def getNextToken(self):
+        index = self._index
+        if index < len(self.stream) - 1:
+            self._index = index + 1
+        return self.stream.token(index)
+
+# Lines tokenized together by iterTokens
+DEFAULT_TOKEN_BATCH_LINES = 1024
+
+# Tokenizes a source given as an iterable of lines (like an open file) and yields Tokens.
+# Lines are tokenized in batches, so memory use depends on the batch size and not on the source size
+def iterTokens(lines, batchLines=DEFAULT_TOKEN_BATCH_LINES):
+    batch = []
+    for line in lines:
+        batch.append(line if line.endswith('\n') else line + '\n')
+        if len(batch) >= batchLines:
+            yield from _batchTokens(''.join(batch))
+            batch = []
+    if batch:
+        yield from _batchTokens(''.join(batch))
+    yield Token(TokenType.EOF, '\0')
+
+# Yields the tokens of a batch of whole lines, without its EOF token
+def _batchTokens(text):
+    stream = tokenize(text)
+    for index in range(len(stream) - 1):
+        yield stream.token(index)
+
+###########################################################################
+# IteratorLexer - serves tokens from an iterator (like iterTokens) through
+# the getNextToken interface of Lexer, the EOF token repeats at the end
+###########################################################################
+class IteratorLexer:
+    def __init__(self, tokens):
+        self._tokens = iter(tokens)
+        self._eof = Token(TokenType.EOF, '\0')
+
+    def getNextToken(self):
+        return next(self._tokens, self._eof)
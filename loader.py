@@ -0,0 +1,34 @@
+from memory import MemoryException
+
+# Programs are loaded at the start of this segment by default
+DEFAULT_LOAD_SEGMENT = 0x1000
+
+#################################################################
+# Loader - places machine code images into memory and moves them
+# between memory and image files on disk
+#################################################################
+class Loader:
+    def __init__(self, memory):
+        self.memory = memory
+
+    # Copies the image into memory at segment:offset and returns its physical address
+    def loadImage(self, image, segment=DEFAULT_LOAD_SEGMENT, offset=0):
+        address = (segment << 4) + offset
+        if address + len(image) > len(self.memory):
+            raise MemoryException("Image does not fit in memory")
+        self.memory[address:address + len(image)] = image
+        return address
+
+    # Reads an image file and loads it into memory
+    def loadFile(self, path, segment=DEFAULT_LOAD_SEGMENT, offset=0):
+        return self.loadImage(Loader.readImage(path), segment, offset)
+
+    @staticmethod
+    def readImage(path):
+        with open(path, 'rb') as imageFile:
+            return imageFile.read()
+
+    @staticmethod
+    def saveImage(path, image):
+        with open(path, 'wb') as imageFile:
+            imageFile.write(image)
@@ -1,22 +1,140 @@
+import argparse
 import sys
 from lex import *
-from parse import Parser
-from emit import Emitter
+from assembler import assemble, assembleCached, assembleStream
+from asmcache import AssemblyCache, DEFAULT_CACHE_DIR
 from cpu import CPU8086
+from memory import Memory
+from loader import Loader
+from jit import DEFAULT_THRESHOLD
+from trace import Tracer, TraceMode, TRACE_FORMATS
+from profiler import Profiler, REPORT_FORMATS
+from scheduler import ProgrammableIntervalTimer, CPU_CLOCK_HZ
+from debugger import Debugger, DebuggerShell, SourceMap
+
+def parseArguments():
+    argParser = argparse.ArgumentParser(description="8086 CPU simulator")
+    argParser.add_argument('source', help="assembly source file")
+    argParser.add_argument('--verbose', action='store_true',
+        help="print the grammar rules, the opcode script and the state after every instruction")
+    argParser.add_argument('--trace', metavar='FILE', help="write an execution trace to FILE")
+    argParser.add_argument('--trace-format', choices=sorted(TRACE_FORMATS), default='ndjson')
+    argParser.add_argument('--trace-mode', choices=[mode.name.lower() for mode in TraceMode], default='registers')
+    argParser.add_argument('--snapshot-interval', type=int, default=1000,
+        help="instructions between snapshots in snapshots trace mode")
+    argParser.add_argument('--no-cache', action='store_true', help="always assemble the source, bypassing the assembly cache")
+    argParser.add_argument('--clear-cache', action='store_true', help="remove every cached assembled program first")
+    argParser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    argParser.add_argument('--stream', action='store_true',
+        help="assemble the source line by line and run every instruction as soon as it is assembled")
+    argParser.add_argument('--jit', action='store_true', help="compile hot basic blocks into Python functions")
+    argParser.add_argument('--jit-threshold', type=int, default=DEFAULT_THRESHOLD,
+        help="executions of an address before a block is compiled there")
+    argParser.add_argument('--profile', metavar='FILE', help="profile the run and write the report to FILE")
+    argParser.add_argument('--profile-format', choices=sorted(REPORT_FORMATS), default='text',
+        help="a flat text report or collapsed stacks for flamegraph tools")
+    argParser.add_argument('--debug', action='store_true',
+        help="load the program and start the interactive debugger (not with --stream)")
+    argParser.add_argument('--timing', action='store_true',
+        help="count clocks with the 8086 timing tables and run timed events, instead of fast-forwarding")
+    argParser.add_argument('--max-cycles', type=int, help="stop a timed run after this many clocks")
+    argParser.add_argument('--pit', metavar='DIVISOR', type=int,
+        help="start the interval timer with DIVISOR, it raises interrupt 8 (implies --timing)")
+    argParser.add_argument('--ram-image', metavar='FILE', help="map FILE as the 1 MiB RAM instead of starting zeroed")
+    argParser.add_argument('--persist-ram', action='store_true', help="write changes to the memory back to the RAM image")
+    argParser.add_argument('--load', metavar='ADDR:FILE', action='append', default=[], type=parseLoadArgument,
+        help="copy FILE into memory at the physical address ADDR before running, may be repeated")
+    return argParser.parse_args()
+
+# Splits an ADDR:FILE argument, the address is a Python integer literal like 0xF0000
+def parseLoadArgument(text):
+    address, separator, path = text.partition(':')
+    try:
+        return int(address, 0), path
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected ADDR:FILE, got " + text)
+
+# Yields the machine code of the source file statement by statement, the file is read lazily
+def streamProgram(path, verbose):
+    with open(path, 'r') as inputFile:
+        for scriptLine, code in assembleStream(inputFile, verbose):
+            if verbose:
+                print(scriptLine)
+            yield code
 
 def main():
-    with open(sys.argv[1], 'r') as inputFile:
-        program = inputFile.read()
+    args = parseArguments()
+    if args.debug and args.stream:
+        sys.exit("--debug needs the whole program, it cannot be combined with --stream")
+
+    if not args.stream:
+        with open(args.source, 'r') as inputFile:
+            program = inputFile.read()
+
+        cache = AssemblyCache(args.cache_dir)
+        if args.clear_cache:
+            cache.clear()
+
+        # verbose runs print the opcode script, so they always assemble
+        if args.no_cache or args.verbose:
+            emitter = assemble(program, args.verbose)
+            if args.verbose:
+                print(emitter.getProgramScript())
+            image = emitter.getMachineCode()
+        else:
+            image = assembleCached(program, cache)
+
+    memory = Memory.fromImageFile(args.ram_image, args.persist_ram) if args.ram_image else Memory()
+    loader = Loader(memory)
+    for address, path in args.load:
+        loader.loadFile(path, address >> 4, address & 0xF)
+
+    cpu = CPU8086(memory)
+    if args.jit:
+        cpu.enableJit(args.jit_threshold)
+    if args.trace:
+        sink = TRACE_FORMATS[args.trace_format](args.trace)
+        cpu.tracer = Tracer(sink, TraceMode[args.trace_mode.upper()], args.snapshot_interval)
+    if args.profile:
+        cpu.profiler = Profiler()
+    timed = args.timing or args.pit is not None or args.max_cycles is not None
+    if timed:
+        cpu.enableTiming()
+    if args.pit is not None:
+        ProgrammableIntervalTimer(cpu, args.pit).start()
 
-    lexer = Lexer(program)
-    emitter = Emitter()
-    parser = Parser(lexer, emitter)
-    parser.program()
-    program = emitter.getProgramScript()
-    print(program)
+    if args.debug:
+        cpu.loadProgram(image)
+        DebuggerShell(Debugger(cpu, SourceMap(program))).cmdloop()
+        cpu.printState()
+    elif args.stream:
+        cpu.runStream(streamProgram(args.source, args.verbose))
+        cpu.printState()
+    elif args.verbose:
+        cpu.loadProgram(image)
+        while not cpu.halted:
+            cpu.step()
+            if not cpu.halted:
+                cpu.printState()
+    elif args.max_cycles is not None:
+        cpu.loadProgram(image)
+        cpu.runFor(args.max_cycles)
+        cpu.printState()
+    else:
+        cpu.loadProgram(image)
+        cpu.run()
+        cpu.printState()
+    if timed:
+        print("cycles: %d (%.3f ms at %.2f MHz)" % (cpu.cycles, cpu.cycles * 1e3 / CPU_CLOCK_HZ, CPU_CLOCK_HZ / 1e6))
+    if args.jit and args.verbose:
+        print("jit: " + ", ".join("%s: %d" % item for item in cpu.jit.stats().items()))
 
-    cpu = CPU8086()
-    cpu.runProgram(program.split('\n'))
+    if cpu.tracer is not None:
+        cpu.tracer.close()
+    if cpu.profiler is not None:
+        cpu.profiler.detach()
+        cpu.profiler.writeReport(args.profile, args.profile_format)
+    memory.close()
 
 
     """
@@ -27,4 +145,4 @@ def main():
     """
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
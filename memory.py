@@ -1,4 +1,5 @@
-from registers import MP8BitRegister
+import mmap
+import os
 
 #################################################################
 # MemoryException - An exception that occured in memory
@@ -6,52 +7,324 @@ from registers import MP8BitRegister
 class MemoryException(Exception):
     pass
 
+# The size of the 8086 address space (20 address lines)
+MEMORY_SIZE = 0x100000
+
+# Writes are tracked per page of this size
+PAGE_SHIFT = 12
+PAGE_SIZE = 1 << PAGE_SHIFT
+
+# The interrupt vector table fills the first KiB of memory, vector n is the offset:segment pair at n * 4
+IVT_ADDRESS = 0
+IVT_ENTRIES = 256
+
+# Zero filled blocks by size, copying one is faster than allocating a fresh one on every clear.
+# Zero snapshots share their pages with it too, so restoring between snapshots taken after
+# different clears only copies the pages that really differ
+_zeroBlocks = {}
+
+# Returns the zero filled block of a size, every caller gets the same object
+def _zeroBlock(size):
+    zeros = _zeroBlocks.get(size)
+    if zeros is None:
+        zeros = _zeroBlocks[size] = bytes(size)
+    return zeros
+
+#################################################################
+# MemorySnapshot - the contents of a memory as a tuple of immutable
+# pages. A page that did not change between two snapshots is the
+# same object in both, so snapshots share their unchanged pages
+#################################################################
+class MemorySnapshot:
+    __slots__ = ('pages', 'size')
+
+    def __init__(self, pages, size):
+        self.pages = pages
+        self.size = size
+
+    # Returns a zero filled snapshot of a memory of the given size, every full page is the same object
+    # in all zero snapshots
+    @staticmethod
+    def zero(sizeInBytes):
+        pages = [_zeroBlock(PAGE_SIZE)] * (sizeInBytes >> PAGE_SHIFT)
+        if sizeInBytes % PAGE_SIZE:
+            pages.append(_zeroBlock(sizeInBytes % PAGE_SIZE))
+        return MemorySnapshot(tuple(pages), sizeInBytes)
+
+    def readByte(self, address):
+        return self.pages[address >> PAGE_SHIFT][address & (PAGE_SIZE - 1)]
+
+    def toBytes(self):
+        return b''.join(self.pages)
+
 #################################################################
 # Memory - A class used to represent a RAM memory device that
-# supports IO operations
+# supports IO operations. The whole address space is a single
+# bytearray, slices are handed out as zero-copy memoryviews.
+# Listeners can watch pages and get notified on writes to them.
+# Snapshots are copy-on-write: the memory remembers the snapshot it
+# last matched and the pages written since, only those pages are
+# copied by the next snapshot.
+# The storage is a bytearray, or an mmap of a RAM image file (see
+# fromImageFile) that is paged in lazily by the operating system
 #################################################################
 class Memory:
-    def __init__(self, sizeInBytes):
-        self._ram = [MP8BitRegister() for i in range(sizeInBytes)]
+    def __init__(self, sizeInBytes=MEMORY_SIZE, backing=None):
+        self._ram = bytearray(sizeInBytes) if backing is None else backing
+        self._view = memoryview(self._ram)
+        sizeInBytes = len(self._ram)
 
-    def _getValueOfMultipleCells(self, cells):
-        binStr = ''
-        for cell in cells:
-            binStr += str(format(cell, '08b'))
-        return int(binStr, 2)
+        # number of listeners watching each page, and the listeners themselves.
+        # A clean page counts as watched too, so the first write to it is seen by _notifyWrite
+        self._watchedPages = bytearray((sizeInBytes + PAGE_SIZE - 1) >> PAGE_SHIFT)
+        self._pageWatchers = {}
+
+        # the snapshot the memory matched last, the pages not written since and the written pages
+        self._base = None
+        self._cleanPages = None
+        self._dirtyPages = []
+        if backing is None:
+            self._resetTracking(MemorySnapshot.zero(sizeInBytes))
+        else:
+            # the contents of an image are unknown until the first snapshot copies them
+            self._markAllDirty()
+
+    # Maps a RAM image file as the memory. With persist the writes go back to the file, which is
+    # extended to the memory size when it is shorter. Otherwise the file is mapped copy-on-write and
+    # never changes; an image shorter than the memory cannot be mapped that way and is read into
+    # anonymous memory instead
+    @staticmethod
+    def fromImageFile(path, persist=False, sizeInBytes=MEMORY_SIZE):
+        with open(path, 'r+b' if persist else 'rb') as imageFile:
+            fileSize = os.fstat(imageFile.fileno()).st_size
+            if fileSize > sizeInBytes:
+                raise MemoryException("RAM image %s is larger than the memory" % path)
+            if persist:
+                if fileSize < sizeInBytes:
+                    imageFile.truncate(sizeInBytes)
+                backing = mmap.mmap(imageFile.fileno(), sizeInBytes, access=mmap.ACCESS_WRITE)
+            elif fileSize == sizeInBytes:
+                backing = mmap.mmap(imageFile.fileno(), sizeInBytes, access=mmap.ACCESS_COPY)
+            else:
+                backing = mmap.mmap(-1, sizeInBytes)
+                with memoryview(backing) as view:
+                    imageFile.readinto(view[:fileSize])
+        return Memory(backing=backing)
+
+    # Writes the changes of a persistent RAM image back to its file
+    def flush(self):
+        if isinstance(self._ram, mmap.mmap):
+            self._ram.flush()
+
+    # Flushes and unmaps a RAM image, the memory cannot be used afterwards
+    def close(self):
+        if isinstance(self._ram, mmap.mmap):
+            self._ram.flush()
+            self._view.release()
+            self._ram.close()
+
+    # Marks every page clean with respect to the given snapshot
+    def _resetTracking(self, snapshot):
+        self._base = snapshot
+        self._cleanPages = bytearray(b'\x01' * len(self._watchedPages))
+        self._dirtyPages = []
+        watched = self._watchedPages
+        watched[:] = self._cleanPages
+        for page, watchers in self._pageWatchers.items():
+            watched[page] += len(watchers)
+
+    # Marks every page written, the next snapshot copies the whole memory
+    def _markAllDirty(self):
+        self._base = None
+        self._cleanPages = bytearray(len(self._watchedPages))
+        self._dirtyPages = list(range(len(self._watchedPages)))
+        watched = self._watchedPages
+        watched[:] = self._cleanPages
+        for page, watchers in self._pageWatchers.items():
+            watched[page] = len(watchers)
+
+    # Calls listener(start, stop) after every write that touches a page overlapping [start, stop)
+    def watchPages(self, start, stop, listener):
+        for page in range(start >> PAGE_SHIFT, ((stop - 1) >> PAGE_SHIFT) + 1):
+            watchers = self._pageWatchers.setdefault(page, [])
+            if listener not in watchers:
+                watchers.append(listener)
+                self._watchedPages[page] = len(watchers) + self._cleanPages[page]
+
+    # Stops notifying the listener about writes to any page
+    def unwatchPages(self, listener):
+        for page, watchers in list(self._pageWatchers.items()):
+            if listener in watchers:
+                watchers.remove(listener)
+                self._watchedPages[page] = len(watchers) + self._cleanPages[page]
+                if not watchers:
+                    del self._pageWatchers[page]
+
+    # Notifies the listeners of every watched page in the written range
+    def _notifyWrite(self, start, stop):
+        notified = []
+        clean = self._cleanPages
+        for page in range(start >> PAGE_SHIFT, ((stop - 1) >> PAGE_SHIFT) + 1):
+            if clean[page]:
+                # first write since the last snapshot, later writes to the page take the fast path
+                clean[page] = 0
+                self._watchedPages[page] -= 1
+                self._dirtyPages.append(page)
+            for listener in self._pageWatchers.get(page, ()):
+                if listener not in notified:
+                    notified.append(listener)
+        for listener in notified:
+            listener(start, stop)
 
     # Checks if the given index is a legal index in memory
     def _isWithinRange(self, index):
         return index >= 0 and index < len(self._ram)
 
+    # Checks that a slice is legal and returns its bounds
+    def _sliceBounds(self, index):
+        start = 0 if index.start is None else index.start
+        stop = len(self._ram) if index.stop is None else index.stop
+        if index.step not in (None, 1) or start > stop or not self._isWithinRange(start) or stop > len(self._ram):
+            raise MemoryException("Trying to access illegal memory location")
+        return start, stop
+
+    # Zeroes the whole memory, watchers of written pages are notified
+    def clear(self):
+        size = len(self._ram)
+        self[0:size] = _zeroBlock(size)
+        self._resetTracking(MemorySnapshot.zero(size))
+
+    # Returns a snapshot of the whole memory. Only the pages written since the last snapshot
+    # or restore are copied, every other page is shared with that snapshot
+    def snapshot(self):
+        view = self._view
+        pages = list(self._base.pages) if self._base is not None else [None] * len(self._watchedPages)
+        for page in self._dirtyPages:
+            start = page << PAGE_SHIFT
+            pages[page] = bytes(view[start:start + PAGE_SIZE])
+        snapshot = MemorySnapshot(tuple(pages), len(self._ram))
+        self._markClean(snapshot)
+        return snapshot
+
+    # Returns the memory to the contents of a snapshot. Only the pages written since the last
+    # snapshot or restore and the pages that differ between the two snapshots are copied,
+    # watchers see the copied pages as writes
+    def restore(self, snapshot):
+        if snapshot.size != len(self._ram):
+            raise MemoryException("Snapshot of a %d byte memory cannot be restored into %d bytes" % (snapshot.size, len(self._ram)))
+        changed = set(self._dirtyPages)
+        if self._base is not None:
+            basePages = self._base.pages
+            changed.update(page for page, content in enumerate(snapshot.pages) if content is not basePages[page])
+
+        view = self._view
+        for page in sorted(changed):
+            start = page << PAGE_SHIFT
+            content = snapshot.pages[page]
+            view[start:start + len(content)] = content
+            if self._pageWatchers.get(page):
+                self._notifyWrite(start, start + len(content))
+        self._markClean(snapshot)
+
+    # Marks the written pages clean again, the memory now matches the snapshot
+    def _markClean(self, snapshot):
+        clean = self._cleanPages
+        watched = self._watchedPages
+        for page in self._dirtyPages:
+            if not clean[page]:
+                clean[page] = 1
+                watched[page] += 1
+        self._dirtyPages = []
+        self._base = snapshot
+
     # Returns the length of the memory in bytes
     def __len__(self):
         return len(self._ram)
 
-    # Get the value bits of a specific cell or slice of cells
-    def __getitem__(self, index):
-        isSlice = isinstance(index, slice)
+    # Reads a single byte
+    def readByte(self, address):
+        try:
+            return self._ram[address]
+        except IndexError:
+            raise MemoryException("Trying to access illegal memory location")
 
-        # Check that index is legal
-        if isSlice:
-            isLegalIndex = self._isWithinRange(index.start) and self._isWithinRange(index.stop)
-        else:
-            isLegalIndex = self._isWithinRange(index)
+    # Writes a single byte
+    def writeByte(self, address, value):
+        try:
+            self._ram[address] = value & 0xFF
+        except IndexError:
+            raise MemoryException("Trying to access illegal memory location")
+        if self._watchedPages[address >> PAGE_SHIFT]:
+            self._notifyWrite(address, address + 1)
+
+    # Reads a little endian word
+    def readWord(self, address):
+        ram = self._ram
+        try:
+            return ram[address] | (ram[address + 1] << 8)
+        except IndexError:
+            raise MemoryException("Trying to access illegal memory location")
 
-        if not isLegalIndex:
+    # Writes a little endian word
+    def writeWord(self, address, value):
+        ram = self._ram
+        try:
+            ram[address + 1] = (value >> 8) & 0xFF
+            ram[address] = value & 0xFF
+        except IndexError:
             raise MemoryException("Trying to access illegal memory location")
-        
-        # Retrieve the appropriate value
-        value = self._ram[index].get_value_bits()
-        if isSlice:
-            value = self._getValueOfMultipleCells(value)
-        return value
+        watched = self._watchedPages
+        if watched[address >> PAGE_SHIFT] or watched[(address + 1) >> PAGE_SHIFT]:
+            self._notifyWrite(address, address + 2)
+
+    # Copies length bytes from source to dest in one slice assignment. Overlapping ranges are
+    # copied like memmove, as if the source was read completely before the first write
+    def copyBlock(self, dest, source, length):
+        self[dest:dest + length] = self._view[source:source + length]
+
+    # Fills length bytes at the address with the pattern repeated, the last repetition may be cut short
+    def fillBlock(self, address, pattern, length):
+        pattern = bytes(pattern)
+        self[address:address + length] = (pattern * (length // len(pattern) + 1))[:length]
+
+    # Returns the (segment, offset) of the handler of an interrupt vector
+    def getInterruptVector(self, vector):
+        address = IVT_ADDRESS + (vector % IVT_ENTRIES) * 4
+        return self.readWord(address + 2), self.readWord(address)
+
+    # Points an interrupt vector at a handler
+    def setInterruptVector(self, vector, segment, offset):
+        address = IVT_ADDRESS + (vector % IVT_ENTRIES) * 4
+        self.writeWord(address, offset)
+        self.writeWord(address + 2, segment)
+
+    # Get the value of a specific cell, or a zero-copy view of a slice of cells
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop = self._sliceBounds(index)
+            return self._view[start:stop]
+
+        if not self._isWithinRange(index):
+            raise MemoryException("Trying to access illegal memory location")
+        return self._ram[index]
     
-    # Set the value bits of a specific cell or slice of cells
-    def __setitem__(self, index, value_bits):
-        self._ram[index].set_value_bits(value_bits)
+    # Set the value of a specific cell, or copy a bytes-like object into a slice of cells
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            start, stop = self._sliceBounds(index)
+            if len(value) != stop - start:
+                raise MemoryException("Slice assignment must not change the size of memory")
+            self._view[start:stop] = value
+            if start < stop and any(self._watchedPages[start >> PAGE_SHIFT:((stop - 1) >> PAGE_SHIFT) + 1]):
+                self._notifyWrite(start, stop)
+            return
+
+        if not self._isWithinRange(index):
+            raise MemoryException("Trying to access illegal memory location")
+        self.writeByte(index, value)
 
 
 if __name__ == "__main__":
-    m = Memory(4096)
-    print(m[0:2])
\ No newline at end of file
+    m = Memory()
+    m.writeWord(0, 0x1234)
+    print(hex(m.readWord(0)), bytes(m[0:2]))
@@ -4,10 +4,75 @@ class RegType(Enum):
     REG8BIT = 0
     REG16BIT = 1
     MEMORY = 2
+    SEGMENT = 3
 
 class OperandType(Enum):
     REGISTER = 0
     DEC_NUMBER = 1
     HEX_NUMBER = 2
     BIN_NUMBER = 3
-    MEMORY_ADDRESS = 4
\ No newline at end of file
+    MEMORY_ADDRESS = 4
+    LABEL = 5
+
+# Register numbers used in the reg and r/m fields of the ModR/M byte
+REG16_CODES = {'ax': 0, 'cx': 1, 'dx': 2, 'bx': 3, 'sp': 4, 'bp': 5, 'si': 6, 'di': 7}
+REG8_CODES = {'al': 0, 'cl': 1, 'dl': 2, 'bl': 3, 'ah': 4, 'ch': 5, 'dh': 6, 'bh': 7}
+SEGMENT_CODES = {'es': 0, 'cs': 1, 'ss': 2, 'ds': 3}
+
+# The registers an effective address adds, at most one of each kind
+BASE_REGISTERS = ('bx', 'bp')
+INDEX_REGISTERS = ('si', 'di')
+
+# The r/m field of the ModR/M byte for the registers of an effective address (mod 00-10)
+# Format: (base register name or None, index register name or None) : r/m
+ADDRESS_RM_CODES = {
+    ('bx', 'si'): 0,
+    ('bx', 'di'): 1,
+    ('bp', 'si'): 2,
+    ('bp', 'di'): 3,
+    (None, 'si'): 4,
+    (None, 'di'): 5,
+    ('bp', None): 6,
+    ('bx', None): 7,
+}
+
+# The operand widths a memory operand of the opcode script can name
+MEMORY_WIDTHS = {'byte': 8, 'word': 16}
+
+# A memory operand of the opcode script is a single part: the optional width and segment override
+# each followed by ':', then the registers and the displacement in hex joined by '+', like
+# word:es:bx+si+1a. A direct address is its displacement alone
+def formatMemoryOperand(width, segment, base, index, displacement):
+    terms = [name for name in (base, index) if name is not None]
+    displacement &= 0xFFFF
+    if displacement or not terms:
+        terms.append('%x' % displacement)
+    text = '+'.join(terms)
+    if segment is not None:
+        text = segment.lower() + ':' + text
+    if width is not None:
+        text = ('word:' if width == 16 else 'byte:') + text
+    return text
+
+# Splits a memory operand of the opcode script into (width or None, segment name or None, base name or None,
+# index name or None, displacement)
+def parseMemoryOperand(text):
+    prefixes = text.lower().split(':')
+    width = None
+    segment = None
+    for prefix in prefixes[:-1]:
+        if prefix in MEMORY_WIDTHS:
+            width = MEMORY_WIDTHS[prefix]
+        else:
+            segment = prefix
+    base = None
+    index = None
+    displacement = 0
+    for term in prefixes[-1].split('+'):
+        if term in BASE_REGISTERS:
+            base = term
+        elif term in INDEX_REGISTERS:
+            index = term
+        else:
+            displacement = int(term, 16)
+    return width, segment, base, index, displacement
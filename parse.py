@@ -1,11 +1,20 @@
 import sys
 from lex import TokenType
-from opcode_enums import RegType, OperandType
+from opcode_enums import RegType, OperandType, BASE_REGISTERS, INDEX_REGISTERS, formatMemoryOperand
+
+# The base of the text of every number token
+# Format: number token kind : base
+NUMBER_BASES = {
+    TokenType.HEX_NUMBER: 16,
+    TokenType.BIN_NUMBER: 2,
+    TokenType.DEC_NUMBER: 10,
+}
 
 class Parser:
-    def __init__(self, lexer, emitter):
+    def __init__(self, lexer, emitter, verbose=False):
         self.lexer = lexer
         self.emitter = emitter
+        self.verbose = verbose
         
         self.curToken = None
         self._nextToken()
@@ -27,13 +36,25 @@ class Parser:
     def _abort(self, message):
         sys.exit("Error in parsing. " + message)
 
+    # Prints the grammar rules as they are entered, only in verbose mode
+    def _log(self, rule):
+        if self.verbose:
+            print(rule)
+
     # program ::= {statement nl}
     def program(self):
-        print("PROGRAM")
+        for statement in self.statements():
+            pass
+
+    # Parses the program one statement at a time, yields after every statement.
+    # The emitter has ended the opcode of every statement followed by a newline
+    def statements(self):
+        self._log("PROGRAM")
         while not self._checkToken(TokenType.EOF):
             self.statement()
             if not self._checkToken(TokenType.EOF):
                 self.nl()
+            yield
 
     # nl ::= NEWLINE
     def nl(self):
@@ -44,25 +65,64 @@ class Parser:
         # end the currently generated opcode    
         self.emitter.endOpcode()
     
-    # statement ::= COMMAND singleOperand | COMMAND doubleOperands
+    # statement ::= LABEL ':' [command] | command
+    # command ::= COMMAND | PREFIX STRING | BRANCH LABEL | INT number | COMMAND singleOperand | COMMAND doubleOperands
     def statement(self):
-        print("STATEMENT")
+        self._log("STATEMENT")
+        if self._checkToken(TokenType.LABEL):
+            self.labelDefinition()
+            if self._checkToken(TokenType.NEWLINE) or self._checkToken(TokenType.EOF):
+                return
+        if TokenType.isPrefix(self.curToken):
+            self.prefix()
         self._matchCommand()
 
         # Add the command to the opcode
         self.emitter.addOpcodePart(self.curToken.text)
         
-        # Check if command requires single or double operands
-        if TokenType.isSingleOperand(self.curToken):
+        # Check if command requires no, single or double operands
+        if TokenType.isNoOperand(self.curToken):
+            self._nextToken()
+        elif TokenType.isBranch(self.curToken):
+            self._nextToken()
+            self.labelOperand()
+        elif self._checkToken(TokenType.INT):
+            self._nextToken()
+            self.number()
+        elif TokenType.isSingleOperand(self.curToken):
             self._nextToken()
             self.singleOperand()
         else:
             self._nextToken()
             self.doubleOperands()
     
-    # singleOpernad ::= REG8BIT | REG16BIT
+    # prefix ::= PREFIX, only a string command can follow it
+    def prefix(self):
+        self._log("PREFIX")
+        self.emitter.addOpcodePart(self.curToken.text)
+        self._nextToken()
+        if not TokenType.isString(self.curToken):
+            self._abort("Expected a string command after a repeat prefix. got: " + str(self.curToken.kind))
+
+    # labelDefinition ::= LABEL ':'
+    def labelDefinition(self):
+        self._log("LABEL")
+        self.emitter.defineLabel(self.curToken.text)
+        self._nextToken()
+        self._match(TokenType.COLON)
+
+    # labelOperand ::= LABEL
+    def labelOperand(self):
+        self._log("LABEL_OPERAND")
+        if not self._checkToken(TokenType.LABEL):
+            self._abort("Expected label. got: " + str(self.curToken.kind))
+        self.emitter.addOpcodePart(OperandType.LABEL.value)
+        self.emitter.addOpcodePart(self.curToken.text)
+        self._nextToken()
+
+    # singleOpernad ::= REG8BIT | REG16BIT | SEGREG | memory
     def singleOperand(self):
-        print("SINGLE_OPERAND")
+        self._log("SINGLE_OPERAND")
 
         if self._checkToken(TokenType.REG8BIT):
             # emit opcode
@@ -78,12 +138,33 @@ class Parser:
             self.emitter.addOpcodePart(self.curToken.text)
 
             self._nextToken()
+        elif self._checkToken(TokenType.SEGREG):
+            segment = self.curToken.text
+            self._nextToken()
+
+            # a segment override starts a memory operand
+            if self._checkToken(TokenType.COLON):
+                self.emitter.addOpcodePart(RegType.MEMORY.value)
+                self.emitter.addOpcodePart(OperandType.MEMORY_ADDRESS.value)
+                self.memory(segment)
+                return
+
+            # emit opcode
+            self.emitter.addOpcodePart(RegType.SEGMENT.value)
+            self.emitter.addOpcodePart(OperandType.REGISTER.value)
+            self.emitter.addOpcodePart(segment)
+        elif self._isMemoryStart():
+            # emit opcode
+            self.emitter.addOpcodePart(RegType.MEMORY.value)
+            self.emitter.addOpcodePart(OperandType.MEMORY_ADDRESS.value)
+
+            self.memory()
         else:
-            self._abort("Expected register. got: " + str(self.curToken.kind))
+            self._abort("Expected register or memory. got: " + str(self.curToken.kind))
     
-    # doubleOperands ::= REG8BIT, source8 | REG16BIT, source16 | memory
+    # doubleOperands ::= REG8BIT, source8 | REG16BIT, source16 | SEGREG, source16 | memory, memorySource
     def doubleOperands(self):
-        print("OPERANDS")
+        self._log("OPERANDS")
 
         # The destination is an 8 bit register
         if self._checkToken(TokenType.REG8BIT):
@@ -92,7 +173,7 @@ class Parser:
             self.emitter.addOpcodePart(self.curToken.text)
 
             self._nextToken()
-            self._nextToken()
+            self._match(TokenType.COMMA)
             self.source8()
         
         # The destination is a 16 bit register
@@ -104,17 +185,37 @@ class Parser:
             self._nextToken()
             self._match(TokenType.COMMA)
             self.source16()
-        elif self._checkToken(TokenType.LEFT_BRACE):
+
+        # The destination is a segment register, or memory with a segment override
+        elif self._checkToken(TokenType.SEGREG):
+            segment = self.curToken.text
+            self._nextToken()
+            if self._checkToken(TokenType.COLON):
+                self.emitter.addOpcodePart(RegType.MEMORY.value)
+                self.memory(segment)
+                self._match(TokenType.COMMA)
+                self.memorySource()
+                return
+
+            # emit opcode
+            self.emitter.addOpcodePart(RegType.SEGMENT.value)
+            self.emitter.addOpcodePart(segment)
+
+            self._match(TokenType.COMMA)
+            self.source16()
+        elif self._isMemoryStart():
             # emit opcode
             self.emitter.addOpcodePart(RegType.MEMORY.value)
 
             self.memory()
+            self._match(TokenType.COMMA)
+            self.memorySource()
         else:
             self._abort("Unexpected token at operands: " + str(self.curToken.kind))
 
-    # source8 ::= 8REG | numberSource
+    # source8 ::= 8REG | memory | number
     def source8(self):
-        print("SOURCE8")
+        self._log("SOURCE8")
 
         if self._checkToken(TokenType.REG8BIT):
             self.emitter.addOpcodePart(OperandType.REGISTER.value)
@@ -127,56 +228,129 @@ class Parser:
         else:
             self.numberSource()
 
-    # source16 ::= 16REG | numberSource
+    # source16 ::= 16REG | SEGREG | memory | number
     def source16(self):
-        print("SOURCE16")
+        self._log("SOURCE16")
 
         if self._checkToken(TokenType.REG16BIT):
             self.emitter.addOpcodePart(OperandType.REGISTER.value)
             self.emitter.addOpcodePart(self.curToken.text)
             self._nextToken()
+        elif self._checkToken(TokenType.SEGREG):
+            segment = self.curToken.text
+            self._nextToken()
+
+            # a segment override starts a memory operand
+            if self._checkToken(TokenType.COLON):
+                self.emitter.addOpcodePart(OperandType.MEMORY_ADDRESS.value)
+                self.memory(segment)
+                return
+            self.emitter.addOpcodePart(OperandType.REGISTER.value)
+            self.emitter.addOpcodePart(segment)
 
         # Check if it is an 8-bit instead of a 16-bit register
         elif self._checkToken(TokenType.REG8BIT):
             self._abort("Expected 16-bit register. got: " + str(self.curToken.text))
         else:
             self.numberSource()
-    
-    # memory ::= [HEX_NUMBER] (REG8 | REG16 | numberSource)-exactly one
-    def memory(self):
-        print("memory")
 
-        # [HEX_NUMBER]
-        self._match(TokenType.LEFT_BRACE)
-        self.emitter.addOpcodePart(self.curToken.text) # add the number
-        self._match(TokenType.HEX_NUMBER)
-        self._match(TokenType.RIGHT_BRACE)
-        self._nextToken()
+    # memorySource ::= REG8 | REG16 | SEGREG | number
+    def memorySource(self):
+        self._log("MEMORY_SOURCE")
 
-        if self._checkToken(TokenType.REG8BIT):
-            pass
-        elif self._checkToken(TokenType.REG16BIT):
-            pass
+        if self._checkToken(TokenType.REG8BIT) or self._checkToken(TokenType.REG16BIT) or self._checkToken(TokenType.SEGREG):
+            self.emitter.addOpcodePart(OperandType.REGISTER.value)
+            self.emitter.addOpcodePart(self.curToken.text)
+            self._nextToken()
+        elif self._isMemoryStart():
+            self._abort("An instruction cannot have two memory operands")
         else:
-            self.numberSource()
+            self.number()
 
-    # numberSource ::= number | [number]
+    # numberSource ::= number | memory
     def numberSource(self):
-        print("NUMBER_SOURCE")
+        self._log("NUMBER_SOURCE")
 
-        if self._checkToken(TokenType.LEFT_BRACE):
+        # a segment override starts a memory operand
+        if self._checkToken(TokenType.SEGREG):
+            segment = self.curToken.text
+            self._nextToken()
+            self.emitter.addOpcodePart(OperandType.MEMORY_ADDRESS.value)
+            self.memory(segment)
+        elif self._isMemoryStart():
             # emit opcode
             self.emitter.addOpcodePart(OperandType.MEMORY_ADDRESS.value)
 
-            self._nextToken()
-            self.number()
-            self._match(TokenType.RIGHT_BRACE)
+            self.memory()
         else:
             self.number()
-    
+
+    # Checks if the current token starts a memory operand, a segment override is handled by the caller
+    def _isMemoryStart(self):
+        return self._checkToken(TokenType.LEFT_BRACE) or TokenType.isOperandWord(self.curToken.kind)
+
+    # memory ::= [(BYTE | WORD) PTR] [SEGREG ':'] '[' [SEGREG ':'] address ']'
+    # address ::= term {('+' | '-') term}, term ::= BX | BP | SI | DI | number
+    # segment is the segment override already consumed by the caller, the current token is then its ':'.
+    # The operand is emitted as a single part, see opcode_enums.formatMemoryOperand
+    def memory(self, segment=None):
+        self._log("MEMORY")
+
+        width = None
+        if segment is None and (self._checkToken(TokenType.BYTE) or self._checkToken(TokenType.WORD)):
+            width = 8 if self._checkToken(TokenType.BYTE) else 16
+            self._nextToken()
+            self._match(TokenType.PTR)
+            if self._checkToken(TokenType.SEGREG):
+                segment = self.curToken.text
+                self._nextToken()
+        if segment is not None:
+            self._match(TokenType.COLON)
+
+        self._match(TokenType.LEFT_BRACE)
+        if self._checkToken(TokenType.SEGREG):
+            if segment is not None:
+                self._abort("Two segment overrides in a memory operand")
+            segment = self.curToken.text
+            self._nextToken()
+            self._match(TokenType.COLON)
+
+        base = None
+        index = None
+        displacement = 0
+        sign = 1
+        while True:
+            if self._checkToken(TokenType.REG16BIT):
+                name = self.curToken.text.lower()
+                if sign < 0:
+                    self._abort("A register cannot be subtracted in an address: " + name)
+                if name in BASE_REGISTERS and base is None:
+                    base = name
+                elif name in INDEX_REGISTERS and index is None:
+                    index = name
+                else:
+                    self._abort("Cannot address memory with register: " + name)
+                self._nextToken()
+            elif self._checkToken(TokenType.HEX_NUMBER) or self._checkToken(TokenType.BIN_NUMBER) or self._checkToken(TokenType.DEC_NUMBER):
+                displacement += sign * int(self.curToken.text, NUMBER_BASES[self.curToken.kind])
+                self._nextToken()
+            else:
+                self._abort("Expected a register or a number in an address. got: " + str(self.curToken.kind))
+
+            if self._checkToken(TokenType.PLUS):
+                sign = 1
+            elif self._checkToken(TokenType.MINUS):
+                sign = -1
+            else:
+                break
+            self._nextToken()
+        self._match(TokenType.RIGHT_BRACE)
+
+        self.emitter.addOpcodePart(formatMemoryOperand(width, segment, base, index, displacement))
+
     # number ::= HEX_NUMBER | BIN_NUMBER | DEC_NUMBER
     def number(self):
-        print("NUMBER")
+        self._log("NUMBER")
 
         if self._checkToken(TokenType.HEX_NUMBER):
             # emit opcode
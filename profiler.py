@@ -0,0 +1,144 @@
+# Memory accesses are counted per range of 1 << DEFAULT_RANGE_SHIFT bytes
+DEFAULT_RANGE_SHIFT = 8
+
+# Rows shown per table of the text report
+DEFAULT_REPORT_ROWS = 20
+
+# The memory methods counted while profiling
+# Format: (method name, bytes accessed, 0 for reads or 1 for writes)
+_MEMORY_ACCESSES = (
+    ('readByte', 1, 0),
+    ('readWord', 2, 0),
+    ('writeByte', 1, 1),
+    ('writeWord', 2, 1),
+)
+
+#####################################################################
+# Profiler - counts how often every instruction address runs and the
+# wall time spent in it, and how often every memory range is read and
+# written. Opcode totals are derived from the per address counters.
+# The profiler is opt-in: a CPU without one runs its usual loop, with
+# one it runs a loop that times every instruction
+#####################################################################
+class Profiler:
+    def __init__(self, rangeShift=DEFAULT_RANGE_SHIFT):
+        self.rangeShift = rangeShift
+        # instruction address -> [executions, seconds]
+        self.addresses = {}
+        # instruction address -> (mnemonic, opcode)
+        self.instructions = {}
+        # memory range number -> [reads, writes]
+        self.ranges = {}
+        # memory accesses are only counted while an instruction executes, not while one is decoded
+        self.counting = False
+        self._cpu = None
+
+    # Called by the CPU before it starts running. Memory accesses are counted by wrapping the
+    # memory methods, the decoded instructions are dropped so they bind to the wrappers
+    def attach(self, cpu):
+        if self._cpu is cpu:
+            return
+        self.detach()
+        self._cpu = cpu
+        memory = cpu.memory
+        for name, size, slot in _MEMORY_ACCESSES:
+            setattr(memory, name, self._countingAccess(getattr(memory, name), size, slot))
+        cpu.invalidateInstructions()
+
+    def detach(self):
+        if self._cpu is None:
+            return
+        memory = self._cpu.memory
+        for name, size, slot in _MEMORY_ACCESSES:
+            memory.__dict__.pop(name, None)
+        self._cpu.invalidateInstructions()
+        self._cpu = None
+
+    # Wraps a memory access method, slot 0 of a range counts reads and slot 1 counts writes
+    def _countingAccess(self, access, size, slot):
+        ranges = self.ranges
+        shift = self.rangeShift
+        def countingAccess(address, *value):
+            if not self.counting:
+                return access(address, *value)
+            for number in range(address >> shift, ((address + size - 1) >> shift) + 1):
+                counters = ranges.get(number)
+                if counters is None:
+                    counters = ranges[number] = [0, 0]
+                counters[slot] += 1
+            return access(address, *value)
+        return countingAccess
+
+    # Called by the CPU after every instruction with the time it took
+    def record(self, address, instruction, elapsed):
+        counters = self.addresses.get(address)
+        if counters is None:
+            counters = self.addresses[address] = [0, 0.0]
+            self.instructions[address] = (instruction.mnemonic, instruction.opcode)
+        counters[0] += 1
+        counters[1] += elapsed
+
+    # Returns [executions, seconds] per opcode as {(mnemonic, opcode): counters}
+    def opcodes(self):
+        totals = {}
+        for address, (count, seconds) in self.addresses.items():
+            key = self.instructions[address]
+            counters = totals.setdefault(key, [0, 0.0])
+            counters[0] += count
+            counters[1] += seconds
+        return totals
+
+    def clear(self):
+        self.addresses.clear()
+        self.instructions.clear()
+        self.ranges.clear()
+
+    ############################################################################
+    # Reports
+    ############################################################################
+
+    # Returns a flat text report: opcodes and addresses by time, memory ranges by accesses
+    def textReport(self, rows=DEFAULT_REPORT_ROWS):
+        totalCount = sum(count for count, seconds in self.addresses.values())
+        totalSeconds = sum(seconds for count, seconds in self.addresses.values()) or 1.0
+        lines = ["%d instructions in %.6fs" % (totalCount, totalSeconds), ""]
+
+        lines.append("%-14s %12s %12s %7s %10s" % ("opcode", "count", "seconds", "time%", "ns/instr"))
+        opcodes = sorted(self.opcodes().items(), key=lambda item: item[1][1], reverse=True)
+        for (mnemonic, opcode), (count, seconds) in opcodes[:rows]:
+            lines.append("%-14s %12d %12.6f %6.1f%% %10.0f" %
+                ("%s (%02x)" % (mnemonic, opcode), count, seconds, seconds * 100 / totalSeconds, seconds * 1e9 / count))
+        lines.append("")
+
+        lines.append("%-14s %12s %12s %7s %10s" % ("address", "count", "seconds", "time%", "ns/instr"))
+        addresses = sorted(self.addresses.items(), key=lambda item: item[1][1], reverse=True)
+        for address, (count, seconds) in addresses[:rows]:
+            lines.append("%05x %-8s %12d %12.6f %6.1f%% %10.0f" %
+                (address, self.instructions[address][0], count, seconds, seconds * 100 / totalSeconds, seconds * 1e9 / count))
+        lines.append("")
+
+        lines.append("%-14s %12s %12s" % ("memory range", "reads", "writes"))
+        ranges = sorted(self.ranges.items(), key=lambda item: sum(item[1]), reverse=True)
+        for number, (reads, writes) in ranges[:rows]:
+            start = number << self.rangeShift
+            lines.append("%05x-%05x    %12d %12d" % (start, start + (1 << self.rangeShift) - 1, reads, writes))
+        return '\n'.join(lines) + '\n'
+
+    # Returns the profile in the collapsed stack format of flamegraph tools: one
+    # "frame;frame;frame value" line per instruction address, the value is in microseconds
+    def collapsedStacks(self):
+        lines = []
+        for address, (count, seconds) in sorted(self.addresses.items()):
+            mnemonic = self.instructions[address][0]
+            lines.append("8086;%s;%05x %d" % (mnemonic, address, round(seconds * 1e6)))
+        return '\n'.join(lines) + '\n'
+
+    def writeReport(self, path, reportFormat='text'):
+        with open(path, 'w') as reportFile:
+            reportFile.write(REPORT_FORMATS[reportFormat](self))
+
+# Format: 'format name' : function producing the report of a profiler
+REPORT_FORMATS = {
+    'text': Profiler.textReport,
+    'collapsed': Profiler.collapsedStacks,
+}
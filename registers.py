@@ -1,14 +1,328 @@
 import math
 from abc import abstractclassmethod, ABC
+from alu import PARITY_TABLE
 
+#####################################################################
+# FlagsRegister - the status flags are evaluated lazily. Arithmetic
+# operations only record what they did in `pending` as
+# (operation, first operand, second operand, raw result, width, carry source)
+# and the six flags are computed the first time one of them is read.
+# The control flags (trap, interrupt, direction) are plain attributes
+#####################################################################
 class FlagsRegister:
+    # Operations that leave their flags pending. adc/sbb/neg/cmp are recorded as
+    # ADD/SUB with their raw result, and/or/xor/not as LOGIC
+    ADD = 0
+    SUB = 1
+    LOGIC = 2
+    INC = 3
+    DEC = 4
+
+    def __init__(self):
+        self._carry = False
+        self._auxiliary = False
+        self._parity = False
+        self._zero = False
+        self._sign = False
+        self._overflow = False
+        self.pending = None
+        self.trap = False
+        self.interrupt = False
+        self.direction = False
+
+    # Records an inc/dec. They leave the carry flag untouched, so the carry source
+    # is the carry of whatever operation came before them
+    def setPendingIncDec(self, operation, value, result, width):
+        pending = self.pending
+        if pending is None:
+            carrySource = self._carry
+        elif pending[0] >= FlagsRegister.INC:
+            carrySource = pending[5]
+        else:
+            carrySource = pending
+        self.pending = (operation, value, 1, result, width, carrySource)
+
+    # Computes the carry of a pending add/sub/logic operation
+    @staticmethod
+    def _pendingCarry(pending):
+        operation, a, b, result, width = pending[:5]
+        if operation == FlagsRegister.ADD:
+            return result > (0xFFFF if width == 16 else 0xFF)
+        if operation == FlagsRegister.SUB:
+            return result < 0
+        return False
+
+    # Computes all of the pending flags
+    def materialize(self):
+        pending = self.pending
+        if pending is None:
+            return
+        self.pending = None
+
+        operation, a, b, result, width, carrySource = pending
+        if width == 16:
+            mask, signBit = 0xFFFF, 0x8000
+        else:
+            mask, signBit = 0xFF, 0x80
+        value = result & mask
+
+        self._zero = value == 0
+        self._sign = (value & signBit) != 0
+        self._parity = PARITY_TABLE[value & 0xFF]
+
+        if operation == FlagsRegister.LOGIC:
+            self._auxiliary = False
+            self._overflow = False
+        else:
+            self._auxiliary = ((a ^ b ^ result) & 0x10) != 0
+            if operation == FlagsRegister.ADD or operation == FlagsRegister.INC:
+                self._overflow = ((a ^ value) & (b ^ value) & signBit) != 0
+            else:
+                self._overflow = ((a ^ b) & (a ^ value) & signBit) != 0
+
+        if operation <= FlagsRegister.LOGIC:
+            self._carry = FlagsRegister._pendingCarry(pending)
+        elif isinstance(carrySource, tuple):
+            self._carry = FlagsRegister._pendingCarry(carrySource)
+        else:
+            self._carry = carrySource
+
+    # Single flag tests for conditional jumps. They read the flag straight from a pending
+    # operation and leave it pending, the other flags are not computed
+    def testZero(self):
+        pending = self.pending
+        if pending is None:
+            return self._zero
+        return not pending[3] & (0xFFFF if pending[4] == 16 else 0xFF)
+
+    def testSign(self):
+        pending = self.pending
+        if pending is None:
+            return self._sign
+        return (pending[3] & (0x8000 if pending[4] == 16 else 0x80)) != 0
+
+    def testCarry(self):
+        pending = self.pending
+        if pending is None:
+            return self._carry
+        if pending[0] <= FlagsRegister.LOGIC:
+            return FlagsRegister._pendingCarry(pending)
+        carrySource = pending[5]
+        if isinstance(carrySource, tuple):
+            return FlagsRegister._pendingCarry(carrySource)
+        return carrySource
+
+    # Bit positions of the status flags in the FLAGS word
+    CARRY_BIT = 1 << 0
+    PARITY_BIT = 1 << 2
+    AUXILIARY_BIT = 1 << 4
+    ZERO_BIT = 1 << 6
+    SIGN_BIT = 1 << 7
+    OVERFLOW_BIT = 1 << 11
+
+    # Bit positions of the control flags in the FLAGS word
+    TRAP_BIT = 1 << 8
+    INTERRUPT_BIT = 1 << 9
+    DIRECTION_BIT = 1 << 10
+
+    # Returns the status and control flags packed as in the FLAGS word
+    def getWord(self):
+        self.materialize()
+        word = 0
+        if self._carry:
+            word |= FlagsRegister.CARRY_BIT
+        if self._parity:
+            word |= FlagsRegister.PARITY_BIT
+        if self._auxiliary:
+            word |= FlagsRegister.AUXILIARY_BIT
+        if self._zero:
+            word |= FlagsRegister.ZERO_BIT
+        if self._sign:
+            word |= FlagsRegister.SIGN_BIT
+        if self._overflow:
+            word |= FlagsRegister.OVERFLOW_BIT
+        if self.trap:
+            word |= FlagsRegister.TRAP_BIT
+        if self.interrupt:
+            word |= FlagsRegister.INTERRUPT_BIT
+        if self.direction:
+            word |= FlagsRegister.DIRECTION_BIT
+        return word
+
+    # Sets the status and control flags from a FLAGS word
+    def setWord(self, word):
+        self.pending = None
+        self._carry = (word & FlagsRegister.CARRY_BIT) != 0
+        self._parity = (word & FlagsRegister.PARITY_BIT) != 0
+        self._auxiliary = (word & FlagsRegister.AUXILIARY_BIT) != 0
+        self._zero = (word & FlagsRegister.ZERO_BIT) != 0
+        self._sign = (word & FlagsRegister.SIGN_BIT) != 0
+        self._overflow = (word & FlagsRegister.OVERFLOW_BIT) != 0
+        self.trap = (word & FlagsRegister.TRAP_BIT) != 0
+        self.interrupt = (word & FlagsRegister.INTERRUPT_BIT) != 0
+        self.direction = (word & FlagsRegister.DIRECTION_BIT) != 0
+
+    @property
+    def carry(self):
+        if self.pending is not None:
+            self.materialize()
+        return self._carry
+
+    @carry.setter
+    def carry(self, value):
+        self.materialize()
+        self._carry = value
+
+    @property
+    def auxiliary(self):
+        if self.pending is not None:
+            self.materialize()
+        return self._auxiliary
+
+    @auxiliary.setter
+    def auxiliary(self, value):
+        self.materialize()
+        self._auxiliary = value
+
+    @property
+    def parity(self):
+        if self.pending is not None:
+            self.materialize()
+        return self._parity
+
+    @parity.setter
+    def parity(self, value):
+        self.materialize()
+        self._parity = value
+
+    @property
+    def zero(self):
+        if self.pending is not None:
+            self.materialize()
+        return self._zero
+
+    @zero.setter
+    def zero(self, value):
+        self.materialize()
+        self._zero = value
+
+    @property
+    def sign(self):
+        if self.pending is not None:
+            self.materialize()
+        return self._sign
+
+    @sign.setter
+    def sign(self, value):
+        self.materialize()
+        self._sign = value
+
+    @property
+    def overflow(self):
+        if self.pending is not None:
+            self.materialize()
+        return self._overflow
+
+    @overflow.setter
+    def overflow(self, value):
+        self.materialize()
+        self._overflow = value
+
+# Converts an integer into a list of bits (most significant bit first)
+def toBits(value, width):
+    return [(value >> i) & 1 for i in range(width - 1, -1, -1)]
+
+# Converts a list of bits (most significant bit first) into an integer
+def fromBits(bits):
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+#####################################################################
+# RegisterFile - compact storage for the general purpose registers.
+# Every 16-bit register is kept as a plain int, the 8-bit halves are
+# read and written by masking and shifting the 16-bit value
+#####################################################################
+class RegisterFile:
+    # Index of each 16-bit register inside the file (8086 encoding order)
+    AX = 0
+    CX = 1
+    DX = 2
+    BX = 3
+    SP = 4
+    BP = 5
+    SI = 6
+    DI = 7
+
+    # Index of each segment register (8086 encoding order)
+    ES = 0
+    CS = 1
+    SS = 2
+    DS = 3
+
+    # Names of the registers in the order they are stored in words and segments
+    WORD_NAMES = ('ax', 'cx', 'dx', 'bx', 'sp', 'bp', 'si', 'di')
+    SEGMENT_NAMES = ('es', 'cs', 'ss', 'ds')
+
     def __init__(self):
-        self.carry = False
-        self.auxiliary = False
-        self.parity = False
-        self.zero = False
-        self.sign = False
-        self.overflow = False
+        # The lists are only ever updated in place so views can hold on to them
+        self.words = [0, 0, 0, 0, 0, 0, 0, 0]
+        self.segments = [0, 0, 0, 0]
+        self.ip = 0
+
+    def getWord(self, index):
+        return self.words[index]
+
+    def setWord(self, index, value):
+        self.words[index] = value & 0xFFFF
+
+    def getLow(self, index):
+        return self.words[index] & 0xFF
+
+    def setLow(self, index, value):
+        self.words[index] = (self.words[index] & 0xFF00) | (value & 0xFF)
+
+    def getHigh(self, index):
+        return self.words[index] >> 8
+
+    def setHigh(self, index, value):
+        self.words[index] = (self.words[index] & 0x00FF) | ((value & 0xFF) << 8)
+
+    # Zeroes every register, the lists keep their identity
+    def clear(self):
+        self.words[:] = [0, 0, 0, 0, 0, 0, 0, 0]
+        self.segments[:] = [0, 0, 0, 0]
+        self.ip = 0
+
+    # Returns the value of a 16-bit, segment or ip register given by its name
+    def getByName(self, name):
+        name = name.lower()
+        if name in RegisterFile.WORD_NAMES:
+            return self.words[RegisterFile.WORD_NAMES.index(name)]
+        if name in RegisterFile.SEGMENT_NAMES:
+            return self.segments[RegisterFile.SEGMENT_NAMES.index(name)]
+        if name == 'ip':
+            return self.ip
+        raise KeyError("Unknown register: " + name)
+
+    def setByName(self, name, value):
+        name = name.lower()
+        if name in RegisterFile.WORD_NAMES:
+            self.words[RegisterFile.WORD_NAMES.index(name)] = value & 0xFFFF
+        elif name in RegisterFile.SEGMENT_NAMES:
+            self.segments[RegisterFile.SEGMENT_NAMES.index(name)] = value & 0xFFFF
+        elif name == 'ip':
+            self.ip = value & 0xFFFF
+        else:
+            raise KeyError("Unknown register: " + name)
+
+    # Returns every register by name
+    def asDict(self):
+        values = dict(zip(RegisterFile.WORD_NAMES, self.words))
+        values.update(zip(RegisterFile.SEGMENT_NAMES, self.segments))
+        values['ip'] = self.ip
+        return values
 
 class MPRegister(ABC):
     def __init__(self, limitInBits):
@@ -16,31 +330,66 @@ class MPRegister(ABC):
     
     def limit(self):
         return self._limitInBits
-  
+
     @abstractclassmethod
-    def get_value_bits(self):
+    def get_value(self):
         pass
 
     @abstractclassmethod
-    def set_value_bits(self, bits):
+    def set_value(self, value):
         pass
 
+    # Compatibility layer - the value as a list of bits
+    def get_value_bits(self):
+        return toBits(self.get_value(), self._limitInBits)
+
+    # Compatibility layer - set the value from a list of bits
+    def set_value_bits(self, bits):
+        self.set_value(fromBits(bits))
+
+# A view of the lower or upper half of a 16-bit word. When no storage
+# is given the register owns a single word of its own
 class MP8BitRegister(MPRegister):
-    def __init__(self):
+    def __init__(self, words=None, index=0, shift=0):
         super().__init__(8)
-        self._bits = [0 for i in range(8)]
+        if words is None:
+            words = [0]
+        self._words = words
+        self._index = index
+        self._shift = shift
+        self._keepMask = 0xFFFF ^ (0xFF << shift)
 
-    def get_value_bits(self):
-        return self._bits
-    
-    def set_value_bits(self, bits):
-        self._bits = bits
+    def get_value(self):
+        return (self._words[self._index] >> self._shift) & 0xFF
+
+    def set_value(self, value):
+        words = self._words
+        index = self._index
+        words[index] = (words[index] & self._keepMask) | ((value & 0xFF) << self._shift)
+
+# A view of a segment register inside a register file
+class MPSegmentRegister(MPRegister):
+    def __init__(self, registerFile, index):
+        super().__init__(16)
+        self._segments = registerFile.segments
+        self._index = index
 
+    def get_value(self):
+        return self._segments[self._index]
+
+    def set_value(self, value):
+        self._segments[self._index] = value & 0xFFFF
+
+# A view of a 16-bit word inside a register file
 class MP16BitRegister(MPRegister):
-    def __init__(self):
+    def __init__(self, registerFile=None, index=0):
         super().__init__(16)
-        self._lower = MP8BitRegister()
-        self._upper = MP8BitRegister()
+        if registerFile is None:
+            registerFile = RegisterFile()
+        self._words = registerFile.words
+        self._index = index
+        self._lower = MP8BitRegister(self._words, index, 0)
+        self._upper = MP8BitRegister(self._words, index, 8)
 
     def __getitem__(self, identifier):
         if identifier == 'l':
@@ -51,12 +400,9 @@ class MP16BitRegister(MPRegister):
             return self
         else:
             raise Exception("Unknown identifier in register")
-    
-    def get_value_bits(self):
-        bits = self._upper.get_value_bits().copy()
-        bits.extend(self._lower.get_value_bits())
-        return bits
-    
-    def set_value_bits(self, bits):
-        self._upper.set_value_bits(bits[0:8])
-        self._lower.set_value_bits(bits[8:16])
\ No newline at end of file
+
+    def get_value(self):
+        return self._words[self._index]
+
+    def set_value(self, value):
+        self._words[self._index] = value & 0xFFFF
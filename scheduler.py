@@ -0,0 +1,113 @@
+import heapq
+
+# The clock of the original PC 8086 and of its 8253 timer, the timer counts once every 4 CPU clocks
+CPU_CLOCK_HZ = 4772727
+PIT_CLOCK_HZ = 1193182
+CYCLES_PER_PIT_COUNT = 4
+
+# The timer raises IRQ 0, which the PC maps to interrupt vector 8
+PIT_VECTOR = 8
+
+# A divisor of 65536 (written as 0 on the 8253) gives the 18.2 Hz tick of the PC
+DEFAULT_PIT_DIVISOR = 65536
+
+# The cycle reported as the next event when nothing is scheduled
+NEVER = 1 << 62
+
+#####################################################################
+# ScheduledEvent - a callback due at an absolute CPU cycle. A
+# cancelled event stays queued but is skipped when it comes due
+#####################################################################
+class ScheduledEvent:
+    __slots__ = ('cycle', 'callback', 'cancelled')
+
+    def __init__(self, cycle, callback):
+        self.cycle = cycle
+        self.callback = callback
+        self.cancelled = False
+
+#####################################################################
+# Scheduler - timed events ordered by the cycle they are due at. The
+# timed run loop of the CPU only compares its cycle counter with
+# nextCycle, so an idle scheduler costs one comparison per
+# instruction
+#####################################################################
+class Scheduler:
+    def __init__(self):
+        # heap of (cycle, sequence number, event), the sequence keeps events due at the same cycle in order
+        self._queue = []
+        self._sequence = 0
+        self.nextCycle = NEVER
+
+    def __len__(self):
+        return len(self._queue)
+
+    # Calls callback(cycle) once the CPU reached the cycle
+    def scheduleAt(self, cycle, callback):
+        event = ScheduledEvent(cycle, callback)
+        heapq.heappush(self._queue, (cycle, self._sequence, event))
+        self._sequence += 1
+        if cycle < self.nextCycle:
+            self.nextCycle = cycle
+        return event
+
+    def cancel(self, event):
+        event.cancelled = True
+
+    # Runs every event due at or before the cycle, events may schedule new ones
+    def runDue(self, cycle):
+        queue = self._queue
+        while queue and queue[0][0] <= cycle:
+            event = heapq.heappop(queue)[2]
+            if not event.cancelled:
+                event.callback(event.cycle)
+        self.nextCycle = queue[0][0] if queue else NEVER
+
+    # Drops every event, their owners see them as cancelled
+    def clear(self):
+        for cycle, sequence, event in self._queue:
+            event.cancelled = True
+        self._queue.clear()
+        self.nextCycle = NEVER
+
+#####################################################################
+# ProgrammableIntervalTimer - channel 0 of the 8253 in rate generator
+# mode. It requests its interrupt once every divisor timer counts,
+# the period is kept in CPU cycles so ticks never drift. The timer
+# is programmed through its methods, there are no I/O ports
+#####################################################################
+class ProgrammableIntervalTimer:
+    def __init__(self, cpu, divisor=DEFAULT_PIT_DIVISOR, vector=PIT_VECTOR):
+        self.cpu = cpu
+        self.vector = vector
+        self.ticks = 0
+        self._event = None
+        self.setDivisor(divisor)
+
+    # A divisor of 0 counts 65536 like the 8253
+    def setDivisor(self, divisor):
+        self.divisor = divisor or 65536
+        self.period = self.divisor * CYCLES_PER_PIT_COUNT
+
+    @property
+    def frequency(self):
+        return PIT_CLOCK_HZ / self.divisor
+
+    @property
+    def running(self):
+        return self._event is not None and not self._event.cancelled
+
+    # Starts counting from the current cycle of the CPU
+    def start(self):
+        self.stop()
+        self._event = self.cpu.scheduler.scheduleAt(self.cpu.cycles + self.period, self._tick)
+
+    def stop(self):
+        if self._event is not None:
+            self.cpu.scheduler.cancel(self._event)
+            self._event = None
+
+    def _tick(self, cycle):
+        self.ticks += 1
+        self._event = self.cpu.scheduler.scheduleAt(cycle + self.period, self._tick)
+        self.cpu.requestInterrupt(self.vector)
@@ -0,0 +1,812 @@
+from decoder import OperandKind, DecodeException, STRING_OPCODES
+from registers import FlagsRegister, RegisterFile
+from alu import ALU, ALUException
+
+ADD = FlagsRegister.ADD
+SUB = FlagsRegister.SUB
+LOGIC = FlagsRegister.LOGIC
+INC = FlagsRegister.INC
+DEC = FlagsRegister.DEC
+
+AX = RegisterFile.AX
+CX = RegisterFile.CX
+SP = RegisterFile.SP
+SI = RegisterFile.SI
+DI = RegisterFile.DI
+ES = RegisterFile.ES
+SS = RegisterFile.SS
+DS = RegisterFile.DS
+
+#####################################################################
+# Semantics - turns decoded instructions into execute functions.
+# Every function works directly on the register file and memory of
+# the CPU it was bound to, hot operand shapes get their own
+# specialized function
+#####################################################################
+
+# Builds the function returning the physical address of a memory operand. It is chosen once per
+# operand by the registers its addressing mode adds, so no function tests the mode when it runs
+def effectiveAddress(cpu, operand):
+    segments = cpu.regFile.segments
+    words = cpu.regFile.words
+    segment = operand.segment
+    displacement = operand.value
+    base = operand.base
+    index = operand.index
+    if base is None and index is None:
+        return lambda: ((segments[segment] << 4) + displacement) & 0xFFFFF
+    if base is None or index is None:
+        reg = index if base is None else base
+        return lambda: ((segments[segment] << 4) + ((words[reg] + displacement) & 0xFFFF)) & 0xFFFFF
+    return lambda: ((segments[segment] << 4) + ((words[base] + words[index] + displacement) & 0xFFFF)) & 0xFFFFF
+
+# Builds a function that returns the current value of the operand
+def operandReader(cpu, operand):
+    kind = operand.kind
+    if kind is OperandKind.REGISTER:
+        words = cpu.regFile.words
+        reg = operand.reg
+        if operand.width == 16:
+            return lambda: words[reg]
+        if reg < 4:
+            return lambda: words[reg] & 0xFF
+        reg -= 4
+        return lambda: words[reg] >> 8
+
+    if kind is OperandKind.IMMEDIATE:
+        value = operand.value
+        return lambda: value
+
+    if kind is OperandKind.MEMORY:
+        read = cpu.memory.readWord if operand.width == 16 else cpu.memory.readByte
+        # a direct address is computed inline, saving the call of an effective address function
+        if operand.base is None and operand.index is None:
+            segments = cpu.regFile.segments
+            segment = operand.segment
+            displacement = operand.value
+            return lambda: read(((segments[segment] << 4) + displacement) & 0xFFFFF)
+        address = effectiveAddress(cpu, operand)
+        return lambda: read(address())
+
+    if kind is OperandKind.SEGMENT:
+        segments = cpu.regFile.segments
+        reg = operand.reg
+        return lambda: segments[reg]
+
+    raise DecodeException("Cannot read operand of kind " + str(kind))
+
+# Builds a function that stores a value into the operand, the value is truncated to the operand width
+def operandWriter(cpu, operand):
+    kind = operand.kind
+    if kind is OperandKind.REGISTER:
+        words = cpu.regFile.words
+        reg = operand.reg
+        if operand.width == 16:
+            def writeWord(value):
+                words[reg] = value & 0xFFFF
+            return writeWord
+        if reg < 4:
+            def writeLow(value):
+                words[reg] = (words[reg] & 0xFF00) | (value & 0xFF)
+            return writeLow
+        high = reg - 4
+        def writeHigh(value):
+            words[high] = (words[high] & 0x00FF) | ((value & 0xFF) << 8)
+        return writeHigh
+
+    if kind is OperandKind.MEMORY:
+        write = cpu.memory.writeWord if operand.width == 16 else cpu.memory.writeByte
+        if operand.base is None and operand.index is None:
+            segments = cpu.regFile.segments
+            segment = operand.segment
+            displacement = operand.value
+            return lambda value: write(((segments[segment] << 4) + displacement) & 0xFFFFF, value)
+        address = effectiveAddress(cpu, operand)
+        return lambda value: write(address(), value)
+
+    if kind is OperandKind.SEGMENT:
+        segments = cpu.regFile.segments
+        reg = operand.reg
+        def writeSegment(value):
+            segments[reg] = value & 0xFFFF
+        return writeSegment
+
+    raise DecodeException("Cannot write operand of kind " + str(kind))
+
+def _isRegister16(operand):
+    return operand.kind is OperandKind.REGISTER and operand.width == 16
+
+############################################################################
+# Data transfer
+############################################################################
+
+def _bindMov(cpu, instruction):
+    dest, source = instruction.dest, instruction.source
+    words = cpu.regFile.words
+
+    # mov reg16, imm16 and mov reg16, reg16
+    if _isRegister16(dest):
+        reg = dest.reg
+        if source.kind is OperandKind.IMMEDIATE:
+            value = source.value
+            def movRegImmediate():
+                words[reg] = value
+            return movRegImmediate
+        if _isRegister16(source):
+            sourceReg = source.reg
+            def movRegReg():
+                words[reg] = words[sourceReg]
+            return movRegReg
+
+    write = operandWriter(cpu, dest)
+    read = operandReader(cpu, source)
+    def mov():
+        write(read())
+    return mov
+
+############################################################################
+# Stack
+############################################################################
+
+# The stack is addressed through SS:SP, pushes and pops access memory a word at a time.
+# On the 8086 push sp stores the decremented value
+
+def _bindPush(cpu, instruction):
+    source = instruction.dest
+    words = cpu.regFile.words
+    segments = cpu.regFile.segments
+    writeWord = cpu.memory.writeWord
+
+    if _isRegister16(source):
+        reg = source.reg
+        def pushRegister():
+            sp = (words[SP] - 2) & 0xFFFF
+            words[SP] = sp
+            writeWord(((segments[SS] << 4) + sp) & 0xFFFFF, words[reg])
+        return pushRegister
+
+    read = operandReader(cpu, source)
+    def push():
+        sp = (words[SP] - 2) & 0xFFFF
+        words[SP] = sp
+        writeWord(((segments[SS] << 4) + sp) & 0xFFFFF, read())
+    return push
+
+def _bindPop(cpu, instruction):
+    dest = instruction.dest
+    words = cpu.regFile.words
+    segments = cpu.regFile.segments
+    readWord = cpu.memory.readWord
+
+    if _isRegister16(dest):
+        reg = dest.reg
+        def popRegister():
+            sp = words[SP]
+            words[SP] = (sp + 2) & 0xFFFF
+            words[reg] = readWord(((segments[SS] << 4) + sp) & 0xFFFFF)
+        return popRegister
+
+    # the destination is written before SP moves, so an instruction failing on its write leaves SP as it was
+    write = operandWriter(cpu, dest)
+    def pop():
+        sp = words[SP]
+        write(readWord(((segments[SS] << 4) + sp) & 0xFFFFF))
+        words[SP] = (sp + 2) & 0xFFFF
+    return pop
+
+def _bindPushf(cpu, instruction):
+    flags = cpu.flags
+    def pushf():
+        cpu.push(flags.getWord())
+    return pushf
+
+def _bindPopf(cpu, instruction):
+    flags = cpu.flags
+    def popf():
+        flags.setWord(cpu.pop())
+    return popf
+
+############################################################################
+# Arithmetic
+############################################################################
+
+# Arithmetic instructions only record their operands and raw result,
+# the flags are computed by the FlagsRegister when they are read
+
+def _bindAdd(cpu, instruction):
+    dest, source = instruction.dest, instruction.source
+    words = cpu.regFile.words
+    flags = cpu.flags
+    width = instruction.width
+
+    # add reg16, imm16 and add reg16, reg16
+    if _isRegister16(dest):
+        reg = dest.reg
+        if source.kind is OperandKind.IMMEDIATE:
+            value = source.value
+            def addRegImmediate():
+                a = words[reg]
+                result = a + value
+                words[reg] = result & 0xFFFF
+                flags.pending = (ADD, a, value, result, 16, None)
+            return addRegImmediate
+        if _isRegister16(source):
+            sourceReg = source.reg
+            def addRegReg():
+                a = words[reg]
+                b = words[sourceReg]
+                result = a + b
+                words[reg] = result & 0xFFFF
+                flags.pending = (ADD, a, b, result, 16, None)
+            return addRegReg
+
+    readDest = operandReader(cpu, dest)
+    write = operandWriter(cpu, dest)
+    readSource = operandReader(cpu, source)
+    def add():
+        a = readDest()
+        b = readSource()
+        result = a + b
+        write(result)
+        flags.pending = (ADD, a, b, result, width, None)
+    return add
+
+def _bindSub(cpu, instruction):
+    readDest = operandReader(cpu, instruction.dest)
+    write = operandWriter(cpu, instruction.dest)
+    readSource = operandReader(cpu, instruction.source)
+    flags = cpu.flags
+    width = instruction.width
+    def sub():
+        a = readDest()
+        b = readSource()
+        result = a - b
+        write(result)
+        flags.pending = (SUB, a, b, result, width, None)
+    return sub
+
+def _bindInc(cpu, instruction):
+    readDest = operandReader(cpu, instruction.dest)
+    write = operandWriter(cpu, instruction.dest)
+    setPending = cpu.flags.setPendingIncDec
+    width = instruction.width
+    def inc():
+        a = readDest()
+        result = a + 1
+        write(result)
+        setPending(INC, a, result, width)
+    return inc
+
+def _bindDec(cpu, instruction):
+    readDest = operandReader(cpu, instruction.dest)
+    write = operandWriter(cpu, instruction.dest)
+    setPending = cpu.flags.setPendingIncDec
+    width = instruction.width
+    def dec():
+        a = readDest()
+        result = a - 1
+        write(result)
+        setPending(DEC, a, result, width)
+    return dec
+
+# Builds a binder for a two operand operation that records pending flags of the given kind.
+# compute(a, b, flags) returns the raw result, the result is stored only when store is set
+def _binaryOperation(kind, compute, store=True):
+    def bind(cpu, instruction):
+        readDest = operandReader(cpu, instruction.dest)
+        readSource = operandReader(cpu, instruction.source)
+        flags = cpu.flags
+        width = instruction.width
+        if store:
+            write = operandWriter(cpu, instruction.dest)
+            def execute():
+                a = readDest()
+                b = readSource()
+                result = compute(a, b, flags)
+                write(result)
+                flags.pending = (kind, a, b, result, width, None)
+        else:
+            def execute():
+                a = readDest()
+                b = readSource()
+                flags.pending = (kind, a, b, compute(a, b, flags), width, None)
+        return execute
+    return bind
+
+def _bindNeg(cpu, instruction):
+    readDest = operandReader(cpu, instruction.dest)
+    write = operandWriter(cpu, instruction.dest)
+    flags = cpu.flags
+    width = instruction.width
+    def neg():
+        b = readDest()
+        write(-b)
+        flags.pending = (SUB, 0, b, -b, width, None)
+    return neg
+
+# not does not change any flag
+def _bindNot(cpu, instruction):
+    readDest = operandReader(cpu, instruction.dest)
+    write = operandWriter(cpu, instruction.dest)
+    def bitwiseNot():
+        write(~readDest())
+    return bitwiseNot
+
+# mul/imul - AX = AL * src or DX:AX = AX * src, CF and OF tell whether the high half is significant
+def _bindMultiply(signed):
+    def bind(cpu, instruction):
+        readSource = operandReader(cpu, instruction.source)
+        words = cpu.regFile.words
+        flags = cpu.flags
+        width = instruction.width
+        def multiply():
+            if width == 16:
+                low, high, significant = ALU.mul(words[RegisterFile.AX], readSource(), 16, signed)
+                words[RegisterFile.AX] = low
+                words[RegisterFile.DX] = high
+            else:
+                low, high, significant = ALU.mul(words[RegisterFile.AX] & 0xFF, readSource(), 8, signed)
+                words[RegisterFile.AX] = (high << 8) | low
+            flags.carry = significant
+            flags.overflow = significant
+        return multiply
+    return bind
+
+# The interrupt vector of divide errors
+DIVIDE_ERROR_VECTOR = 0
+
+# div/idiv - AL, AH = AX / src or AX, DX = DX:AX / src. A divide by zero or a quotient that does
+# not fit is interrupt 0 with IP at the dividing instruction. While the vector still is 0000:0000
+# no handler was installed, the error is raised like every other fault of the simulation
+def _bindDivide(signed):
+    def bind(cpu, instruction):
+        readSource = operandReader(cpu, instruction.source)
+        regFile = cpu.regFile
+        words = regFile.words
+        width = instruction.width
+        length = instruction.length
+        def divide():
+            try:
+                if width == 16:
+                    dividend = (words[RegisterFile.DX] << 16) | words[RegisterFile.AX]
+                    quotient, remainder = ALU.div(dividend, readSource(), 16, signed)
+                    words[RegisterFile.AX] = quotient
+                    words[RegisterFile.DX] = remainder
+                else:
+                    quotient, remainder = ALU.div(words[RegisterFile.AX], readSource(), 8, signed)
+                    words[RegisterFile.AX] = (remainder << 8) | quotient
+            except ALUException:
+                if cpu.memory.getInterruptVector(DIVIDE_ERROR_VECTOR) == (0, 0):
+                    raise
+                regFile.ip = (regFile.ip - length) & 0xFFFF
+                cpu.interrupt(DIVIDE_ERROR_VECTOR)
+        return divide
+    return bind
+
+############################################################################
+# String operations
+############################################################################
+
+# String instructions read the source at DS:SI (or the segment of an override prefix) and the
+# destination at ES:DI and step SI and DI by the element size, backwards when the direction flag is set. Both wrap around within their segment.
+# A repeated instruction runs all of its iterations in one execution: the count is split into runs
+# whose elements do not wrap around, and every run is a single block operation on the memory.
+# cpu.repeatLimit bounds the iterations of one execution, an instruction stopped by it leaves CX
+# counting the rest and points IP back at itself, so it resumes when it runs again
+
+# Returns how many elements of the size fit from the offset on before the offset or the physical address wraps
+def _elementsBeforeWrap(base, offset, size, backwards):
+    physical = (base + offset) & 0xFFFFF
+    if offset + size > 0x10000 or physical + size > 0x100000:
+        return 0
+    if backwards:
+        return min(offset // size, physical // size) + 1
+    return min((0x10000 - offset) // size, (0x100000 - physical) // size)
+
+# Returns the index of the first byte where two equally long byte sequences differ, -1 when they are equal.
+# The slice comparisons run in C, they halve the range that holds the difference
+def _firstDifference(a, b):
+    if a == b:
+        return -1
+    low, high = 0, len(a)
+    while high - low > 1:
+        middle = (low + high) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle
+    return low
+
+# Returns the index of the last byte where two equally long byte sequences differ, -1 when they are equal
+def _lastDifference(a, b):
+    if a == b:
+        return -1
+    low, high = 0, len(a)
+    while high - low > 1:
+        middle = (low + high) // 2
+        if a[middle:high] == b[middle:high]:
+            high = middle
+        else:
+            low = middle
+    return low
+
+# Returns the index of the first element of the run, in the order of the iterations, where a and b hold
+# the same value. Returns -1 when there is none
+def _firstEqualElement(a, b, size, count, backwards):
+    if isinstance(a, bytes) and len(a) == size:
+        # scas compares every element with the accumulator, the matches are found with bytes.find
+        haystack = bytes(b)
+        position = haystack.rfind(a) if backwards else haystack.find(a)
+        while position >= 0 and position % size:
+            position = haystack.rfind(a, 0, position + size - 1) if backwards else haystack.find(a, position + 1)
+        if position < 0:
+            return -1
+        return (len(haystack) - size - position) // size if backwards else position // size
+    for index in range(count):
+        offset = (count - 1 - index) * size if backwards else index * size
+        if a[offset:offset + size] == b[offset:offset + size]:
+            return index
+    return -1
+
+def _bindString(cpu, instruction):
+    operation = instruction.mnemonic[:4]
+    repeat = instruction.repeat
+    length = instruction.length
+    width = instruction.width
+    size = width // 8
+    mask = 0xFFFF if width == 16 else 0xFF
+    regFile = cpu.regFile
+    words = regFile.words
+    segments = regFile.segments
+    memory = cpu.memory
+    readByte = memory.readByte
+    writeByte = memory.writeByte
+    flags = cpu.flags
+    usesSource = operation in ('movs', 'cmps', 'lods')
+    usesDest = operation != 'lods'
+    compares = operation in ('cmps', 'scas')
+    stopOnEqual = repeat == 'repne'
+    # the source is in DS unless a segment override prefix names another segment
+    sourceSegment = DS if instruction.override is None else instruction.override
+
+    def readElement(segment, offset):
+        base = segments[segment] << 4
+        value = readByte((base + offset) & 0xFFFFF)
+        if size == 2:
+            value |= readByte((base + ((offset + 1) & 0xFFFF)) & 0xFFFFF) << 8
+        return value
+
+    def writeElement(segment, offset, value):
+        base = segments[segment] << 4
+        writeByte((base + offset) & 0xFFFFF, value)
+        if size == 2:
+            writeByte((base + ((offset + 1) & 0xFFFF)) & 0xFFFFF, value >> 8)
+
+    def setAccumulator(value):
+        words[AX] = value if size == 2 else (words[AX] & 0xFF00) | value
+
+    # Runs up to count iterations one element at a time, returns (iterations, whether the repeat condition stopped it)
+    def iterate(count):
+        step = -size if flags.direction else size
+        for done in range(1, count + 1):
+            si = words[SI]
+            di = words[DI]
+            if operation == 'movs':
+                writeElement(ES, di, readElement(sourceSegment, si))
+            elif operation == 'stos':
+                writeElement(ES, di, words[AX] & mask)
+            elif operation == 'lods':
+                setAccumulator(readElement(sourceSegment, si))
+            else:
+                a = readElement(sourceSegment, si) if operation == 'cmps' else words[AX] & mask
+                b = readElement(ES, di)
+                flags.pending = (SUB, a, b, a - b, width, None)
+            if usesSource:
+                words[SI] = (si + step) & 0xFFFF
+            if usesDest:
+                words[DI] = (di + step) & 0xFFFF
+            if repeat is not None and compares and flags.testZero() == stopOnEqual:
+                return done, True
+        return count, False
+
+    # Runs count iterations whose elements do not wrap around as block operations,
+    # returns (iterations, whether the repeat condition stopped it)
+    def bulk(count):
+        backwards = flags.direction
+        total = count * size
+        # the lowest physical address of the elements of a pointer
+        def lowest(segment, offset):
+            physical = ((segments[segment] << 4) + offset) & 0xFFFFF
+            return physical - total + size if backwards else physical
+
+        done, stopped = count, False
+        if operation == 'stos':
+            memory.fillBlock(lowest(ES, words[DI]), (words[AX] & mask).to_bytes(size, 'little'), total)
+
+        elif operation == 'lods':
+            step = -size if backwards else size
+            setAccumulator(readElement(sourceSegment, (words[SI] + (count - 1) * step) & 0xFFFF))
+
+        elif operation == 'movs':
+            source = lowest(sourceSegment, words[SI])
+            dest = lowest(ES, words[DI])
+            distance = source - dest if backwards else dest - source
+            if 0 < distance < total:
+                if distance < size:
+                    return iterate(count)
+                # every element reads bytes an earlier one wrote, the copy repeats the bytes it read first
+                if backwards:
+                    pattern = bytes(memory[dest + total:dest + total + distance])
+                    shift = -total % distance
+                    memory.fillBlock(dest, pattern[shift:] + pattern[:shift], total)
+                else:
+                    memory.fillBlock(dest, memory[source:source + distance], total)
+            else:
+                memory.copyBlock(dest, source, total)
+
+        else:
+            dest = lowest(ES, words[DI])
+            b = memory[dest:dest + total]
+            if operation == 'cmps':
+                source = lowest(sourceSegment, words[SI])
+                a = memory[source:source + total]
+            else:
+                a = (words[AX] & mask).to_bytes(size, 'little')
+            if stopOnEqual:
+                index = _firstEqualElement(a, b, size, count, backwards)
+            else:
+                if len(a) != total:
+                    a = a * count
+                position = _lastDifference(a, b) if backwards else _firstDifference(a, b)
+                index = -1 if position < 0 else ((total - 1 - position) // size if backwards else position // size)
+            if index >= 0:
+                done, stopped = index + 1, True
+            # the flags are those of the last comparison
+            offset = (count - done) * size if backwards else (done - 1) * size
+            first = int.from_bytes(a[offset:offset + size] if len(a) == total else a, 'little')
+            second = int.from_bytes(b[offset:offset + size], 'little')
+            flags.pending = (SUB, first, second, first - second, width, None)
+
+        step = -done * size if backwards else done * size
+        if usesSource:
+            words[SI] = (words[SI] + step) & 0xFFFF
+        if usesDest:
+            words[DI] = (words[DI] + step) & 0xFFFF
+        return done, stopped
+
+    if repeat is None:
+        def string():
+            iterate(1)
+        return string
+
+    def repeatString():
+        count = words[CX]
+        limit = cpu.repeatLimit
+        budget = count if limit is None or limit > count else limit
+        done = 0
+        stopped = False
+        while done < budget and not stopped:
+            backwards = flags.direction
+            fit = budget - done
+            if usesSource:
+                fit = min(fit, _elementsBeforeWrap(segments[sourceSegment] << 4, words[SI], size, backwards))
+            if usesDest:
+                fit = min(fit, _elementsBeforeWrap(segments[ES] << 4, words[DI], size, backwards))
+            executed, stopped = bulk(fit) if fit else iterate(1)
+            done += executed
+        words[CX] = count - done
+        cpu.iterations = done
+        if count != done and not stopped:
+            regFile.ip = (regFile.ip - length) & 0xFFFF
+    return repeatString
+
+############################################################################
+# Control
+############################################################################
+
+def _bindNop(cpu, instruction):
+    def nop():
+        pass
+    return nop
+
+def _bindHlt(cpu, instruction):
+    def hlt():
+        cpu.halted = True
+    return hlt
+
+# Branches run with IP already pointing at the next instruction, relative
+# displacements are added to it
+
+# The conditions of the conditional jumps, zero, sign and carry are tested without computing the other flags
+# Format: 'mnemonic' : function of the flags register that tells whether the jump is taken
+JCC_CONDITIONS = {
+    'jo': lambda flags: flags.overflow,
+    'jno': lambda flags: not flags.overflow,
+    'jb': FlagsRegister.testCarry,
+    'jae': lambda flags: not flags.testCarry(),
+    'je': FlagsRegister.testZero,
+    'jne': lambda flags: not flags.testZero(),
+    'jbe': lambda flags: flags.testCarry() or flags.testZero(),
+    'ja': lambda flags: not (flags.testCarry() or flags.testZero()),
+    'js': FlagsRegister.testSign,
+    'jns': lambda flags: not flags.testSign(),
+    'jp': lambda flags: flags.parity,
+    'jnp': lambda flags: not flags.parity,
+    'jl': lambda flags: flags.sign != flags.overflow,
+    'jge': lambda flags: flags.sign == flags.overflow,
+    'jle': lambda flags: flags.zero or flags.sign != flags.overflow,
+    'jg': lambda flags: not flags.zero and flags.sign == flags.overflow,
+}
+
+def _bindConditionalJump(cpu, instruction):
+    regFile = cpu.regFile
+    flags = cpu.flags
+    condition = JCC_CONDITIONS[instruction.mnemonic]
+    displacement = instruction.dest.value
+    def conditionalJump():
+        if condition(flags):
+            regFile.ip = (regFile.ip + displacement) & 0xFFFF
+    return conditionalJump
+
+# loop/loope/loopne decrement CX without touching the flags, jcxz only tests it
+def _bindLoop(cpu, instruction):
+    regFile = cpu.regFile
+    words = regFile.words
+    flags = cpu.flags
+    mnemonic = instruction.mnemonic
+    displacement = instruction.dest.value
+
+    if mnemonic == 'jcxz':
+        def jcxz():
+            if not words[CX]:
+                regFile.ip = (regFile.ip + displacement) & 0xFFFF
+        return jcxz
+    if mnemonic == 'loop':
+        def loop():
+            count = (words[CX] - 1) & 0xFFFF
+            words[CX] = count
+            if count:
+                regFile.ip = (regFile.ip + displacement) & 0xFFFF
+        return loop
+
+    whileZero = mnemonic == 'loope'
+    def conditionalLoop():
+        count = (words[CX] - 1) & 0xFFFF
+        words[CX] = count
+        if count and flags.testZero() == whileZero:
+            regFile.ip = (regFile.ip + displacement) & 0xFFFF
+    return conditionalLoop
+
+def _bindJmp(cpu, instruction):
+    regFile = cpu.regFile
+    target = instruction.dest
+    if target.kind is OperandKind.RELATIVE:
+        displacement = target.value
+        def jmp():
+            regFile.ip = (regFile.ip + displacement) & 0xFFFF
+        return jmp
+
+    read = operandReader(cpu, target)
+    def jmpIndirect():
+        regFile.ip = read()
+    return jmpIndirect
+
+# call pushes the IP of the next instruction
+def _bindCall(cpu, instruction):
+    regFile = cpu.regFile
+    words = regFile.words
+    segments = regFile.segments
+    writeWord = cpu.memory.writeWord
+    target = instruction.dest
+
+    if target.kind is OperandKind.RELATIVE:
+        displacement = target.value
+        def call():
+            ip = regFile.ip
+            sp = (words[SP] - 2) & 0xFFFF
+            words[SP] = sp
+            writeWord(((segments[SS] << 4) + sp) & 0xFFFFF, ip)
+            regFile.ip = (ip + displacement) & 0xFFFF
+        return call
+
+    read = operandReader(cpu, target)
+    def callIndirect():
+        ip = read()
+        sp = (words[SP] - 2) & 0xFFFF
+        words[SP] = sp
+        writeWord(((segments[SS] << 4) + sp) & 0xFFFFF, regFile.ip)
+        regFile.ip = ip
+    return callIndirect
+
+# ret imm16 releases imm16 bytes of arguments after popping IP
+def _bindRet(cpu, instruction):
+    regFile = cpu.regFile
+    words = regFile.words
+    segments = regFile.segments
+    readWord = cpu.memory.readWord
+    release = 2 if instruction.dest is None else 2 + instruction.dest.value
+    def ret():
+        sp = words[SP]
+        words[SP] = (sp + release) & 0xFFFF
+        regFile.ip = readWord(((segments[SS] << 4) + sp) & 0xFFFFF)
+    return ret
+
+# int - enters the handler of the vector through the interrupt vector table
+def _bindInt(cpu, instruction):
+    vector = instruction.dest.value
+    def interrupt():
+        cpu.interrupt(vector)
+    return interrupt
+
+def _bindIret(cpu, instruction):
+    def iret():
+        cpu.returnFromInterrupt()
+    return iret
+
+def _bindSetFlag(name, value):
+    def bind(cpu, instruction):
+        flags = cpu.flags
+        def setFlag():
+            setattr(flags, name, value)
+        return setFlag
+    return bind
+
+def _bindCmc(cpu, instruction):
+    flags = cpu.flags
+    def cmc():
+        flags.carry = not flags.carry
+    return cmc
+
+# Format: 'mnemonic' : function that builds the execute function of an instruction
+SEMANTICS = {
+    'mov': _bindMov,
+    'push': _bindPush,
+    'pop': _bindPop,
+    'pushf': _bindPushf,
+    'popf': _bindPopf,
+    'add': _bindAdd,
+    'sub': _bindSub,
+    'inc': _bindInc,
+    'dec': _bindDec,
+    'adc': _binaryOperation(ADD, lambda a, b, flags: a + b + flags.carry),
+    'sbb': _binaryOperation(SUB, lambda a, b, flags: a - b - flags.carry),
+    'and': _binaryOperation(LOGIC, lambda a, b, flags: a & b),
+    'or': _binaryOperation(LOGIC, lambda a, b, flags: a | b),
+    'xor': _binaryOperation(LOGIC, lambda a, b, flags: a ^ b),
+    'cmp': _binaryOperation(SUB, lambda a, b, flags: a - b, store=False),
+    'neg': _bindNeg,
+    'not': _bindNot,
+    'mul': _bindMultiply(False),
+    'imul': _bindMultiply(True),
+    'div': _bindDivide(False),
+    'idiv': _bindDivide(True),
+    'nop': _bindNop,
+    'hlt': _bindHlt,
+    'int': _bindInt,
+    'iret': _bindIret,
+    'jmp': _bindJmp,
+    'call': _bindCall,
+    'ret': _bindRet,
+    'loop': _bindLoop,
+    'loope': _bindLoop,
+    'loopne': _bindLoop,
+    'jcxz': _bindLoop,
+    'cmc': _bindCmc,
+    'clc': _bindSetFlag('carry', False),
+    'stc': _bindSetFlag('carry', True),
+    'cli': _bindSetFlag('interrupt', False),
+    'sti': _bindSetFlag('interrupt', True),
+    'cld': _bindSetFlag('direction', False),
+    'std': _bindSetFlag('direction', True),
+}
+
+SEMANTICS.update((mnemonic, _bindConditionalJump) for mnemonic in JCC_CONDITIONS)
+SEMANTICS.update((mnemonic, _bindString) for mnemonic in STRING_OPCODES.values())
+
+# Binds the execute function of a decoded instruction to the given CPU
+def bindInstruction(cpu, instruction):
+    bind = SEMANTICS.get(instruction.mnemonic)
+    if bind is None:
+        raise DecodeException("Instruction '%s' at address 0x%05x is not supported" % (instruction.mnemonic, instruction.address))
+    instruction.execute = bind(cpu, instruction)
+    return instruction
@@ -0,0 +1,412 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from batch import BatchJob, initWorker, runWorkerJob, DEFAULT_MAX_STEPS, DEFAULT_MEMORY_WINDOW
+from jit import DEFAULT_THRESHOLD
+
+# Unix sockets do not exist everywhere, the server then only listens on localhost TCP
+HAS_UNIX_SOCKETS = hasattr(asyncio, 'start_unix_server')
+
+DEFAULT_SOCKET_PATH = os.path.join(tempfile.gettempdir(), 'sim8086.sock')
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8086
+
+# Seconds a job may run before it fails, unless its request asks for another limit
+DEFAULT_TIMEOUT = 5.0
+
+# Longest request line accepted, a 1 MiB image takes 2 MiB of hex
+MAX_REQUEST_BYTES = 4 << 20
+
+# The program of the load generator when no sources are given, a loop of 2000 instructions
+DEFAULT_LOAD_SOURCE = '\n'.join(['mov cx, 500', 'mov ax, 0',
+    'top:', 'add ax, cx', 'dec cx', 'jnz top', 'hlt'])
+
+#####################################################################
+# Protocol - newline delimited JSON over a Unix socket or a localhost
+# TCP connection. Every line sent to the server is one request:
+#   {"id": any value, "source": "mov ax, 1" or "image": "b80100",
+#    "registers": {"ax": 1}, "memory": {"0x100": "0102"},
+#    "maxSteps": instructions, "timeout": seconds}
+# only source or image is required, and maxSteps and timeout can
+# only lower the limits the server was started with. The requests of
+# a connection run concurrently and every response is written as
+# soon as its job finished, so responses can arrive out of order. A response is the
+# BatchResult of the job as a dict without its batch index, with the
+# id of its request and the seconds it spent queued and running:
+#   {"id": ..., "registers": {...}, "flags": 2, "memory": "hex",
+#    "steps": n, "halted": true, "error": null, "seconds": s}
+# A request that cannot be run gets a response with just its id,
+# the error and the seconds
+#####################################################################
+
+#################################################################
+# RequestException - A request that is not a valid job
+#################################################################
+class RequestException(Exception):
+    pass
+
+# Builds the BatchJob of a decoded request. The limits of the server are upper bounds, a request may
+# only ask for fewer instructions or a shorter timeout
+def jobFromRequest(request, maxSteps=DEFAULT_MAX_STEPS, timeout=DEFAULT_TIMEOUT):
+    if not isinstance(request, dict):
+        raise RequestException("a request is a JSON object")
+    if ('source' in request) == ('image' in request):
+        raise RequestException("a request has either a source or an image")
+    try:
+        if 'source' in request:
+            program = str(request['source'])
+        else:
+            program = bytes.fromhex(request['image'])
+        memory = {int(address, 0): bytes.fromhex(data) for address, data in request.get('memory', {}).items()}
+        registers = {name.lower(): int(value) for name, value in request.get('registers', {}).items()}
+        requestSteps = int(request['maxSteps']) if 'maxSteps' in request else None
+        requestTimeout = float(request['timeout']) if 'timeout' in request else None
+    except (TypeError, ValueError, AttributeError) as error:
+        raise RequestException("malformed request: %s" % error)
+    if requestSteps is not None:
+        if requestSteps < 0:
+            raise RequestException("maxSteps must not be negative")
+        maxSteps = requestSteps if maxSteps is None else min(requestSteps, maxSteps)
+    if requestTimeout is not None:
+        # a NaN timeout would never compare past the deadline
+        if not requestTimeout >= 0:
+            raise RequestException("timeout must be a number of seconds")
+        timeout = requestTimeout if timeout is None else min(requestTimeout, timeout)
+    return BatchJob(program, registers, memory, maxSteps, timeout)
+
+#####################################################################
+# SimulationServer - accepts jobs over a socket and runs them on a
+# pool of warm workers. A worker process keeps its BatchRunner, so
+# it assembles a source once and restores a snapshot of a loaded
+# image instead of loading it again. With 0 workers the jobs run
+# one at a time on a thread of the server process
+#####################################################################
+class SimulationServer:
+    def __init__(self, workers=None, memoryWindow=DEFAULT_MEMORY_WINDOW, jitThreshold=None,
+            maxSteps=DEFAULT_MAX_STEPS, timeout=DEFAULT_TIMEOUT):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.maxSteps = maxSteps
+        self.timeout = timeout
+        self.completed = 0
+        if self.workers > 0:
+            self._executor = ProcessPoolExecutor(self.workers, initializer=initWorker, initargs=(memoryWindow, jitThreshold))
+        else:
+            self._executor = ThreadPoolExecutor(1, initializer=initWorker, initargs=(memoryWindow, jitThreshold))
+        self._server = None
+        self._path = None
+
+    # Starts listening on the Unix socket at path, or on host:port. Port 0 picks a free port,
+    # address() tells which one. The workers are started before the first connection
+    async def start(self, path=None, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        await self.warm()
+        if path is not None:
+            if os.path.exists(path):
+                os.unlink(path)
+            self._path = path
+            self._server = await asyncio.start_unix_server(self._serve, path, limit=MAX_REQUEST_BYTES)
+        else:
+            self._server = await asyncio.start_server(self._serve, host, port, limit=MAX_REQUEST_BYTES)
+        return self
+
+    # Returns the socket path or the (host, port) the server listens on
+    def address(self):
+        return self._server.sockets[0].getsockname()
+
+    # Runs a tiny job on every worker, so the processes exist and imported the simulator before the first request
+    async def warm(self):
+        loop = asyncio.get_running_loop()
+        job = BatchJob('hlt')
+        await asyncio.gather(*[loop.run_in_executor(self._executor, runWorkerJob, job) for i in range(max(1, self.workers))])
+
+    async def serveForever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._path is not None and os.path.exists(self._path):
+            os.unlink(self._path)
+        self._executor.shutdown(cancel_futures=True)
+
+    # Reads the requests of a connection and answers each one as soon as its job finished
+    async def _serve(self, reader, writer):
+        answers = set()
+        lock = asyncio.Lock()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    await self._respond(writer, lock, {'id': None, 'error': "request longer than %d bytes" % MAX_REQUEST_BYTES})
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                answer = asyncio.ensure_future(self._answer(line, writer, lock))
+                answers.add(answer)
+                answer.add_done_callback(answers.discard)
+            if answers:
+                await asyncio.wait(answers)
+        except ConnectionError:
+            pass
+        finally:
+            for answer in answers:
+                answer.cancel()
+            writer.close()
+
+    async def _answer(self, line, writer, lock):
+        start = time.perf_counter()
+        requestId = None
+        try:
+            request = json.loads(line)
+            if isinstance(request, dict):
+                requestId = request.get('id')
+            job = jobFromRequest(request, self.maxSteps, self.timeout)
+            response = await asyncio.get_running_loop().run_in_executor(self._executor, runWorkerJob, job)
+            # the position in a batch means nothing for a single job
+            del response['index']
+        except Exception as error:
+            # a bad request or a broken worker pool fails the request, the connection stays open
+            response = {'error': "%s: %s" % (type(error).__name__, error)}
+        response['id'] = requestId
+        response['seconds'] = time.perf_counter() - start
+        self.completed += 1
+        await self._respond(writer, lock, response)
+
+    # Writes one response line, the lock keeps the writes of concurrent answers from waiting on drain together
+    async def _respond(self, writer, lock, response):
+        async with lock:
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+
+#####################################################################
+# SimulationClient - a connection to a SimulationServer. submit
+# sends a request and waits for its response, any number of them
+# can be waiting at once on one connection. Requests without an id
+# get a number
+#####################################################################
+class SimulationClient:
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._nextId = 0
+        self._waiting = {}
+        self._receiver = asyncio.ensure_future(self._receive())
+
+    # Connects to the Unix socket at path, or to host:port
+    @staticmethod
+    async def connect(path=None, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path, limit=MAX_REQUEST_BYTES)
+        else:
+            reader, writer = await asyncio.open_connection(host, port, limit=MAX_REQUEST_BYTES)
+        return SimulationClient(reader, writer)
+
+    # Sends a request dict and returns the response dict
+    async def submit(self, request):
+        if request.get('id') is None:
+            request = dict(request, id=self._nextId)
+            self._nextId += 1
+        response = asyncio.get_running_loop().create_future()
+        self._waiting[request['id']] = response
+        self._writer.write(json.dumps(request).encode() + b'\n')
+        await self._writer.drain()
+        return await response
+
+    # Runs an assembly source or a machine code image (bytes) with the given initial state
+    async def run(self, program, registers=None, memory=None, maxSteps=None, timeout=None):
+        request = {'image': bytes(program).hex()} if isinstance(program, (bytes, bytearray)) else {'source': program}
+        if registers:
+            request['registers'] = registers
+        if memory:
+            request['memory'] = {hex(address): bytes(data).hex() for address, data in memory.items()}
+        if maxSteps is not None:
+            request['maxSteps'] = maxSteps
+        if timeout is not None:
+            request['timeout'] = timeout
+        return await self.submit(request)
+
+    # Hands every response line to the submit call waiting for its id
+    async def _receive(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                waiting = self._waiting.pop(response.get('id'), None)
+                if waiting is not None and not waiting.done():
+                    waiting.set_result(response)
+        finally:
+            for waiting in self._waiting.values():
+                if not waiting.done():
+                    waiting.set_exception(ConnectionError("the server closed the connection"))
+            self._waiting.clear()
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+        self._receiver.cancel()
+
+#####################################################################
+# LoadReport - the latencies a load generator measured, in seconds
+#####################################################################
+class LoadReport:
+    def __init__(self, latencies, elapsed, errors):
+        self.latencies = sorted(latencies)
+        self.elapsed = elapsed
+        self.errors = errors
+
+    # Nearest rank percentile of the latencies, fraction is in [0, 1]
+    def percentile(self, fraction):
+        if not self.latencies:
+            return 0.0
+        rank = min(len(self.latencies), max(1, math.ceil(fraction * len(self.latencies))))
+        return self.latencies[rank - 1]
+
+    @property
+    def requestsPerSecond(self):
+        return len(self.latencies) / self.elapsed if self.elapsed > 0 else float('inf')
+
+    def asDict(self):
+        return {'requests': len(self.latencies), 'errors': self.errors, 'requests/s': self.requestsPerSecond,
+            'p50Ms': self.percentile(0.5) * 1e3, 'p99Ms': self.percentile(0.99) * 1e3,
+            'maxMs': self.latencies[-1] * 1e3 if self.latencies else 0.0}
+
+    def __str__(self):
+        metrics = self.asDict()
+        return ("%d requests in %.3fs (%.0f requests/s), %d errors, latency p50 %.2f ms, p99 %.2f ms, max %.2f ms" %
+            (metrics['requests'], self.elapsed, metrics['requests/s'], self.errors,
+            metrics['p50Ms'], metrics['p99Ms'], metrics['maxMs']))
+
+# Sends `requests` requests cycling through the programs, keeping `concurrency` of them waiting on
+# one connection, and measures the latency of every request from sending it to its response
+async def generateLoad(client, programs, requests, concurrency):
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def sender():
+        nonlocal errors
+        for number in remaining:
+            start = time.perf_counter()
+            response = await client.run(programs[number % len(programs)])
+            latencies.append(time.perf_counter() - start)
+            if response.get('error') is not None:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[sender() for i in range(concurrency)])
+    return LoadReport(latencies, time.perf_counter() - start, errors)
+
+# Runs the load generator against a server started in this process on a temporary socket,
+# nothing outside the machine is needed. Returns the LoadReport
+async def localLoadTest(programs=None, requests=1000, concurrency=16, workers=None, jitThreshold=None):
+    programs = programs or [DEFAULT_LOAD_SOURCE]
+    with tempfile.TemporaryDirectory() as directory:
+        server = SimulationServer(workers, jitThreshold=jitThreshold)
+        if HAS_UNIX_SOCKETS:
+            await server.start(path=os.path.join(directory, 'sim8086.sock'))
+            client = await SimulationClient.connect(path=server.address())
+        else:
+            await server.start(port=0)
+            client = await SimulationClient.connect(port=server.address()[1])
+        try:
+            # one round first, so every worker assembled the programs before the latencies count
+            await generateLoad(client, programs, len(programs) * max(1, server.workers), concurrency)
+            return await generateLoad(client, programs, requests, concurrency)
+        finally:
+            await client.close()
+            await server.close()
+
+def _readSources(paths):
+    sources = []
+    for path in paths:
+        with open(path, 'r') as inputFile:
+            sources.append(inputFile.read())
+    return sources
+
+def _connectArguments(args):
+    if args.unix is not None or (args.port is None and HAS_UNIX_SOCKETS):
+        return {'path': args.unix or DEFAULT_SOCKET_PATH}
+    return {'host': args.host, 'port': args.port or DEFAULT_PORT}
+
+async def _serveCommand(args):
+    server = SimulationServer(args.workers, jitThreshold=DEFAULT_THRESHOLD if args.jit else None,
+        maxSteps=args.max_steps, timeout=args.timeout)
+    await server.start(**_connectArguments(args))
+    print("serving on %s with %d worker(s)" % (server.address(), server.workers), flush=True)
+    try:
+        await server.serveForever()
+    finally:
+        await server.close()
+
+async def _runCommand(args):
+    client = await SimulationClient.connect(**_connectArguments(args))
+    try:
+        responses = await asyncio.gather(*[client.run(source, maxSteps=args.max_steps, timeout=args.timeout)
+            for source in _readSources(args.sources)])
+    finally:
+        await client.close()
+    for path, response in zip(args.sources, responses):
+        if args.json:
+            print(json.dumps(response))
+        elif response.get('error') is not None:
+            print("%s: %s" % (path, response['error']))
+        else:
+            print("%s: %s, %d steps, halted %s" % (path, ', '.join("%s: %d" % item for item in response['registers'].items()),
+                response['steps'], response['halted']))
+
+async def _loadCommand(args):
+    programs = _readSources(args.sources) or [DEFAULT_LOAD_SOURCE]
+    if args.local:
+        report = await localLoadTest(programs, args.requests, args.concurrency, args.workers)
+    else:
+        client = await SimulationClient.connect(**_connectArguments(args))
+        try:
+            report = await generateLoad(client, programs, args.requests, args.concurrency)
+        finally:
+            await client.close()
+    print(report)
+
+def main():
+    argParser = argparse.ArgumentParser(description="Runs programs on a long lived pool of simulators behind a socket")
+    commands = argParser.add_subparsers(dest='command', required=True)
+    serveParser = commands.add_parser('serve', help="start the server")
+    runParser = commands.add_parser('run', help="run source files on a running server")
+    loadParser = commands.add_parser('load', help="send many requests and report the latencies")
+    for parser in (serveParser, runParser, loadParser):
+        parser.add_argument('--unix', metavar='PATH', help="Unix socket path (default %s)" % DEFAULT_SOCKET_PATH)
+        parser.add_argument('--host', default=DEFAULT_HOST)
+        parser.add_argument('--port', type=int, help="listen on localhost TCP instead of a Unix socket")
+    for parser in (serveParser, loadParser):
+        parser.add_argument('--workers', type=int, help="worker processes, 0 runs the jobs in the server process")
+    for parser in (serveParser, runParser):
+        parser.add_argument('--max-steps', type=int, default=DEFAULT_MAX_STEPS)
+        parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help="seconds a program may run")
+    serveParser.add_argument('--jit', action='store_true', help="run the programs with the block compiling tier")
+    runParser.add_argument('sources', nargs='+', help="assembly source files")
+    runParser.add_argument('--json', action='store_true', help="print every response as a JSON line")
+    loadParser.add_argument('sources', nargs='*', help="assembly source files, a counting loop by default")
+    loadParser.add_argument('--requests', type=int, default=1000)
+    loadParser.add_argument('--concurrency', type=int, default=16, help="requests waiting at once")
+    loadParser.add_argument('--local', action='store_true', help="start a server in this process for the run")
+    args = argParser.parse_args()
+
+    command = {'serve': _serveCommand, 'run': _runCommand, 'load': _loadCommand}[args.command]
+    try:
+        asyncio.run(command(args))
+    except KeyboardInterrupt:
+        sys.exit(130)
+
+if __name__ == "__main__":
+    main()
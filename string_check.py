@@ -0,0 +1,268 @@
+from alu_check import BitSerialALU
+from assembler import assemble
+from cpu import CPU8086, HLT_OPCODE
+from differential import DifferentialChecker, firstDifference
+from memory import MEMORY_SIZE
+from registers import FlagsRegister, fromBits, toBits
+
+# The string instructions and the prefixes they are generated with, None runs one iteration
+STRING_MNEMONICS = ('movsb', 'movsw', 'cmpsb', 'cmpsw', 'stosb', 'stosw', 'lodsb', 'lodsw', 'scasb', 'scasw')
+REPEAT_MNEMONICS = ('rep', 'repe', 'repne', None)
+
+# The segment override prefixes, es: - cs: - ss: - ds:
+SEGMENT_PREFIXES = (0x26, 0x2E, 0x36, 0x3E)
+
+# The program runs high in the address space, the destination segments are chosen so none reaches its code
+CODE_SEGMENT = 0x9000
+CODE_ADDRESS = CODE_SEGMENT << 4
+
+# Segments and offsets that wrap around, or end right before they would
+EDGE_SEGMENTS = (0, 0xF000, 0xFFF0, 0xFFFF)
+EDGE_OFFSETS = (0, 1, 2, 0xFFFE, 0xFFFF)
+
+# Instructions a run may execute, enough for every iteration of three repeated instructions one at a time
+MAX_STEPS = 1000000
+
+# The repeat limits of the runs of the CPU compared with the reference model. None runs every repeat
+# in bulk, 0 draws a small limit
+# Format: 'run' : repeat limit
+REPEAT_LIMITS = {'bulk': None, 'iterated': 1, 'limited': 0}
+
+# The operations of the string opcodes by their opcode with the width bit cleared
+# Format: opcode : 'operation'
+REFERENCE_OPERATIONS = {0xA4: 'movs', 0xA6: 'cmps', 0xAA: 'stos', 0xAC: 'lods', 0xAE: 'scas'}
+
+# The segment registers of the override prefixes
+# Format: prefix byte : 'segment register'
+REFERENCE_SEGMENTS = {0x26: 'es', 0x2E: 'cs', 0x36: 'ss', 0x3E: 'ds'}
+
+# The status flags a comparison sets, and every flag of the FLAGS word
+STATUS_FLAGS_MASK = (FlagsRegister.CARRY_BIT | FlagsRegister.PARITY_BIT | FlagsRegister.AUXILIARY_BIT |
+    FlagsRegister.ZERO_BIT | FlagsRegister.SIGN_BIT | FlagsRegister.OVERFLOW_BIT)
+FLAGS_MASK = STATUS_FLAGS_MASK | FlagsRegister.TRAP_BIT | FlagsRegister.INTERRUPT_BIT | FlagsRegister.DIRECTION_BIT
+
+#####################################################################
+# ReferenceStrings - the reference model of the string instructions.
+# It decodes the prefixes itself and runs one iteration at a time on
+# a flat copy of the memory, stepping the pointers and wrapping every
+# byte address within its segment and the address space on its own.
+# Comparisons take their flags from the bit serial ALU of alu_check.
+# It shares no code with the string instructions of the CPU
+#####################################################################
+class ReferenceStrings:
+    def __init__(self, registers, flags, code, memory):
+        self.registers = dict(registers)
+        self.registers['cs'] = CODE_SEGMENT
+        self.flags = flags & FLAGS_MASK
+        self.memory = bytearray(memory)
+        self.memory[CODE_ADDRESS:CODE_ADDRESS + len(code) + 1] = code + bytes((HLT_OPCODE,))
+
+    def address(self, segment, offset):
+        return ((self.registers[segment] << 4) + (offset & 0xFFFF)) & 0xFFFFF
+
+    def read(self, segment, offset, size):
+        return sum(self.memory[self.address(segment, offset + index)] << (8 * index) for index in range(size))
+
+    def write(self, segment, offset, size, value):
+        for index in range(size):
+            self.memory[self.address(segment, offset + index)] = (value >> (8 * index)) & 0xFF
+
+    # Sets the status flags of a - b
+    def compare(self, a, b, width):
+        bits, borrow, overflow, auxiliary = BitSerialALU.sub(toBits(a, width), toBits(b, width))
+        result = fromBits(bits)
+        flags = self.flags & ~STATUS_FLAGS_MASK
+        for bit, value in ((FlagsRegister.CARRY_BIT, borrow), (FlagsRegister.OVERFLOW_BIT, overflow),
+                (FlagsRegister.AUXILIARY_BIT, auxiliary), (FlagsRegister.ZERO_BIT, result == 0),
+                (FlagsRegister.SIGN_BIT, bits[0] == 1), (FlagsRegister.PARITY_BIT, bin(result & 0xFF).count('1') % 2 == 0)):
+            if value:
+                flags |= bit
+        self.flags = flags
+
+    # Runs one iteration of a string operation
+    def iterate(self, operation, size, source):
+        registers = self.registers
+        mask = (1 << (8 * size)) - 1
+        if operation == 'movs':
+            self.write('es', registers['di'], size, self.read(source, registers['si'], size))
+        elif operation == 'stos':
+            self.write('es', registers['di'], size, registers['ax'] & mask)
+        elif operation == 'lods':
+            value = self.read(source, registers['si'], size)
+            registers['ax'] = value if size == 2 else (registers['ax'] & 0xFF00) | value
+        elif operation == 'cmps':
+            self.compare(self.read(source, registers['si'], size), self.read('es', registers['di'], size), size * 8)
+        else:
+            self.compare(registers['ax'] & mask, self.read('es', registers['di'], size), size * 8)
+        step = -size if self.flags & FlagsRegister.DIRECTION_BIT else size
+        if operation in ('movs', 'cmps', 'lods'):
+            registers['si'] = (registers['si'] + step) & 0xFFFF
+        if operation != 'lods':
+            registers['di'] = (registers['di'] + step) & 0xFFFF
+
+    # Runs the machine code of a program generated by StringChecker.program and the hlt after it
+    def run(self, code):
+        registers = self.registers
+        position = 0
+        while position < len(code):
+            repeat = None
+            source = 'ds'
+            while code[position] in REFERENCE_SEGMENTS or code[position] in (0xF2, 0xF3):
+                if code[position] in REFERENCE_SEGMENTS:
+                    source = REFERENCE_SEGMENTS[code[position]]
+                else:
+                    repeat = code[position]
+                position += 1
+            opcode = code[position]
+            position += 1
+            if opcode == 0xFC:
+                self.flags &= ~FlagsRegister.DIRECTION_BIT
+                continue
+            if opcode == 0xFD:
+                self.flags |= FlagsRegister.DIRECTION_BIT
+                continue
+            operation = REFERENCE_OPERATIONS[opcode & ~1]
+            size = 2 if opcode & 1 else 1
+            if repeat is None:
+                self.iterate(operation, size, source)
+                continue
+            while registers['cx'] != 0:
+                self.iterate(operation, size, source)
+                registers['cx'] -= 1
+                if operation in ('cmps', 'scas') and bool(self.flags & FlagsRegister.ZERO_BIT) != (repeat == 0xF3):
+                    break
+        registers['ip'] = len(code) + 1
+
+    # Returns the state after a run, in the form of StringChecker.state
+    def state(self):
+        names = ('ax', 'cx', 'dx', 'bx', 'sp', 'bp', 'si', 'di', 'es', 'cs', 'ss', 'ds', 'ip')
+        return {'registers': {name: self.registers[name] for name in names}, 'flags': self.flags, 'halted': True, 'error': None}
+
+#####################################################################
+# StringChecker - runs random programs of repeated string
+# instructions over random registers and memory on the reference
+# model and three times on the CPU: with every repeat in bulk, with
+# one iteration per execution and with a small random repeat limit.
+# The final states must be those of the reference model, except for
+# the number of executed steps. The pointers and counts are often
+# chosen next to a segment or address space wrap and the source and
+# destination often overlap
+#####################################################################
+class StringChecker(DifferentialChecker):
+    DESCRIPTION = "Checks the repeated string instructions against a reference model on random programs"
+    OPTIONS = {
+        'programs': ('programs', 300, None),
+    }
+
+    @staticmethod
+    def segment(rng):
+        return rng.choice(EDGE_SEGMENTS) if rng.random() < 0.3 else rng.randint(0, 0xFFFF)
+
+    @staticmethod
+    def offset(rng):
+        if rng.random() < 0.3:
+            return rng.choice(EDGE_OFFSETS)
+        if rng.random() < 0.3:
+            return (0x10000 - rng.randint(1, 64)) & 0xFFFF
+        return rng.randint(0, 0xFFFF)
+
+    @staticmethod
+    def count(rng):
+        kind = rng.random()
+        if kind < 0.7:
+            return rng.randint(0, 64)
+        if kind < 0.97:
+            return rng.randint(0, 0x1000)
+        return rng.choice((0xFFFF, rng.randint(0x1000, 0xFFFF)))
+
+    # Returns whether a segment reaches the code of the program
+    @staticmethod
+    def reachesCode(segment, length):
+        distance = (CODE_ADDRESS - (segment << 4)) & 0xFFFFF
+        return distance < 0x10000 or distance + length > MEMORY_SIZE
+
+    # Returns the machine code of a program of one to three repeated string instructions.
+    # Override prefixes go before or after the repeat prefix, the direction may change between them
+    def program(self, rng):
+        code = b''
+        for index in range(rng.randint(1, 3)):
+            if index and rng.random() < 0.3:
+                code += assemble(rng.choice(('cld', 'std'))).getMachineCode()
+            repeat = rng.choice(REPEAT_MNEMONICS)
+            mnemonic = rng.choice(STRING_MNEMONICS)
+            instruction = assemble(mnemonic if repeat is None else '%s %s' % (repeat, mnemonic)).getMachineCode()
+            if rng.random() < 0.4:
+                position = rng.randint(0, len(instruction) - 1)
+                instruction = instruction[:position] + bytes((rng.choice(SEGMENT_PREFIXES),)) + instruction[position:]
+            code += instruction
+        return code
+
+    # Returns the registers, flags and memory a program starts with. The memory holds a few distinct
+    # values only, so repe and repne stop somewhere inside the runs
+    def initialState(self, rng, length):
+        registers = {name: rng.randint(0, 0xFFFF) for name in ('ax', 'bx', 'dx', 'bp', 'sp')}
+        registers['cx'] = self.count(rng)
+        registers['si'] = self.offset(rng)
+        registers['ds'] = self.segment(rng)
+        registers['ss'] = self.segment(rng)
+        if rng.random() < 0.4:
+            # the destination overlaps the source, a few bytes before or after it
+            registers['es'] = (registers['ds'] + rng.choice((0, 0, 1, -1))) & 0xFFFF
+            registers['di'] = (registers['si'] + (registers['ds'] - registers['es']) * 16 + rng.randint(-8, 8)) & 0xFFFF
+        else:
+            registers['es'] = self.segment(rng)
+            registers['di'] = self.offset(rng)
+        while StringChecker.reachesCode(registers['es'], length):
+            registers['es'] = self.segment(rng)
+
+        values = bytes(rng.randint(0, 0xFF) for i in range(rng.randint(1, 4)))
+        table = bytes(values[index % len(values)] for index in range(256))
+        memory = rng.randbytes(MEMORY_SIZE).translate(table)
+        if rng.random() < 0.5:
+            # the accumulator holds one of the values in memory, scas finds it
+            registers['ax'] = rng.choice(values) * 0x0101
+        return registers, rng.randint(0, 0xFFFF), memory
+
+    # Returns the state of a CPU after a run for comparison
+    @staticmethod
+    def state(cpu, error):
+        return {'registers': cpu.regFile.asDict(), 'flags': cpu.flags.getWord(), 'halted': cpu.halted, 'error': error}
+
+    # Runs a program from a state with a repeat limit, returns the CPU and the exception message or None
+    @staticmethod
+    def execute(code, registers, flags, memory, repeatLimit):
+        cpu = CPU8086()
+        cpu.memory[0:MEMORY_SIZE] = memory
+        cpu.loadProgram(code, CODE_SEGMENT)
+        for name, value in registers.items():
+            cpu.regFile.setByName(name, value)
+        cpu.flags.setWord(flags)
+        cpu.repeatLimit = repeatLimit
+        try:
+            cpu.run(MAX_STEPS)
+        except Exception as exception:
+            return cpu, "%s: %s" % (type(exception).__name__, exception)
+        return cpu, None
+
+    def checkProgram(self, case, rng, code, registers, flags, memory):
+        reference = ReferenceStrings(registers, flags, code, memory)
+        reference.run(code)
+        expected = reference.state()
+        for run, repeatLimit in REPEAT_LIMITS.items():
+            cpu, error = StringChecker.execute(code, registers, flags, memory, rng.randint(2, 40) if repeatLimit == 0 else repeatLimit)
+            got = StringChecker.state(cpu, error)
+            for name in expected:
+                self.expect('%s %s' % (run, name), case, got[name], expected[name])
+            self.expect('%s first differing memory address' % run, case,
+                firstDifference(cpu.memory[0:MEMORY_SIZE], reference.memory), None)
+
+    def run(self, rng, programs):
+        for number in range(programs):
+            code = self.program(rng)
+            registers, flags, memory = self.initialState(rng, len(code) + 1)
+            case = "program %d" % number
+            description = "%s: %s, registers %r, flags %04X" % (case, code.hex(), registers, flags)
+            self.checkCase(description, self.checkProgram, case, rng, code, registers, flags, memory)
+
+if __name__ == "__main__":
+    StringChecker.main()
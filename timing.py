@@ -0,0 +1,176 @@
+from decoder import OperandKind, JCC_MNEMONICS, STRING_OPCODES
+
+#####################################################################
+# Instruction timing - the clock counts of the 8086 timing tables.
+# Every decoded instruction gets its count once, from its mnemonic,
+# its operand form, the effective address calculation of its memory
+# operand and its segment override prefix. Counts that depend on the
+# operand values (mul/div) use the fastest case, and the 4 clock
+# penalty of word accesses at odd addresses is not modeled.
+# Conditional branches count the not taken case, the clocks a taken
+# branch adds are kept apart. A repeated string instruction counts
+# its setup, and its clocks per iteration are added for the
+# iterations it ran
+#####################################################################
+
+# Operand form names by operand kind
+_FORM_NAMES = {
+    OperandKind.REGISTER: 'reg',
+    OperandKind.IMMEDIATE: 'imm',
+    OperandKind.MEMORY: 'mem',
+    OperandKind.SEGMENT: 'seg',
+    OperandKind.RELATIVE: 'rel',
+}
+
+# The clocks of an arithmetic or logic operation
+_ALU_CYCLES = {'reg,reg': 3, 'reg,mem': 9, 'mem,reg': 16, 'reg,imm': 4, 'mem,imm': 17}
+
+# The clocks of every instruction without its effective address calculation. An operand form is
+# looked up with the operation width appended first (like 'reg8'), then without it
+# Format: 'mnemonic' : {'operand form' : clocks}
+BASE_CYCLES = {
+    'mov': {'reg,reg': 2, 'reg,mem': 8, 'mem,reg': 9, 'reg,imm': 4, 'mem,imm': 10,
+        'seg,reg': 2, 'seg,mem': 8, 'reg,seg': 2, 'mem,seg': 9, 'acc,mem': 10, 'mem,acc': 10},
+    'add': _ALU_CYCLES,
+    'adc': _ALU_CYCLES,
+    'sub': _ALU_CYCLES,
+    'sbb': _ALU_CYCLES,
+    'and': _ALU_CYCLES,
+    'or': _ALU_CYCLES,
+    'xor': _ALU_CYCLES,
+    'cmp': {'reg,reg': 3, 'reg,mem': 9, 'mem,reg': 9, 'reg,imm': 4, 'mem,imm': 10},
+    'inc': {'reg16': 2, 'reg8': 3, 'mem': 15},
+    'dec': {'reg16': 2, 'reg8': 3, 'mem': 15},
+    'neg': {'reg': 3, 'mem': 16},
+    'not': {'reg': 3, 'mem': 16},
+    'mul': {'reg8': 70, 'reg16': 118, 'mem8': 76, 'mem16': 124},
+    'imul': {'reg8': 80, 'reg16': 128, 'mem8': 86, 'mem16': 134},
+    'div': {'reg8': 80, 'reg16': 144, 'mem8': 86, 'mem16': 150},
+    'idiv': {'reg8': 101, 'reg16': 165, 'mem8': 107, 'mem16': 171},
+    'nop': {'': 3},
+    'hlt': {'': 2},
+    'int': {'imm': 51},
+    'iret': {'': 24},
+    'cmc': {'': 2},
+    'clc': {'': 2},
+    'stc': {'': 2},
+    'cli': {'': 2},
+    'sti': {'': 2},
+    'cld': {'': 2},
+    'std': {'': 2},
+    'push': {'reg': 11, 'seg': 10, 'mem': 16},
+    'pop': {'reg': 8, 'seg': 8, 'mem': 17},
+    'pushf': {'': 10},
+    'popf': {'': 8},
+    'call': {'rel': 19, 'reg': 16, 'mem': 21},
+    'ret': {'': 8, 'imm': 12},
+    'jmp': {'rel': 15, 'reg': 11, 'mem': 18},
+    'loop': {'rel': 5},
+    'loope': {'rel': 6},
+    'loopne': {'rel': 5},
+    'jcxz': {'rel': 6},
+}
+BASE_CYCLES.update((mnemonic, {'rel': 4}) for mnemonic in JCC_MNEMONICS)
+
+# The clocks a conditional branch adds when it is taken
+# Format: 'mnemonic' : clocks
+TAKEN_CYCLES = {
+    'loop': 12,
+    'loope': 12,
+    'loopne': 14,
+    'jcxz': 12,
+}
+TAKEN_CYCLES.update((mnemonic, 12) for mnemonic in JCC_MNEMONICS)
+
+# The clocks of the string instructions by operation
+# Format: 'operation' : (clocks without a repeat prefix, clocks of the repeat setup, clocks per repeated iteration)
+STRING_CYCLES = {
+    'movs': (18, 9, 17),
+    'cmps': (22, 9, 22),
+    'scas': (15, 9, 15),
+    'lods': (12, 9, 13),
+    'stos': (11, 9, 10),
+}
+
+# int 3 has its own single byte encoding and takes one clock more than int imm8
+INT3_CYCLES = 52
+
+# The accumulator forms of mov with a direct address (0xA0-0xA3) have their own timing
+_MOV_OFFSET_OPCODES = range(0xA0, 0xA4)
+
+# Clocks of the effective address calculation by addressing mode
+# Format: 'addressing mode' : clocks
+EA_CYCLES = {
+    'disp': 6,
+    'base': 5,
+    'index': 5,
+    'base+disp': 9,
+    'index+disp': 9,
+    'bp+di': 7,
+    'bx+si': 7,
+    'bp+si': 8,
+    'bx+di': 8,
+    'bp+di+disp': 11,
+    'bx+si+disp': 11,
+    'bp+si+disp': 12,
+    'bx+di+disp': 12,
+}
+
+# A segment override prefix adds to the effective address calculation
+SEGMENT_OVERRIDE_CYCLES = 2
+
+#################################################################
+# TimingException - An instruction without a known clock count
+#################################################################
+class TimingException(Exception):
+    pass
+
+# Returns the clocks of the effective address calculation of a memory operand
+def effectiveAddressCycles(operand):
+    return EA_CYCLES[operand.mode]
+
+# Returns the operand form of an instruction, like 'reg,mem'
+def operandForm(instruction):
+    if instruction.mnemonic == 'mov' and instruction.opcode in _MOV_OFFSET_OPCODES:
+        return 'mem,acc' if instruction.opcode & 2 else 'acc,mem'
+    operands = [operand for operand in (instruction.dest, instruction.source) if operand is not None]
+    return ','.join(_FORM_NAMES[operand.kind] for operand in operands)
+
+# Returns the clocks an instruction takes, the effective address calculation and the segment
+# override prefix included
+def instructionCycles(instruction):
+    if instruction.override is None:
+        return _unprefixedCycles(instruction)
+    return _unprefixedCycles(instruction) + SEGMENT_OVERRIDE_CYCLES
+
+def _unprefixedCycles(instruction):
+    if instruction.opcode == 0xCC:
+        return INT3_CYCLES
+    if instruction.opcode in STRING_OPCODES:
+        single, setup, iteration = STRING_CYCLES[instruction.mnemonic[:4]]
+        return single if instruction.repeat is None else setup
+    forms = BASE_CYCLES.get(instruction.mnemonic)
+    form = operandForm(instruction)
+    cycles = None
+    if forms is not None:
+        cycles = forms.get(form + str(instruction.width), forms.get(form))
+    if cycles is None:
+        raise TimingException("No clock count for '%s' with operands '%s'" % (instruction.mnemonic, form))
+
+    # the accumulator forms of mov include their address in the base count
+    if instruction.mnemonic == 'mov' and instruction.opcode in _MOV_OFFSET_OPCODES:
+        return cycles
+    for operand in (instruction.dest, instruction.source):
+        if operand is not None and operand.kind is OperandKind.MEMORY:
+            cycles += effectiveAddressCycles(operand)
+    return cycles
+
+# Returns the clocks a branch adds when it is taken, 0 for every other instruction
+def takenCycles(instruction):
+    return TAKEN_CYCLES.get(instruction.mnemonic, 0)
+
+# Returns the clocks of every iteration of a repeated string instruction, 0 for every other instruction
+def repeatCycles(instruction):
+    if instruction.repeat is None:
+        return 0
+    return STRING_CYCLES[instruction.mnemonic[:4]][2]
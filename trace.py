@@ -0,0 +1,149 @@
+import json
+import struct
+from enum import Enum
+
+class TraceMode(Enum):
+    REGISTERS = 0   # the registers that changed after every instruction
+    MEMORY = 1      # every memory write
+    SNAPSHOTS = 2   # all registers and a memory window every N instructions
+
+# Names of the traced registers, the index is the register number used by the binary format
+REGISTER_NAMES = ('ax', 'cx', 'dx', 'bx', 'sp', 'bp', 'si', 'di', 'es', 'cs', 'ss', 'ds', 'ip', 'flags')
+
+# Binary trace format - a magic header followed by records that start with their type byte
+BINARY_MAGIC = b'T86\x01'
+RECORD_REGISTERS = 1
+RECORD_MEMORY = 2
+RECORD_SNAPSHOT = 3
+
+_STEP_HEADER = struct.Struct('<BII')          # type, step, instruction address
+_REGISTER_DELTA = struct.Struct('<BH')        # register number, value
+_MEMORY_HEADER = struct.Struct('<BIIH')       # type, step, written address, length
+_SNAPSHOT_REGISTERS = struct.Struct('<14H')
+_SNAPSHOT_MEMORY = struct.Struct('<IH')       # memory window start, length
+
+#####################################################################
+# TraceSink - collects encoded trace records in memory and writes
+# them to the output file in batches
+#####################################################################
+class TraceSink:
+    def __init__(self, path, batchSize=4096):
+        self._file = open(path, 'wb')
+        self._batchSize = batchSize
+        self._buffer = []
+
+    def _append(self, chunk):
+        self._buffer.append(chunk)
+        if len(self._buffer) >= self._batchSize:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._file.write(b''.join(self._buffer))
+            self._buffer = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+# Writes one JSON object per line
+class NDJSONTraceSink(TraceSink):
+    def _writeJson(self, record):
+        self._append((json.dumps(record, separators=(',', ':')) + '\n').encode())
+
+    def writeRegisters(self, step, address, changes):
+        self._writeJson({'step': step, 'address': address,
+            'registers': {REGISTER_NAMES[number]: value for number, value in changes}})
+
+    def writeMemory(self, step, address, data):
+        self._writeJson({'step': step, 'write': address, 'data': bytes(data).hex()})
+
+    def writeSnapshot(self, step, address, registers, memoryStart, data):
+        self._writeJson({'step': step, 'address': address,
+            'registers': dict(zip(REGISTER_NAMES, registers)),
+            'memory': {'start': memoryStart, 'data': bytes(data).hex()}})
+
+# Writes packed little endian records
+class BinaryTraceSink(TraceSink):
+    def __init__(self, path, batchSize=4096):
+        super().__init__(path, batchSize)
+        self._append(BINARY_MAGIC)
+
+    def writeRegisters(self, step, address, changes):
+        parts = [_STEP_HEADER.pack(RECORD_REGISTERS, step, address), bytes((len(changes),))]
+        for number, value in changes:
+            parts.append(_REGISTER_DELTA.pack(number, value))
+        self._append(b''.join(parts))
+
+    def writeMemory(self, step, address, data):
+        self._append(_MEMORY_HEADER.pack(RECORD_MEMORY, step, address, len(data)) + bytes(data))
+
+    def writeSnapshot(self, step, address, registers, memoryStart, data):
+        self._append(_STEP_HEADER.pack(RECORD_SNAPSHOT, step, address) + _SNAPSHOT_REGISTERS.pack(*registers) +
+            _SNAPSHOT_MEMORY.pack(memoryStart, len(data)) + bytes(data))
+
+# Format: 'format name' : sink class
+TRACE_FORMATS = {
+    'ndjson': NDJSONTraceSink,
+    'binary': BinaryTraceSink,
+}
+
+#####################################################################
+# Tracer - observes a CPU while it runs and feeds a sink with
+# records of the selected granularity
+#####################################################################
+class Tracer:
+    def __init__(self, sink, mode=TraceMode.REGISTERS, snapshotInterval=1000, memoryWindow=(0, 256)):
+        self.sink = sink
+        self.mode = mode
+        self.snapshotInterval = snapshotInterval
+        self.memoryWindow = memoryWindow
+        self._cpu = None
+        self._previous = None
+        self._step = 0
+        self._address = 0
+
+    @staticmethod
+    def registerValues(cpu):
+        regFile = cpu.regFile
+        return regFile.words + regFile.segments + [regFile.ip, cpu.flags.getWord()]
+
+    # Called by the CPU before it starts running
+    def attach(self, cpu):
+        if self._cpu is cpu:
+            return
+        self._cpu = cpu
+        self._step = cpu.steps
+        self._previous = Tracer.registerValues(cpu)
+        if self.mode is TraceMode.MEMORY:
+            cpu.memory.watchPages(0, len(cpu.memory), self._onMemoryWrite)
+
+    def detach(self):
+        if self._cpu is not None and self.mode is TraceMode.MEMORY:
+            self._cpu.memory.unwatchPages(self._onMemoryWrite)
+        self._cpu = None
+
+    # Called by the CPU before every instruction
+    def beforeInstruction(self, address):
+        self._address = address
+
+    # Called by the CPU after every instruction
+    def afterInstruction(self, cpu):
+        self._step += 1
+        if self.mode is TraceMode.REGISTERS:
+            current = Tracer.registerValues(cpu)
+            previous = self._previous
+            changes = [(number, value) for number, value in enumerate(current) if value != previous[number]]
+            if changes:
+                self.sink.writeRegisters(self._step, self._address, changes)
+            self._previous = current
+        elif self.mode is TraceMode.SNAPSHOTS and self._step % self.snapshotInterval == 0:
+            start, stop = self.memoryWindow
+            self.sink.writeSnapshot(self._step, self._address, Tracer.registerValues(cpu), start, cpu.memory[start:stop])
+
+    def _onMemoryWrite(self, start, stop):
+        self.sink.writeMemory(self._step + 1, start, self._cpu.memory[start:stop])
+
+    def close(self):
+        self.detach()
+        self.sink.close()
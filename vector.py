@@ -0,0 +1,576 @@
+from alu import ALU, PARITY_TABLE, MASKS, SIGN_BITS
+from decoder import Decoder, DecodeException, Operand, OperandKind
+from loader import Loader, DEFAULT_LOAD_SEGMENT
+from memory import Memory
+from registers import FlagsRegister, RegisterFile
+
+# NumPy is only needed by the vectorized executor, the rest of the simulator runs without it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Size of the data memory of every lane, physical addresses [0, size) are backed
+DEFAULT_LANE_MEMORY_SIZE = 0x10000
+
+# The flags kept per lane, in the order of FLAG_BITS. The status flags and the direction flag,
+# the lanes take no interrupts
+FLAG_NAMES = ('carry', 'parity', 'auxiliary', 'zero', 'sign', 'overflow', 'direction')
+FLAG_BITS = (FlagsRegister.CARRY_BIT, FlagsRegister.PARITY_BIT, FlagsRegister.AUXILIARY_BIT,
+    FlagsRegister.ZERO_BIT, FlagsRegister.SIGN_BIT, FlagsRegister.OVERFLOW_BIT, FlagsRegister.DIRECTION_BIT)
+
+# The flag instructions that set or clear a flag
+# Format: 'mnemonic' : (flag name, value)
+VECTOR_FLAG_SETTERS = {
+    'clc': ('carry', False),
+    'stc': ('carry', True),
+    'cld': ('direction', False),
+    'std': ('direction', True),
+}
+
+#################################################################
+# VectorException - An exception that occured in the vectorized
+# executor
+#################################################################
+class VectorException(Exception):
+    pass
+
+#####################################################################
+# VectorCPU - runs one instruction stream over N lanes in lockstep.
+# Every register is a uint16 array of length N, the flags are boolean
+# arrays and the data memory is an (N, size) uint8 array, so each
+# instruction is executed once for all lanes.
+# The instruction stream is shared: it is decoded from a scalar
+# Memory holding the program and is not visible to the lanes.
+# Every lane has its own IP, so lanes can branch apart. Each step
+# runs the instruction at the lowest IP of the running lanes on the
+# lanes at that IP, which lets lanes behind catch up and reconverge.
+# Lanes that fault (divide errors, accesses outside their memory)
+# are masked out and keep their state from before the fault
+#####################################################################
+class VectorCPU:
+    def __init__(self, lanes, memorySize=DEFAULT_LANE_MEMORY_SIZE):
+        if np is None:
+            raise VectorException("The vectorized executor requires NumPy")
+        self.lanes = lanes
+        self.words = np.zeros((8, lanes), np.uint16)
+        self.segments = np.zeros((4, lanes), np.uint16)
+        self.memory = np.zeros((lanes, memorySize), np.uint8)
+        for name in FLAG_NAMES:
+            setattr(self, name, np.zeros(lanes, np.bool_))
+
+        # lanes not stopped by a fault, and lanes stopped by a fault
+        self.active = np.ones(lanes, np.bool_)
+        self.faulted = np.zeros(lanes, np.bool_)
+        # the IP of every lane, lanes that ran a hlt and the lanes executing the current instruction.
+        # executing is updated in place, the bound instructions hold on to it
+        self.ips = np.zeros(lanes, np.int64)
+        self.laneHalted = np.zeros(lanes, np.bool_)
+        self.executing = np.zeros(lanes, np.bool_)
+        self._currentIp = 0
+        self._laneIndex = np.arange(lanes)
+        self._parity = np.array(PARITY_TABLE, np.bool_)
+
+        # the shared instruction stream
+        self._code = Memory()
+        self.decoder = Decoder(self._code)
+        self._instructionCache = {}
+        self.codeSegment = DEFAULT_LOAD_SEGMENT
+        self.halted = False
+        self.steps = 0
+
+    ############################################################################
+    # State
+    ############################################################################
+
+    # Loads a machine code image shared by every lane and places a hlt right after it
+    def loadProgram(self, image, segment=DEFAULT_LOAD_SEGMENT):
+        Loader(self._code).loadImage(bytes(image) + bytes((0xF4,)), segment)
+        self._instructionCache.clear()
+        self.codeSegment = segment
+        self.segments[RegisterFile.CS] = segment
+        self.ips[:] = 0
+        self.laneHalted[:] = False
+        self.halted = False
+
+    # Sets a 16-bit, segment or ip register of every lane, values is a scalar or one value per lane
+    def setRegister(self, name, values):
+        name = name.lower()
+        if name in RegisterFile.WORD_NAMES:
+            self.words[RegisterFile.WORD_NAMES.index(name)] = np.asarray(values) & 0xFFFF
+        elif name in RegisterFile.SEGMENT_NAMES:
+            self.segments[RegisterFile.SEGMENT_NAMES.index(name)] = np.asarray(values) & 0xFFFF
+        else:
+            raise KeyError("Unknown lane register: " + name)
+
+    def getRegister(self, name):
+        name = name.lower()
+        if name in RegisterFile.WORD_NAMES:
+            return self.words[RegisterFile.WORD_NAMES.index(name)]
+        if name in RegisterFile.SEGMENT_NAMES:
+            return self.segments[RegisterFile.SEGMENT_NAMES.index(name)]
+        raise KeyError("Unknown lane register: " + name)
+
+    # Applies one initial state per lane, a state is a dict with optional 'registers' and 'memory'
+    # entries as used by batch.jobsForStates
+    def setStates(self, states):
+        if len(states) != self.lanes:
+            raise VectorException("Expected %d lane states, got %d" % (self.lanes, len(states)))
+        for lane, state in enumerate(states):
+            for name, value in (state.get('registers') or {}).items():
+                self.getRegister(name)[lane] = value & 0xFFFF
+            for address, data in (state.get('memory') or {}).items():
+                self.memory[lane, address:address + len(data)] = np.frombuffer(bytes(data), np.uint8)
+
+    # Returns the status flags of every lane packed as in the FLAGS word
+    def flagsWord(self):
+        word = np.zeros(self.lanes, np.uint16)
+        for name, bit in zip(FLAG_NAMES, FLAG_BITS):
+            word[getattr(self, name)] |= bit
+        return word
+
+    # Returns the registers of one lane by name, with the flags word under 'flags'
+    def laneState(self, lane):
+        values = {name: int(self.words[index, lane]) for index, name in enumerate(RegisterFile.WORD_NAMES)}
+        values.update((name, int(self.segments[index, lane])) for index, name in enumerate(RegisterFile.SEGMENT_NAMES))
+        values['ip'] = int(self.ips[lane])
+        values['flags'] = int(self.flagsWord()[lane])
+        return values
+
+    # Stops the executing lanes in the mask, they keep the state they had before the faulting instruction
+    def _fault(self, mask):
+        mask = mask & self.executing
+        if mask.any():
+            self.faulted |= mask
+            self.active &= ~mask
+            self.executing &= ~mask
+            self.ips[mask] = self._currentIp
+
+    ############################################################################
+    # Operands - readers return int64 arrays (or a scalar for immediates),
+    # writers store into the executing lanes only
+    ############################################################################
+
+    # Returns the lane memory addresses of a memory operand, faulting lanes that reach outside their memory.
+    # registers are the base and index registers of the operand
+    def _addresses(self, operand, registers):
+        offset = operand.value
+        for reg in registers:
+            offset = offset + self.words[reg].astype(np.int64)
+        physical = ((self.segments[operand.segment].astype(np.int64) << 4) + (offset & 0xFFFF)) & 0xFFFFF
+        stop = physical + operand.width // 8
+        outside = stop > self.memory.shape[1]
+        if outside.any():
+            self._fault(outside)
+            physical = np.where(outside, 0, physical)
+        return physical
+
+    # Returns the lane memory addresses of the word at SS:sp, faulting lanes that reach outside their memory
+    def _stackAddresses(self, sp):
+        physical = ((self.segments[RegisterFile.SS].astype(np.int64) << 4) + sp) & 0xFFFFF
+        outside = physical + 2 > self.memory.shape[1]
+        if outside.any():
+            self._fault(outside)
+            physical = np.where(outside, 0, physical)
+        return physical
+
+    def _loadWord(self, addresses):
+        memory = self.memory
+        lanes = self._laneIndex
+        return memory[lanes, addresses].astype(np.int64) | (memory[lanes, addresses + 1].astype(np.int64) << 8)
+
+    # Stores a value at the lane memory addresses of the executing lanes
+    def _store(self, addresses, value, width):
+        executing = self.executing
+        value = np.broadcast_to(value, (self.lanes,))[executing]
+        rows = self._laneIndex[executing]
+        addresses = addresses[executing]
+        self.memory[rows, addresses] = value & 0xFF
+        if width == 16:
+            self.memory[rows, addresses + 1] = (value >> 8) & 0xFF
+
+    def _reader(self, operand):
+        kind = operand.kind
+        if kind is OperandKind.REGISTER:
+            words = self.words
+            reg = operand.reg
+            if operand.width == 16:
+                return lambda: words[reg].astype(np.int64)
+            if reg < 4:
+                return lambda: (words[reg] & 0xFF).astype(np.int64)
+            return lambda: (words[reg - 4] >> 8).astype(np.int64)
+
+        if kind is OperandKind.IMMEDIATE:
+            value = operand.value
+            return lambda: value
+
+        if kind is OperandKind.MEMORY:
+            memory = self.memory
+            lanes = self._laneIndex
+            registers = _addressRegisters(operand)
+            if operand.width == 16:
+                return lambda: self._loadWord(self._addresses(operand, registers))
+            return lambda: memory[lanes, self._addresses(operand, registers)].astype(np.int64)
+
+        if kind is OperandKind.SEGMENT:
+            segments = self.segments
+            reg = operand.reg
+            return lambda: segments[reg].astype(np.int64)
+
+        raise DecodeException("Cannot read operand of kind " + str(kind))
+
+    def _writer(self, operand):
+        kind = operand.kind
+        executing = self.executing
+        if kind is OperandKind.REGISTER:
+            words = self.words
+            reg = operand.reg
+            if operand.width == 16:
+                def writeWord(value):
+                    np.copyto(words[reg], value & 0xFFFF, casting='unsafe', where=executing)
+                return writeWord
+            if reg < 4:
+                def writeLow(value):
+                    np.copyto(words[reg], (words[reg] & 0xFF00) | (value & 0xFF), casting='unsafe', where=executing)
+                return writeLow
+            high = reg - 4
+            def writeHigh(value):
+                np.copyto(words[high], (words[high] & 0x00FF) | ((value & 0xFF) << 8), casting='unsafe', where=executing)
+            return writeHigh
+
+        if kind is OperandKind.MEMORY:
+            width = operand.width
+            registers = _addressRegisters(operand)
+            return lambda value: self._store(self._addresses(operand, registers), value, width)
+
+        if kind is OperandKind.SEGMENT:
+            segments = self.segments
+            reg = operand.reg
+            def writeSegment(value):
+                np.copyto(segments[reg], value & 0xFFFF, casting='unsafe', where=executing)
+            return writeSegment
+
+        raise DecodeException("Cannot write operand of kind " + str(kind))
+
+    ############################################################################
+    # Flags - computed eagerly for all lanes, only the executing lanes are updated
+    ############################################################################
+
+    def _setFlag(self, name, value):
+        np.copyto(getattr(self, name), value, where=self.executing)
+
+    # Sets the flags from the (result, carry, overflow, auxiliary) tuple returned by the ALU
+    def _setArithmeticFlags(self, outcome, width, keepCarry=False):
+        result, carry, overflow, auxiliary = outcome
+        if not keepCarry:
+            self._setFlag('carry', carry)
+        self._setFlag('overflow', overflow)
+        self._setFlag('auxiliary', auxiliary)
+        self._setFlag('zero', result == 0)
+        self._setFlag('sign', (result & SIGN_BITS[width]) != 0)
+        self._setFlag('parity', self._parity[result & 0xFF])
+
+    ############################################################################
+    # Instructions
+    ############################################################################
+
+    # Builds the function executing a decoded instruction on every active lane
+    def _bind(self, instruction):
+        mnemonic = instruction.mnemonic
+        width = instruction.width
+        dest, source = instruction.dest, instruction.source
+
+        if mnemonic == 'mov':
+            write = self._writer(dest)
+            read = self._reader(source)
+            return lambda: write(read())
+
+        if mnemonic in VECTOR_ALU_OPERATIONS:
+            compute, usesCarry, store = VECTOR_ALU_OPERATIONS[mnemonic]
+            readDest = self._reader(dest)
+            readSource = self._reader(source)
+            write = self._writer(dest) if store else None
+            def binary():
+                a = readDest()
+                b = readSource()
+                outcome = compute(a, b, width, self.carry.astype(np.int64)) if usesCarry else compute(a, b, width)
+                if write is not None:
+                    write(outcome[0])
+                self._setArithmeticFlags(outcome, width)
+            return binary
+
+        if mnemonic in ('inc', 'dec', 'neg', 'not'):
+            compute = {'inc': ALU.inc, 'dec': ALU.dec, 'neg': ALU.neg}.get(mnemonic)
+            readDest = self._reader(dest)
+            write = self._writer(dest)
+            def unary():
+                a = readDest()
+                if compute is None:
+                    # not does not change any flag
+                    write(~a & MASKS[width])
+                    return
+                outcome = compute(a, width)
+                write(outcome[0])
+                self._setArithmeticFlags(outcome, width, keepCarry=mnemonic != 'neg')
+            return unary
+
+        if mnemonic in ('mul', 'imul'):
+            return self._bindMultiply(instruction, mnemonic == 'imul')
+        if mnemonic in ('div', 'idiv'):
+            return self._bindDivide(instruction, mnemonic == 'idiv')
+
+        if mnemonic in ('push', 'pop', 'pushf', 'popf'):
+            return self._bindStack(instruction)
+        if mnemonic in VECTOR_BRANCH_CONDITIONS or mnemonic in ('jmp', 'call', 'ret'):
+            return self._bindBranch(instruction)
+
+        if mnemonic in VECTOR_FLAG_SETTERS:
+            name, value = VECTOR_FLAG_SETTERS[mnemonic]
+            return lambda: self._setFlag(name, value)
+        if mnemonic == 'cmc':
+            return lambda: self._setFlag('carry', ~self.carry)
+
+        if mnemonic == 'nop':
+            return lambda: None
+        if mnemonic == 'hlt':
+            def hlt():
+                self.laneHalted |= self.executing
+            return hlt
+
+        raise DecodeException("Instruction '%s' at address 0x%05x is not supported by the vectorized executor" %
+            (mnemonic, instruction.address))
+
+    # push/pop/pushf/popf on the stack of every lane, push sp stores the decremented value like the 8086
+    def _bindStack(self, instruction):
+        mnemonic = instruction.mnemonic
+        words = self.words
+        writeSp = self._writer(_SP_OPERAND)
+
+        if mnemonic in ('push', 'pushf'):
+            read = self._reader(instruction.dest) if mnemonic == 'push' else lambda: self.flagsWord().astype(np.int64)
+            def push():
+                sp = (words[RegisterFile.SP].astype(np.int64) - 2) & 0xFFFF
+                addresses = self._stackAddresses(sp)
+                writeSp(sp)
+                self._store(addresses, read(), 16)
+            return push
+
+        if mnemonic == 'pop':
+            write = self._writer(instruction.dest)
+        else:
+            def write(value):
+                for name, bit in zip(FLAG_NAMES, FLAG_BITS):
+                    self._setFlag(name, (value & bit) != 0)
+        # the destination is written before SP moves, so a lane faulting on the write keeps its SP.
+        # pop sp is the exception, SP ends up holding the popped value
+        dest = instruction.dest
+        if dest is not None and dest.kind is OperandKind.REGISTER and dest.reg == RegisterFile.SP:
+            def pop():
+                sp = words[RegisterFile.SP].astype(np.int64)
+                value = self._loadWord(self._stackAddresses(sp))
+                writeSp(sp + 2)
+                write(value)
+            return pop
+        def pop():
+            sp = words[RegisterFile.SP].astype(np.int64)
+            value = self._loadWord(self._stackAddresses(sp))
+            write(value)
+            writeSp(sp + 2)
+        return pop
+
+    # Branches move the IP of the executing lanes that take them, the others continue with the next instruction
+    def _bindBranch(self, instruction):
+        mnemonic = instruction.mnemonic
+        target = instruction.dest
+        ips = self.ips
+        executing = self.executing
+        words = self.words
+        writeSp = self._writer(_SP_OPERAND)
+
+        if mnemonic == 'ret':
+            release = 2 if target is None else 2 + target.value
+            def ret():
+                sp = words[RegisterFile.SP].astype(np.int64)
+                value = self._loadWord(self._stackAddresses(sp))
+                writeSp(sp + release)
+                np.copyto(ips, value, where=executing)
+            return ret
+
+        if target.kind is OperandKind.RELATIVE:
+            displacement = target.value
+            newIps = lambda: (ips + displacement) & 0xFFFF
+        else:
+            newIps = self._reader(target)
+
+        if mnemonic == 'jmp':
+            return lambda: np.copyto(ips, newIps(), where=executing)
+        if mnemonic == 'call':
+            def call():
+                targets = newIps()
+                sp = (words[RegisterFile.SP].astype(np.int64) - 2) & 0xFFFF
+                addresses = self._stackAddresses(sp)
+                writeSp(sp)
+                self._store(addresses, ips, 16)
+                np.copyto(ips, targets, where=executing)
+            return call
+
+        condition = VECTOR_BRANCH_CONDITIONS[mnemonic]
+        writeCx = self._writer(_CX_OPERAND)
+        def branch():
+            if mnemonic.startswith('loop'):
+                writeCx(words[RegisterFile.CX].astype(np.int64) - 1)
+            np.copyto(ips, newIps(), where=executing & condition(self))
+        return branch
+
+    # mul/imul - AX = AL * src or DX:AX = AX * src, CF and OF tell whether the high half is significant
+    def _bindMultiply(self, instruction, signed):
+        readSource = self._reader(instruction.source)
+        width = instruction.width
+        mask = MASKS[width]
+        ax = self._writer(_AX_OPERAND)
+        dx = self._writer(_DX_OPERAND)
+        def multiply():
+            a = self.words[RegisterFile.AX].astype(np.int64) & mask
+            b = np.broadcast_to(readSource(), (self.lanes,))
+            if signed:
+                product = _toSigned(a, width) * _toSigned(b, width)
+                low = product & mask
+                high = (product >> width) & mask
+                significant = high != np.where(low & SIGN_BITS[width], mask, 0)
+            else:
+                product = a * b
+                low = product & mask
+                high = product >> width
+                significant = high != 0
+            if width == 16:
+                ax(low)
+                dx(high)
+            else:
+                ax((high << 8) | low)
+            self._setFlag('carry', significant)
+            self._setFlag('overflow', significant)
+        return multiply
+
+    # div/idiv - AL, AH = AX / src or AX, DX = DX:AX / src, lanes with a divide error fault
+    def _bindDivide(self, instruction, signed):
+        readSource = self._reader(instruction.source)
+        width = instruction.width
+        mask = MASKS[width]
+        ax = self._writer(_AX_OPERAND)
+        dx = self._writer(_DX_OPERAND)
+        def divide():
+            words = self.words
+            if width == 16:
+                dividend = (words[RegisterFile.DX].astype(np.int64) << 16) | words[RegisterFile.AX]
+            else:
+                dividend = words[RegisterFile.AX].astype(np.int64)
+            divisor = np.broadcast_to(readSource(), (self.lanes,)).astype(np.int64)
+            zero = divisor == 0
+            divisor = np.where(zero, 1, divisor)
+            if signed:
+                dividend = _toSigned(dividend, width * 2)
+                divisor = _toSigned(divisor, width)
+                # 8086 division truncates towards zero and the remainder takes the sign of the dividend
+                quotient = np.abs(dividend) // np.abs(divisor)
+                quotient = np.where((dividend < 0) != (divisor < 0), -quotient, quotient)
+                remainder = dividend - quotient * divisor
+                limit = SIGN_BITS[width]
+                overflow = (quotient >= limit) | (quotient < -limit)
+            else:
+                quotient, remainder = np.divmod(dividend, divisor)
+                overflow = quotient > mask
+            self._fault(zero | overflow)
+            quotient &= mask
+            remainder &= mask
+            if width == 16:
+                ax(quotient)
+                dx(remainder)
+            else:
+                ax((remainder << 8) | quotient)
+        return divide
+
+    ############################################################################
+    # Execution
+    ############################################################################
+
+    def instructionAt(self, address):
+        instruction = self._instructionCache.get(address)
+        if instruction is None:
+            instruction = self.decoder.decode(address)
+            instruction.execute = self._bind(instruction)
+            self._instructionCache[address] = instruction
+        return instruction
+
+    # Runs until every lane ran a hlt or faulted, or until maxSteps instructions were executed.
+    # Returns the number of executed instructions, an instruction run by a group of lanes counts once
+    def run(self, maxSteps=None):
+        limit = -1 if maxSteps is None else maxSteps
+        ips = self.ips
+        executing = self.executing
+        steps = 0
+        self.halted = False
+        running = self.active & ~self.laneHalted
+        while steps != limit and running.any():
+            # lanes that are not running never have the lowest IP
+            ip = int(np.where(running, ips, 0x10000).min())
+            np.copyto(executing, running & (ips == ip))
+            instruction = self.instructionAt(((self.codeSegment << 4) + ip) & 0xFFFFF)
+            self._currentIp = ip
+            ips[executing] = (ip + instruction.length) & 0xFFFF
+            instruction.execute()
+            steps += 1
+            running = self.active & ~self.laneHalted
+        self.halted = bool((self.laneHalted & self.active).any()) and not running.any()
+        self.steps += steps
+        return steps
+
+# The implicit operands of mul/div
+_AX_OPERAND = Operand.register(RegisterFile.AX, 16)
+_DX_OPERAND = Operand.register(RegisterFile.DX, 16)
+_CX_OPERAND = Operand.register(RegisterFile.CX, 16)
+_SP_OPERAND = Operand.register(RegisterFile.SP, 16)
+
+# The registers added to the displacement of a memory operand
+def _addressRegisters(operand):
+    return tuple(reg for reg in (operand.base, operand.index) if reg is not None)
+
+def _toSigned(values, width):
+    return np.where(values & SIGN_BITS[width], values - (MASKS[width] + 1), values)
+
+# The ALU operations work on whole arrays, they only use elementwise arithmetic
+# Format: 'mnemonic' : (ALU function, whether it takes the carry flag, whether the result is stored)
+VECTOR_ALU_OPERATIONS = {
+    'add': (ALU.add, False, True),
+    'adc': (ALU.add, True, True),
+    'sub': (ALU.sub, False, True),
+    'sbb': (ALU.sub, True, True),
+    'cmp': (ALU.sub, False, False),
+    'and': (ALU.bitwiseAnd, False, True),
+    'or': (ALU.bitwiseOr, False, True),
+    'xor': (ALU.bitwiseXor, False, True),
+}
+
+# The conditions of the conditional jumps and loops per lane, loops test CX after decrementing it
+# Format: 'mnemonic' : function of the VectorCPU returning a boolean array
+VECTOR_BRANCH_CONDITIONS = {
+    'jo': lambda cpu: cpu.overflow,
+    'jno': lambda cpu: ~cpu.overflow,
+    'jb': lambda cpu: cpu.carry,
+    'jae': lambda cpu: ~cpu.carry,
+    'je': lambda cpu: cpu.zero,
+    'jne': lambda cpu: ~cpu.zero,
+    'jbe': lambda cpu: cpu.carry | cpu.zero,
+    'ja': lambda cpu: ~(cpu.carry | cpu.zero),
+    'js': lambda cpu: cpu.sign,
+    'jns': lambda cpu: ~cpu.sign,
+    'jp': lambda cpu: cpu.parity,
+    'jnp': lambda cpu: ~cpu.parity,
+    'jl': lambda cpu: cpu.sign != cpu.overflow,
+    'jge': lambda cpu: cpu.sign == cpu.overflow,
+    'jle': lambda cpu: cpu.zero | (cpu.sign != cpu.overflow),
+    'jg': lambda cpu: ~cpu.zero & (cpu.sign == cpu.overflow),
+    'loop': lambda cpu: cpu.words[RegisterFile.CX] != 0,
+    'loope': lambda cpu: (cpu.words[RegisterFile.CX] != 0) & cpu.zero,
+    'loopne': lambda cpu: (cpu.words[RegisterFile.CX] != 0) & ~cpu.zero,
+    'jcxz': lambda cpu: cpu.words[RegisterFile.CX] == 0,
+}
@@ -0,0 +1,121 @@
+import sys
+from assembler import assemble
+from batch import BatchJob, BatchRunner, jobsForStates
+from differential import DifferentialChecker, firstDifference
+from jit_check import ProgramGenerator
+from vector import VectorCPU, FLAG_BITS, np
+
+# Registers the lanes start with random values in. The address registers start low enough that
+# no address reaches the end of the segment, and the stack starts well below it
+DATA_REGISTERS = ('ax', 'dx')
+ADDRESS_REGISTERS = ('bx', 'si', 'di', 'bp')
+MAX_ADDRESS_REGISTER = 0x3FFF
+STACK_POINTERS = range(0x8000, 0xF000, 2)
+
+# The data and the stack segment start after the interrupt vector table. The lanes take no
+# interrupts, the interpreter would enter a divide error handler a program wrote into the table
+DATA_SEGMENT = 0x40
+
+# A data segment past the end of the lane memory, the lanes fault on its accesses
+FAULTING_DATA_SEGMENT = 0xF000
+
+# The memory of a lane and the part of it both executors can write
+LANE_MEMORY_SIZE = (DATA_SEGMENT << 4) + 0x10000
+COMPARED_MEMORY = (0, 0x10000)
+
+# The bits of the flags word the lanes keep
+LANE_FLAGS_MASK = sum(FLAG_BITS)
+
+#####################################################################
+# VectorChecker - runs random programs over random lane states with
+# the vectorized executor and runs every lane again on its own on
+# the interpreter, through a BatchRunner. A lane that faulted must
+# have failed on the interpreter too, with its registers and memory
+# as they were before the faulting instruction
+#####################################################################
+class VectorChecker(DifferentialChecker):
+    DESCRIPTION = "Checks the vectorized executor against the interpreter on random programs"
+    OPTIONS = {
+        'programs': ('programs', 100, None),
+        'lanes': ('lanes', 32, None),
+    }
+
+    # Compares a lane with the interpreter run of its state. A lane that faulted on a divide error is
+    # compared without IP and halted state, the interpreter stopped with IP past the faulting instruction
+    def compareLane(self, case, vector, lane, result, faulted):
+        state = vector.laneState(lane)
+        registers = dict(result.registers)
+        if faulted and result.error is not None:
+            del registers['ip']
+            del state['ip']
+        else:
+            self.expect('halted', case, bool(vector.laneHalted[lane]), result.halted)
+        self.expect('flags', case, state.pop('flags'), result.flags & LANE_FLAGS_MASK)
+        self.expect('registers', case, state, registers)
+        self.expect('first differing memory address', case, firstDifference(vector.memory[lane, slice(*COMPARED_MEMORY)], result.memory), None)
+
+    # Runs a program over the lane states with the vectorized executor, returns it
+    @staticmethod
+    def runLanes(source, states):
+        vector = VectorCPU(len(states), LANE_MEMORY_SIZE)
+        vector.loadProgram(assemble(source).getMachineCode())
+        vector.setStates(states)
+        vector.run()
+        return vector
+
+    def checkProgram(self, number, source, states):
+        vector = VectorChecker.runLanes(source, states)
+        results = BatchRunner(memoryWindow=COMPARED_MEMORY).run(jobsForStates(source, states)).results
+        for lane, result in enumerate(results):
+            case = "program %d, lane %d" % (number, lane)
+            faulted = bool(vector.faulted[lane])
+            self.expect('fault', case, faulted, result.error is not None)
+            self.compareLane(case, vector, lane, result, faulted)
+
+    # Runs pushes and a pop into memory over lanes of which some have their data segment outside the
+    # lane memory. Those lanes fault on the pop and must keep the state the interpreter has right
+    # before it, SP included. The other lanes run to the end
+    def checkFaultingPop(self, number, source, states, pushes):
+        vector = VectorChecker.runLanes(source, states)
+        faulting = [state['registers']['ds'] == FAULTING_DATA_SEGMENT for state in states]
+        jobs = jobsForStates(source, states)
+        jobs = [BatchJob(source, job.registers, maxSteps=pushes) if fault else job for job, fault in zip(jobs, faulting)]
+        results = BatchRunner(memoryWindow=COMPARED_MEMORY).run(jobs).results
+        for lane, result in enumerate(results):
+            case = "program %d, lane %d" % (number, lane)
+            faulted = bool(vector.faulted[lane])
+            self.expect('fault', case, faulted, faulting[lane])
+            self.compareLane(case, vector, lane, result, faulted)
+
+    # Returns random lane states
+    @staticmethod
+    def laneStates(generator, rng, lanes):
+        states = []
+        for lane in range(lanes):
+            registers = {name: generator.immediate(16) for name in DATA_REGISTERS}
+            registers.update((name, generator.immediate(16) & MAX_ADDRESS_REGISTER) for name in ADDRESS_REGISTERS)
+            registers['sp'] = rng.choice(STACK_POINTERS)
+            registers['ds'] = registers['ss'] = DATA_SEGMENT
+            states.append({'registers': registers})
+        return states
+
+    def run(self, rng, programs, lanes):
+        generator = ProgramGenerator(rng, segmentOverrides=False, addressRegisters=False)
+        for number in range(programs):
+            states = VectorChecker.laneStates(generator, rng, lanes)
+            if rng.random() < 0.1:
+                pushes = rng.randint(1, 3)
+                lines = ['push %s' % rng.choice(DATA_REGISTERS) for i in range(pushes)]
+                source = '\n'.join(lines + ['pop word ptr [bx+si+%d]' % rng.randint(0, 300), 'pop ax', 'hlt'])
+                for state in states:
+                    if rng.random() < 0.5:
+                        state['registers']['ds'] = FAULTING_DATA_SEGMENT
+                self.checkCase("program %d:\n%s" % (number, source), self.checkFaultingPop, number, source, states, pushes)
+            else:
+                source = generator.program(rng.randint(1, 30), rng.randint(1, 40), registers=False)
+                self.checkCase("program %d:\n%s" % (number, source), self.checkProgram, number, source, states)
+
+if __name__ == "__main__":
+    if np is None:
+        sys.exit("The vectorized executor requires NumPy")
+    VectorChecker.main()